@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of msgpack codec, comparing request preparation with the previous one, which was walking meta
+recursively for every request.
+
+Usage: python -m benchmarks.encoding --messages 2000 --out-degree 30
+"""
+from argparse import ArgumentParser
+from time import time
+
+from msgpack import packb
+from frontera.core.models import Request, Response
+
+from distributed_frontera.backends.remote.codecs import msgpack, compact
+from distributed_frontera.backends.remote.codecs.msgpack import Encoder, Decoder
+
+from benchmarks.webgraph import WebGraph, make_request, make_response
+
+
+def legacy_prepare_request_message(request):
+    def serialize(obj):
+        """Recursively walk object's hierarchy."""
+        if isinstance(obj, (bool, int, long, float, basestring)):
+            return obj
+        elif isinstance(obj, dict):
+            obj = obj.copy()
+            for key in obj:
+                obj[key] = serialize(obj[key])
+            return obj
+        elif isinstance(obj, list):
+            return [serialize(item) for item in obj]
+        elif isinstance(obj, tuple):
+            return tuple(serialize([item for item in obj]))
+        elif hasattr(obj, '__dict__'):
+            return serialize(obj.__dict__)
+        else:
+            return None
+    return [request.url, request.headers, request.cookies, serialize(request.meta)]
+
+
+class LegacyEncoder(Encoder):
+    def encode_page_crawled(self, response, links):
+        return packb(['pc', msgpack._prepare_response_message(response, self.send_body),
+                      map(legacy_prepare_request_message, links)])
+
+    def encode_request(self, request):
+        return packb(legacy_prepare_request_message(request))
+
+
+def measure(func, items):
+    started = time()
+    for item in items:
+        func(*item)
+    return len(items) / (time() - started)
+
+
+def run(args):
+    graph = WebGraph(args.hosts, out_degree=args.out_degree)
+    pages = []
+    for url, links in graph.crawl(graph.seeds(10), args.messages):
+        response = make_response(url)
+        response.meta['state'] = 2
+        links = [make_request(link, state=None, score=0.5, jid=0) for link in links]
+        pages.append((response, links))
+    requests = [(link,) for _, links in pages for link in links[:1]]
+
+    print "%-16s %-20s %12s" % ("encoder", "operation", "ops/sec")
+    for encoder in (LegacyEncoder(Request), Encoder(Request)):
+        name = encoder.__class__.__name__
+        print "%-16s %-20s %12.0f" % (name, "encode_page_crawled", measure(encoder.encode_page_crawled, pages))
+        print "%-16s %-20s %12.0f" % (name, "encode_request", measure(encoder.encode_request, requests))
+
+    encoder = Encoder(Request)
+    decoder = Decoder(Request, Response)
+    messages = [(encoder.encode_page_crawled(*page),) for page in pages]
+    print "%-16s %-20s %12.0f" % ("Decoder", "decode", measure(decoder.decode, messages))
+    messages = [(encoder.encode_request(*request),) for request in requests]
+    print "%-16s %-20s %12.0f" % ("Decoder", "decode_request", measure(decoder.decode_request, messages))
+
+    scores = [(link.meta['fingerprint'], 0.5, link.url, True) for _, links in pages for link in links]
+    print
+    print "%-16s %-20s %12s %12s" % ("codec", "message", "ops/sec", "avg bytes")
+    for codec in (msgpack, compact):
+        encoder = codec.Encoder(Request)
+        decoder = codec.Decoder(Request, Response)
+        name = codec.__name__.rsplit('.', 1)[-1]
+        for message, encode, decode, items in (
+                ("update_score", encoder.encode_update_score, decoder.decode, scores),
+                ("request", encoder.encode_request, decoder.decode_request, requests)):
+            encoded = [(encode(*item),) for item in items]
+            print "%-16s %-20s %12.0f %12.1f" % (name, "encode " + message, measure(encode, items),
+                                                 sum(len(m[0]) for m in encoded) / float(len(encoded)))
+            print "%-16s %-20s %12.0f" % (name, "decode " + message, measure(decode, encoded))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="msgpack codec benchmark")
+    parser.add_argument('--messages', type=int, default=2000, help="Number of page_crawled messages")
+    parser.add_argument('--hosts', type=int, default=1000, help="Number of hosts in web graph")
+    parser.add_argument('--out-degree', type=int, default=30, help="Average number of links per page")
+    run(parser.parse_args())
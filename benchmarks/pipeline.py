@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the crawling pipeline: spider log -> strategy worker -> scoring log -> DB worker -> outgoing
+topic -> spider. All components run in one process, each on it's own thread, with in-memory stand-ins for Kafka and
+HBase. Spider "crawls" requests instantly, getting links from synthetic web graph, so the benchmark measures frontier
+overhead only.
+
+Latency is measured for every request, from the moment link was first sent by the spider in page_crawled, till the
+spider got the request for it from outgoing topic. Besides messages, decoded records are counted for every topic, as
+with framing one message carries several requests.
+
+Usage: python -m benchmarks.pipeline --duration 30 --hosts 1000 --out-degree 30
+"""
+import logging
+from argparse import ArgumentParser
+from threading import Thread, Event
+from time import time
+
+from frontera import FrontierManager, Settings as FrontierSettings
+from frontera.core.models import Request, Response
+from kafka import SimpleConsumer
+
+from distributed_frontera.backends.remote.codecs.framing import iter_records
+from distributed_frontera.settings import Settings
+from distributed_frontera.stubs import hbase, kafka
+from distributed_frontera.worker.main import FrontierWorker
+from distributed_frontera.worker.score import ScoringWorker
+from distributed_frontera.worker.strategy import bfs
+
+from benchmarks.webgraph import WebGraph
+
+logging.basicConfig()
+logger = logging.getLogger("pipeline-benchmark")
+
+MIDDLEWARES = [
+    'frontera.contrib.middlewares.fingerprint.UrlFingerprintMiddleware',
+    'frontera.contrib.middlewares.domain.DomainMiddleware',
+    'frontera.contrib.middlewares.fingerprint.DomainFingerprintMiddleware'
+]
+
+COMMON = {
+    'KAFKA_CLIENT': 'distributed_frontera.stubs.kafka.KafkaClient',
+    'KAFKA_LOCATION': 'localhost:9092',
+    'INCOMING_TOPIC': 'frontier-done',
+    'OUTGOING_TOPIC': 'frontier-todo',
+    'SCORING_TOPIC': 'frontier-score',
+    'FRONTIER_GROUP': 'scrapy-crawler',
+    'SCORING_GROUP': 'scrapy-scoring',
+    'MIDDLEWARES': MIDDLEWARES,
+    'LOGGING_ENABLED': False,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Spider(object):
+    def __init__(self, args):
+        attributes = dict(COMMON)
+        attributes.update({
+            'BACKEND': 'distributed_frontera.backends.remote.KafkaBackend',
+            'SPIDER_PARTITION_ID': 0,
+            'KAFKA_GET_TIMEOUT': 0.1,
+            'MAX_NEXT_REQUESTS': args.batch,
+            'KAFKA_CODEC': args.codec,
+            'KAFKA_ASYNC_PRODUCER': args.async_producer,
+            'KAFKA_PREFETCH': args.prefetch,
+        })
+        self.manager = FrontierManager.from_settings(FrontierSettings(attributes=attributes))
+        self.graph = WebGraph(args.hosts, out_degree=args.out_degree, alpha=args.alpha, seed=args.seed)
+        self.batch = args.batch
+        self.seen = {}
+        self.latencies = []
+        self.crawled = 0
+
+    def add_seeds(self, count):
+        self.manager.add_seeds([Request(url) for url in self.graph.seeds(count)])
+
+    def crawl(self):
+        requests = self.manager.get_next_requests(self.batch)
+        received = time()
+        for request in requests:
+            if request.url in self.seen:
+                self.latencies.append(received - self.seen.pop(request.url))
+            links = [Request(url) for url in self.graph.links(request.url)]
+            self.manager.page_crawled(Response(request.url, request=request), links)
+            # sending the whole batch takes a while, so links are stamped as their page is sent
+            sent = time()
+            for link in links:
+                self.seen.setdefault(link.url, sent)
+            self.crawled += 1
+
+
+def worker_settings(args):
+    attributes = dict(COMMON)
+    attributes.update({
+        'BACKEND': 'distributed_frontera.backends.hbase.HBaseBackend',
+        'HBASE_CONNECTION': 'distributed_frontera.stubs.hbase.Connection',
+        'HBASE_QUEUE_PARTITIONS': 1,
+        'SCORING_PARTITION_ID': 0,
+        'MAX_NEXT_REQUESTS': args.batch * 4,
+        'CONSUMER_BATCH_SIZE': args.batch,
+        'KAFKA_CODEC': args.codec,
+        'KAFKA_FRAME_SIZE': args.frame_size,
+        'NEW_BATCH_DELAY': 0.05,
+    })
+    return Settings(attributes=attributes)
+
+
+def count_records(topic):
+    consumer = SimpleConsumer(kafka.KafkaClient(COMMON['KAFKA_LOCATION']), 'pipeline-benchmark', topic,
+                              auto_commit=False, buffer_size=1048576, max_buffer_size=None)
+    records = 0
+    while True:
+        messages = consumer.get_messages(count=1000, block=False)
+        if not messages:
+            return records
+        for m in messages:
+            records += sum(1 for _ in iter_records(m.message.value))
+
+
+def loop(stopped, func):
+    def target():
+        try:
+            while not stopped.is_set():
+                func()
+        except Exception:
+            logger.exception("Pipeline component failed")
+            stopped.set()
+    thread = Thread(target=target)
+    thread.daemon = True
+    return thread
+
+
+def run(args):
+    hbase.cluster.reset()
+    kafka.broker.reset()
+    for topic in (COMMON['INCOMING_TOPIC'], COMMON['OUTGOING_TOPIC'], COMMON['SCORING_TOPIC']):
+        kafka.broker.create_topic(topic, 1)
+
+    spider = Spider(args)
+    scoring = ScoringWorker(worker_settings(args), bfs)
+    db = FrontierWorker(worker_settings(args), False, False, False, args.pipelined)
+
+    def db_worker():
+        db.consume_incoming()
+        db.consume_scoring()
+        db.new_batch()
+
+    spider.add_seeds(args.seeds)
+    stopped = Event()
+    threads = [loop(stopped, spider.crawl), loop(stopped, scoring.work)]
+    if not args.pipelined:
+        threads.append(loop(stopped, db_worker))
+    started = time()
+    for thread in threads:
+        thread.start()
+    if args.pipelined:
+        db.slot.schedule(on_start=True)
+    stopped.wait(args.duration)
+    stopped.set()
+    if args.pipelined:
+        db.slot.stop()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+    spider.manager.stop()
+
+    stats = kafka.broker.get_stats()
+    print "%-16s %12s %12s %12s %12s" % ("topic", "messages", "msgs/sec", "records", "records/sec")
+    for topic in (COMMON['INCOMING_TOPIC'], COMMON['SCORING_TOPIC'], COMMON['OUTGOING_TOPIC']):
+        records = count_records(topic)
+        print "%-16s %12d %12.0f %12d %12.0f" % (topic, stats[topic]['messages'], stats[topic]['messages'] / elapsed,
+                                                 records, records / elapsed)
+    print "pages crawled: %d, %.0f pages/sec" % (spider.crawled, spider.crawled / elapsed)
+    latencies = sorted(spider.latencies)
+    print "link to request latency, sec: median %.3f, p95 %.3f, p99 %.3f, max %.3f" % (
+        percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99), percentile(latencies, 100))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="End-to-end pipeline benchmark")
+    parser.add_argument('--duration', type=float, default=30.0, help="Benchmark duration, seconds")
+    parser.add_argument('--hosts', type=int, default=1000, help="Number of hosts in web graph")
+    parser.add_argument('--out-degree', type=int, default=30, help="Average number of links per page")
+    parser.add_argument('--alpha', type=float, default=1.0, help="Exponent of popularity power law")
+    parser.add_argument('--seeds', type=int, default=100, help="Number of seed URLs")
+    parser.add_argument('--batch', type=int, default=256, help="Spider batch size")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--codec', default='distributed_frontera.backends.remote.codecs.msgpack',
+                        help="Kafka messages codec module")
+    parser.add_argument('--frame-size', type=int, default=0, help="Kafka frame size, 0 disables framing")
+    parser.add_argument('--async-producer', action='store_true', help="Send spider log asynchronously")
+    parser.add_argument('--prefetch', type=int, default=0, help="Number of requests spider prefetches")
+    parser.add_argument('--pipelined', action='store_true', help="Run DB worker loops on separate threads")
+    run(parser.parse_args())
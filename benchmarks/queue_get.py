@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of HBaseQueue.get, comparing streaming implementation with the previous one, which was materializing
+maps of all scanned items.
+
+Usage: python -m benchmarks.queue_get --items 200000 --hosts 2000
+"""
+import logging
+from argparse import ArgumentParser
+from binascii import hexlify
+from gc import collect
+from hashlib import sha1
+from io import BytesIO
+from multiprocessing import Process, Queue
+from resource import getrusage, RUSAGE_SELF
+from time import time, sleep
+from random import Random
+
+from msgpack import Unpacker
+
+from distributed_frontera.backends.hbase import HBaseQueue
+from distributed_frontera.stubs.hbase import Connection
+
+logging.basicConfig()
+logger = logging.getLogger("queue-benchmark")
+
+
+class LegacyHBaseQueue(HBaseQueue):
+    """
+    HBaseQueue.get before streaming rework, with the scan helpers it was using, verbatim.
+    """
+    def _estimate_limit(self, partition_id, min_requests, min_hosts):
+        """
+        Estimates number of rows to scan to get min_requests from min_hosts, using density observed in previous scans
+        of the partition.
+        """
+        if partition_id not in self._density:
+            return int(min_requests)
+        hosts_per_row, items_per_row = self._density[partition_id]
+        rows = float(min_requests) / max(items_per_row, 0.01)
+        if min_hosts is not None:
+            rows = max(rows, float(min_hosts) / max(hosts_per_row, 0.01))
+        return int(rows * 1.2) + 1
+
+    def _update_density(self, partition_id, rows, hosts, items):
+        if not rows:
+            return
+        density = (float(hosts) / rows, float(items) / rows)
+        if partition_id in self._density:
+            previous = self._density[partition_id]
+            density = ((previous[0] + density[0]) / 2, (previous[1] + density[1]) / 2)
+        self._density[partition_id] = density
+
+    def _should_retry(self, tries, started, rows, limit):
+        if rows < limit:
+            return False  # partition is exhausted
+        return tries < self.GET_RETRIES and time() - started < self.get_time_budget
+
+    def get(self, partition_id, min_requests, min_hosts=None, max_requests_per_host=None):
+        table = self.connection.table(self.table_name)
+
+        meta_map = {}
+        queue = {}
+        limit = self._estimate_limit(partition_id, min_requests, min_hosts)
+        tries = 0
+        count = 0
+        started = time()
+        while True:
+            tries += 1
+            self.logger.debug("Try %d, limit %d, last attempt: requests %d, hosts %d" % (tries, limit, count, len(queue.keys())))
+            meta_map.clear()
+            queue.clear()
+            rows = 0
+            items = 0
+            for rk, data in table.scan(row_prefix='%d_' % partition_id, limit=limit, batch_size=256):
+                rows += 1
+                for cq, buf in data.iteritems():
+                    stream = BytesIO(buf)
+                    unpacker = Unpacker(stream)
+                    for item in unpacker:
+                        items += 1
+                        fingerprint, host_crc32, url, score = item
+                        if host_crc32 not in queue:
+                            queue[host_crc32] = []
+                        if max_requests_per_host is not None and len(queue[host_crc32]) > max_requests_per_host:
+                            continue
+                        queue[host_crc32].append(fingerprint)
+
+                        if fingerprint not in meta_map:
+                            meta_map[fingerprint] = []
+                        meta_map[fingerprint].append((rk, item))
+
+            count = 0
+            for host_id, fprints in queue.iteritems():
+                count += len(fprints)
+            self._update_density(partition_id, rows, len(queue), items)
+
+            if count >= min_requests and (min_hosts is None or len(queue.keys()) >= min_hosts):
+                break
+            if not self._should_retry(tries, started, rows, limit):
+                break
+            limit = max(limit * 2, self._estimate_limit(partition_id, min_requests, min_hosts))
+
+        self.logger.debug("Tries %d, hosts %d, requests %d" % (tries, len(queue.keys()), count))
+
+        # For every fingerprint collect it's row keys and return all fingerprints from them
+        fprint_map = {}
+        for fprint, meta_list in meta_map.iteritems():
+            for rk, _ in meta_list:
+                fprint_map.setdefault(rk, []).append(fprint)
+
+        results = set()
+        trash_can = set()
+        for _, fprints in queue.iteritems():
+            for fprint in fprints:
+                for rk, _ in meta_map[fprint]:
+                    trash_can.add(rk)
+                    for rk_fprint in fprint_map[rk]:
+                        _, item = meta_map[rk_fprint][0]
+                        _, _, url, score = item
+                        results.add((hexlify(rk_fprint), url, score))
+
+        with table.batch(transaction=True) as b:
+            for rk in trash_can:
+                b.delete(rk)
+        self.logger.debug("%d row keys removed" % (len(trash_can)))
+        return results
+
+
+def populate(queue, items, hosts, rounds, seed=0):
+    random = Random(seed)
+    per_round = items // rounds
+    for r in xrange(rounds):
+        links = []
+        for i in xrange(per_round):
+            host = 'host%d.com' % int(random.paretovariate(1.0) * hosts / 10 % hosts)
+            url = 'http://%s/%d/%d' % (host, r, i)
+            links.append((random.random(), sha1(url).hexdigest(), {'name': host}, url))
+        queue.schedule(links)
+        sleep(0.001)  # row keys have microsecond timestamp
+
+
+def run(queue_class, args, output):
+    queue = queue_class(Connection(), 1, logger, 'queue')
+    populate(queue, args.items, args.hosts, args.rounds)
+    collect()
+    rss_before = getrusage(RUSAGE_SELF).ru_maxrss
+    started = time()
+    dequeued = 0
+    batches = 0
+    while True:
+        results = queue.get(0, args.batch, min_hosts=args.min_hosts, max_requests_per_host=args.max_per_host)
+        if not results:
+            break
+        dequeued += len(results)
+        batches += 1
+    elapsed = time() - started
+    output.put((queue_class.__name__, dequeued, batches, elapsed, getrusage(RUSAGE_SELF).ru_maxrss - rss_before))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="HBaseQueue.get benchmark")
+    parser.add_argument('--items', type=int, default=200000, help="Items to schedule")
+    parser.add_argument('--hosts', type=int, default=2000, help="Number of distinct hosts")
+    parser.add_argument('--rounds', type=int, default=20, help="Number of schedule calls (distinct timestamps)")
+    parser.add_argument('--batch', type=int, default=256, help="min_requests for each get")
+    parser.add_argument('--min-hosts', type=int, default=24)
+    parser.add_argument('--max-per-host', type=int, default=128)
+    args = parser.parse_args()
+
+    print "%-20s %10s %8s %12s %14s" % ("implementation", "items", "batches", "items/sec", "peak mem, KB")
+    for queue_class in (LegacyHBaseQueue, HBaseQueue):
+        output = Queue()
+        process = Process(target=run, args=(queue_class, args, output))
+        process.start()
+        name, dequeued, batches, elapsed, memory = output.get()
+        process.join()
+        print "%-20s %10d %8d %12.0f %14d" % (name, dequeued, batches, dequeued / elapsed, memory)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Stage by stage benchmark of the crawling pipeline hot paths, over a synthetic web graph.
+
+Pages of breadth-first crawl of the graph are pushed through each stage in turn: encoding of page_crawled messages,
+producing them to spider log, strategy worker, DB worker consumption of spider log and scoring log, and new batches
+generation. Kafka and HBase are replaced with in-memory stand-ins. For every stage, it's throughput, latency of
+single call (one message for the spider side stages, one batch for workers) and growth of resident memory are
+reported.
+
+Usage: python -m benchmarks.stages --pages 20000 --hosts 1000 --out-degree 30
+"""
+import logging
+from argparse import ArgumentParser
+from gc import collect
+from importlib import import_module
+from os import sysconf
+from resource import getrusage, RUSAGE_SELF
+from time import time
+
+from kafka import KeyedProducer
+from kafka.common import OffsetCommitRequest
+from kafka.protocol import CODEC_SNAPPY
+
+from distributed_frontera.stubs import hbase, kafka
+from distributed_frontera.worker.main import FrontierWorker
+from distributed_frontera.worker.partitioner import FingerprintPartitioner
+from distributed_frontera.worker.score import ScoringWorker
+from distributed_frontera.worker.strategy import bfs
+
+from benchmarks.pipeline import COMMON, worker_settings, percentile
+from benchmarks.webgraph import WebGraph, make_request, make_response
+
+logging.basicConfig()
+logger = logging.getLogger("stages-benchmark")
+
+
+def rss():
+    """
+    Resident memory of current process in KB, falls back to peak resident memory where /proc isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * sysconf('SC_PAGE_SIZE') // 1024
+    except IOError:
+        return getrusage(RUSAGE_SELF).ru_maxrss
+
+
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.calls = []
+        self.elapsed = 0.0
+        self.memory = 0
+
+    def __enter__(self):
+        collect()
+        self._rss = rss()
+        self._started = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time() - self._started
+        self.memory = rss() - self._rss
+
+    def call(self, func, *args):
+        started = time()
+        result = func(*args)
+        self.calls.append(time() - started)
+        return result
+
+    def report(self):
+        calls = sorted(self.calls)
+        print "%-18s %9d %11.0f %9.3f %9.3f %9.3f %10d" % (
+            self.name, self.items, self.items / self.elapsed if self.elapsed else 0.0,
+            percentile(calls, 50) * 1000, percentile(calls, 95) * 1000, percentile(calls, 99) * 1000, self.memory)
+
+
+def log_size(topic):
+    return len(kafka.broker.topics[topic][0])
+
+
+def run(args):
+    hbase.cluster.reset()
+    kafka.broker.reset()
+    for topic in (COMMON['INCOMING_TOPIC'], COMMON['OUTGOING_TOPIC'], COMMON['SCORING_TOPIC']):
+        kafka.broker.create_topic(topic, 1)
+
+    settings = worker_settings(args)
+    graph = WebGraph(args.hosts, out_degree=args.out_degree, alpha=args.alpha, seed=args.seed)
+    seeds = graph.seeds(args.seeds)
+    # seeds message + pages is made a multiple of consumer batch size, so workers never wait for incomplete batch
+    pages = (args.pages // args.batch + 1) * args.batch - 1
+    seed_requests = map(make_request, seeds)
+    crawl = [(make_response(url), map(make_request, links)) for url, links in graph.crawl(seeds, pages)]
+    stages = []
+
+    encoder = import_module(args.codec).Encoder(None)
+    with Stage('encode') as stage:
+        messages = [(seed_requests[0].meta['fingerprint'], stage.call(encoder.encode_add_seeds, seed_requests))]
+        for response, links in crawl:
+            messages.append((response.meta['fingerprint'], stage.call(encoder.encode_page_crawled, response, links)))
+        stage.items = len(messages)
+    stages.append(stage)
+    print "pages: %d, links: %d, spider log: %d KB" % (len(crawl), sum(len(links) for _, links in crawl),
+                                                       sum(len(m) for _, m in messages) / 1024)
+    del crawl
+
+    client = kafka.KafkaClient(COMMON['KAFKA_LOCATION'])
+    producer = KeyedProducer(client, partitioner=FingerprintPartitioner, codec=CODEC_SNAPPY)
+    with Stage('spider log') as stage:
+        for key, message in messages:
+            stage.call(producer.send_messages, COMMON['INCOMING_TOPIC'], key, message)
+        stage.items = len(messages)
+    stages.append(stage)
+    del messages
+
+    scoring = ScoringWorker(settings, bfs)
+    with Stage('strategy worker') as stage:
+        while scoring._in_consumer.offsets[0] < log_size(COMMON['INCOMING_TOPIC']):
+            stage.call(scoring.work)
+        stage.items = scoring._in_consumer.offsets[0]
+    stages.append(stage)
+    scoring.backend.flush_states(is_clear=False)
+
+    db = FrontierWorker(settings, False, False, False)
+    with Stage('db incoming') as stage:
+        while db._in_consumer.offsets[0] < log_size(COMMON['INCOMING_TOPIC']):
+            stage.items += stage.call(db.consume_incoming)
+    stages.append(stage)
+    db._backend.flush()
+
+    print "scoring log: %d messages, %d KB uncompressed" % (
+        log_size(COMMON['SCORING_TOPIC']), kafka.broker.get_stats()[COMMON['SCORING_TOPIC']]['bytes'] / 1024)
+    with Stage('db scoring') as stage:
+        while db._scoring_consumer.offsets[0] < log_size(COMMON['SCORING_TOPIC']):
+            stage.items += stage.call(db.consume_scoring)
+    stages.append(stage)
+
+    with Stage('new batch') as stage:
+        for _ in xrange(args.batches):
+            count = stage.call(db.new_batch)
+            if not count:
+                break
+            stage.items += count
+            # spider consumed everything
+            client.send_offset_commit_request(COMMON['FRONTIER_GROUP'], [
+                OffsetCommitRequest(COMMON['OUTGOING_TOPIC'], 0, log_size(COMMON['OUTGOING_TOPIC']), None)])
+    stages.append(stage)
+
+    print "%-18s %9s %11s %9s %9s %9s %10s" % ("stage", "items", "items/sec", "p50, ms", "p95, ms", "p99, ms",
+                                              "mem, KB")
+    for stage in stages:
+        stage.report()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Pipeline stages benchmark")
+    parser.add_argument('--pages', type=int, default=20000, help="Crawled pages to process")
+    parser.add_argument('--hosts', type=int, default=1000, help="Number of hosts in web graph")
+    parser.add_argument('--out-degree', type=int, default=30, help="Average number of links per page")
+    parser.add_argument('--alpha', type=float, default=1.0, help="Exponent of popularity power law")
+    parser.add_argument('--seeds', type=int, default=100, help="Number of seed URLs")
+    parser.add_argument('--batch', type=int, default=256, help="Consumer batch size")
+    parser.add_argument('--batches', type=int, default=100, help="Maximum number of new batches to generate")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--codec', default='distributed_frontera.backends.remote.codecs.msgpack',
+                        help="Kafka messages codec module")
+    parser.add_argument('--frame-size', type=int, default=0, help="Kafka frame size, 0 disables framing")
+    run(parser.parse_args())
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic web graph for benchmarks.
+
+Host popularity follows Zipf's law with exponent ``alpha``, page popularity within host follows Pareto distribution,
+and a fraction of links (``local_links``) points to the same host, as it's common for real sites. Outgoing links of
+a page are derived from it's URL only, therefore graph is stable between runs and page revisits, and doesn't need to
+be kept in memory.
+"""
+from bisect import bisect
+from collections import deque
+from hashlib import sha1
+from random import Random
+from zlib import crc32
+
+from frontera.core.models import Request, Response
+from frontera.utils.fingerprint import hostname_local_fingerprint
+from frontera.utils.url import parse_domain_from_url_fast
+
+
+class WebGraph(object):
+    def __init__(self, hosts=1000, pages_per_host=100000, out_degree=30, alpha=1.0, local_links=0.5, seed=0):
+        """
+        :param int hosts: number of hosts
+        :param int pages_per_host: maximum number of pages on a host
+        :param int out_degree: average number of outgoing links per page
+        :param float alpha: exponent of host and page popularity power law
+        :param float local_links: fraction of links pointing to the same host
+        :param int seed: random seed
+        """
+        self.hosts = hosts
+        self.pages_per_host = pages_per_host
+        self.out_degree = out_degree
+        self.alpha = alpha
+        self.local_links = local_links
+        self.seed = seed
+        self._cumulative = []
+        total = 0.0
+        for rank in xrange(hosts):
+            total += 1.0 / (rank + 1) ** alpha
+            self._cumulative.append(total)
+
+    def url(self, host, page):
+        return 'http://www.host%d.com/page/%d' % (host, page)
+
+    def _parse(self, url):
+        host, page = url[len('http://www.host'):].split('.com/page/')
+        return int(host), int(page)
+
+    def _random_host(self, random):
+        return min(bisect(self._cumulative, random.random() * self._cumulative[-1]), self.hosts - 1)
+
+    def _random_page(self, random):
+        return int(random.paretovariate(self.alpha)) % self.pages_per_host
+
+    def links(self, url):
+        """
+        :return: list of URLs linked from the page
+        """
+        host, page = self._parse(url)
+        random = Random(crc32(url) ^ self.seed)
+        degree = int(random.expovariate(1.0 / self.out_degree) + 0.5) if self.out_degree else 0
+        links = []
+        for _ in xrange(degree):
+            target = host if random.random() < self.local_links else self._random_host(random)
+            links.append(self.url(target, self._random_page(random)))
+        return links
+
+    def seeds(self, count):
+        """
+        :return: front pages of ``count`` most popular hosts
+        """
+        return [self.url(host, 0) for host in xrange(min(count, self.hosts))]
+
+    def crawl(self, seeds, pages):
+        """
+        Breadth-first walk over the graph, the way frontier without any prioritization would crawl it.
+
+        :return: generator of (url, links) tuples, for ``pages`` distinct pages
+        """
+        queue = deque(seeds)
+        seen = set(seeds)
+        while queue and pages > 0:
+            url = queue.popleft()
+            links = self.links(url)
+            for link in links:
+                if link not in seen:
+                    seen.add(link)
+                    queue.append(link)
+            yield url, links
+            pages -= 1
+
+
+def make_request(url, **meta):
+    """
+    Builds a request with meta prepared the same way as spider's middlewares do: fingerprint, domain and domain
+    fingerprint.
+    """
+    netloc, name, scheme, sld, tld, subdomain = parse_domain_from_url_fast(url)
+    meta.update({
+        'fingerprint': hostname_local_fingerprint(url),
+        'domain': {
+            'netloc': netloc,
+            'name': name,
+            'scheme': scheme,
+            'sld': sld,
+            'tld': tld,
+            'subdomain': subdomain,
+            'fingerprint': sha1(name).hexdigest()
+        }
+    })
+    return Request(url, meta=meta)
+
+
+def make_response(url, job_id=0):
+    return Response(url, request=make_request(url, jid=job_id))
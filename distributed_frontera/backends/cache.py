@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+from array import array
+from math import ceil, log
+from struct import pack, unpack
+from binascii import hexlify, unhexlify
+from sys import byteorder
+
+from distributed_frontera.worker.utils import chunks
+
+
+class ClockStateCache(object):
+    """
+    Size-bounded fingerprint to state cache with CLOCK (second chance) eviction.
+
+    Every entry has a reference bit, which is set on each lookup. When the cache is full, the clock hand sweeps over
+    the slots clearing reference bits, and evicts the first entry not referenced since the previous sweep. Therefore
+    frequently seen fingerprints (e.g. popular hub links) stay resident, and only cold entries are evicted.
+
+    States are stored in a byte array, so values must be integers in range 0-255.
+    """
+
+    def __init__(self, size_limit):
+        """
+        :param int size_limit: maximum number of entries in the cache
+        """
+        if size_limit <= 0:
+            raise ValueError("Cache size limit should be positive.")
+        self._size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self._index = {}
+        self._keys = []
+        self._values = bytearray()
+        self._refs = bytearray()
+        self._hand = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key, default=None):
+        """
+        Returns the state and marks entry as referenced, updating hit/miss counters.
+        """
+        slot = self._index.get(key)
+        if slot is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._refs[slot] = 1
+        return self._values[slot]
+
+    def peek(self, key, default=None):
+        """
+        Returns the state without affecting eviction order and counters.
+        """
+        slot = self._index.get(key)
+        return default if slot is None else self._values[slot]
+
+    def __setitem__(self, key, value):
+        slot = self._index.get(key)
+        if slot is not None:
+            self._values[slot] = value
+            self._refs[slot] = 1
+            return
+
+        if len(self._keys) < self._size_limit:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._values.append(value)
+            self._refs.append(0)
+            return
+
+        slot = self._evict()
+        self._index[key] = slot
+        self._keys[slot] = key
+        self._values[slot] = value
+        self._refs[slot] = 0
+
+    def _evict(self):
+        refs = self._refs
+        hand = self._hand
+        while refs[hand]:
+            refs[hand] = 0
+            hand = (hand + 1) % self._size_limit
+        self._hand = (hand + 1) % self._size_limit
+
+        key = self._keys[hand]
+        del self._index[key]
+        self.evictions += 1
+        return hand
+
+    def dump(self, f):
+        """
+        Writes entries to file object, as 20 bytes binary fingerprint followed by state byte.
+        """
+        values = self._values
+        for chunk in chunks(self._index.items(), 65536):
+            f.write(''.join([unhexlify(key) + chr(values[slot]) for key, slot in chunk]))
+
+    def load(self, buf, offset=0):
+        """
+        Adds entries from buffer (string or mmap) written by :meth:`dump`, starting at ``offset``.
+        """
+        end = len(buf) - (len(buf) - offset) % 21
+        for i in xrange(offset, end, 21):
+            self[hexlify(buf[i:i+20])] = ord(buf[i+20])
+
+    def get_stats(self):
+        return {
+            'size': len(self._index),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class CompactStateCache(object):
+    """
+    Memory efficient fingerprint to state cache, with the same interface and eviction policy as
+    :class:`ClockStateCache`.
+
+    Instead of dict with hex string keys, it's an open addressing (linear probing) hash table, backed by arrays. Every
+    fingerprint is reduced to it's last 64 bits (the first bytes of ``hostname_local_fingerprint`` are host Crc32,
+    and therefore poorly distributed), stored as two 32-bit halves, along with one byte for state and one byte for
+    CLOCK reference bit. That is about 13 bytes per entry, at maximal load factor 0.75.
+
+    The price is that two fingerprints with same last 64 bits are indistinguishable, and the cache can't enumerate
+    fingerprints it holds.
+    """
+
+    MAX_LOAD_FACTOR = 0.75
+
+    def __init__(self, size_limit):
+        """
+        :param int size_limit: maximum number of entries in the cache
+        """
+        if size_limit <= 0:
+            raise ValueError("Cache size limit should be positive.")
+        self._size_limit = size_limit
+        capacity = 8
+        while capacity * self.MAX_LOAD_FACTOR < size_limit:
+            capacity *= 2
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self._hi = array('I', [0]) * self._capacity
+        self._lo = array('I', [0]) * self._capacity
+        # state + 1, zero marks an empty slot
+        self._values = bytearray(self._capacity)
+        self._refs = bytearray(self._capacity)
+        self._size = 0
+        self._hand = 0
+
+    def __len__(self):
+        return self._size
+
+    def _find(self, key):
+        hi, lo = int(key[-16:-8], 16), int(key[-8:], 16)
+        slot, found = self._lookup(hi, lo)
+        return slot, found, hi, lo
+
+    def _lookup(self, hi, lo):
+        i = lo & self._mask
+        values, his, los = self._values, self._hi, self._lo
+        while values[i]:
+            if los[i] == lo and his[i] == hi:
+                return i, True
+            i = (i + 1) & self._mask
+        return i, False
+
+    def __contains__(self, key):
+        return self._find(key)[1]
+
+    def get(self, key, default=None):
+        slot, found, _, _ = self._find(key)
+        if not found:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._refs[slot] = 1
+        return self._values[slot] - 1
+
+    def peek(self, key, default=None):
+        slot, found, _, _ = self._find(key)
+        return self._values[slot] - 1 if found else default
+
+    def __setitem__(self, key, value):
+        slot, found, hi, lo = self._find(key)
+        if found:
+            self._values[slot] = value + 1
+            self._refs[slot] = 1
+            return
+        self._insert(slot, hi, lo, value)
+
+    def _insert(self, slot, hi, lo, value):
+        if self._size >= self._size_limit:
+            self._evict()
+            slot, _ = self._lookup(hi, lo)
+        self._hi[slot] = hi
+        self._lo[slot] = lo
+        self._values[slot] = value + 1
+        self._refs[slot] = 0
+        self._size += 1
+
+    def _evict(self):
+        values, refs, mask = self._values, self._refs, self._mask
+        hand = self._hand
+        while not values[hand] or refs[hand]:
+            refs[hand] = 0
+            hand = (hand + 1) & mask
+        self._hand = (hand + 1) & mask
+        self._delete(hand)
+        self.evictions += 1
+
+    def dump(self, f):
+        """
+        Writes the table to file object as is: capacity, then key halves arrays and states. Everything is big-endian,
+        so dump can be loaded on host with different byte order.
+        """
+        f.write(pack('>I', self._capacity))
+        for keys in (self._hi, self._lo):
+            if byteorder == 'little':
+                keys = array('I', keys)
+                keys.byteswap()
+            f.write(keys.tostring())
+        f.write(self._values)
+
+    def load(self, buf, offset=0):
+        """
+        Adds entries from buffer (string or mmap) written by :meth:`dump`, starting at ``offset``. If the table is
+        empty and of the same capacity, arrays are copied without rehashing.
+        """
+        capacity = unpack('>I', buf[offset:offset + 4])[0]
+        his, los = array('I'), array('I')
+        if len(buf) - offset - 4 < capacity * (his.itemsize + los.itemsize + 1):
+            raise ValueError("Truncated cache dump.")
+        his.fromstring(buf[offset + 4:offset + 4 + capacity * his.itemsize])
+        offset += 4 + capacity * his.itemsize
+        los.fromstring(buf[offset:offset + capacity * los.itemsize])
+        if byteorder == 'little':
+            his.byteswap()
+            los.byteswap()
+        values = bytearray(buf[offset + capacity * los.itemsize:offset + capacity * (los.itemsize + 1)])
+        size = capacity - values.count('\x00')
+        if capacity == self._capacity and not self._size and size <= self._size_limit:
+            self._hi, self._lo, self._values = his, los, values
+            self._size = size
+            return
+        for i in xrange(capacity):
+            if not values[i]:
+                continue
+            slot, found = self._lookup(his[i], los[i])
+            if found:
+                self._values[slot] = values[i]
+            else:
+                self._insert(slot, his[i], los[i], values[i] - 1)
+
+    def _delete(self, slot):
+        """
+        Backward shift deletion, keeps probe sequences unbroken without tombstones.
+        """
+        values, refs, his, los, mask = self._values, self._refs, self._hi, self._lo, self._mask
+        i = j = slot
+        while True:
+            j = (j + 1) & mask
+            if not values[j]:
+                break
+            home = los[j] & mask
+            if (i < j and i < home <= j) or (i > j and (home > i or home <= j)):
+                continue
+            his[i], los[i], values[i], refs[i] = his[j], los[j], values[j], refs[j]
+            i = j
+        values[i] = 0
+        refs[i] = 0
+        self._size -= 1
+
+    def get_stats(self):
+        return {
+            'size': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class FingerprintBloomFilter(object):
+    """
+    Bloom filter of fingerprints, answers whatever fingerprint was definitely never seen.
+
+    Fingerprints are already uniformly distributed hashes, so bit positions are derived from the last 64 bits of
+    fingerprint using double hashing, without computing any extra hash functions.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        :param int capacity: expected number of fingerprints
+        :param float error_rate: false positive rate, when filter contains ``capacity`` fingerprints
+        """
+        if capacity <= 0 or not 0.0 < error_rate < 1.0:
+            raise ValueError("Capacity should be positive and error rate in (0, 1) range.")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._size = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self._hashes = max(1, int(round(float(self._size) / capacity * log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, fingerprint):
+        h1, h2 = int(fingerprint[-8:], 16), int(fingerprint[-16:-8], 16) | 1
+        size = self._size
+        return [(h1 + i * h2) % size for i in xrange(self._hashes)]
+
+    def add(self, fingerprint):
+        bits = self._bits
+        added = False
+        for pos in self._positions(fingerprint):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def dump(self, f):
+        """
+        Writes capacity, error rate, count and bits to file object.
+        """
+        f.write(pack('>QdQ', self.capacity, self.error_rate, self.count))
+        f.write(self._bits)
+
+    def load(self, buf, offset=0):
+        """
+        Replaces bits and count with the ones from buffer (string or mmap) written by :meth:`dump`, starting at
+        ``offset``.
+
+        :return: bool, False if the dump is of a filter with different capacity or error rate, and wasn't loaded
+        """
+        capacity, error_rate, count = unpack('>QdQ', buf[offset:offset + 24])
+        if (capacity, error_rate) != (self.capacity, self.error_rate):
+            return False
+        offset += 24
+        if len(buf) - offset < len(self._bits):
+            raise ValueError("Truncated filter dump.")
+        self._bits = bytearray(buf[offset:offset + len(self._bits)])
+        self.count = count
+        return True
+
+    def __contains__(self, fingerprint):
+        bits = self._bits
+        for pos in self._positions(fingerprint):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
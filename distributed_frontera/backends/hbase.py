@@ -1,18 +1,27 @@
 # -*- coding: utf-8 -*-
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from, calcsize, error as struct_error
 from datetime import datetime
 from calendar import timegm
-from time import time
+from time import time, sleep
 from binascii import hexlify, unhexlify
 from zlib import crc32
 from io import BytesIO
 from random import choice
+from os import rename
+from os.path import exists
+from mmap import mmap, ACCESS_READ
+from itertools import imap
+from collections import deque
+from Queue import Queue
+from threading import Thread, Lock, Event
+from multiprocessing.pool import ThreadPool
 
-from happybase import Connection
 from frontera.utils.url import parse_domain_from_url_fast
-from msgpack import Unpacker, Packer
+from frontera.utils.misc import load_object
+from msgpack import Unpacker, Packer, unpackb
 
 from frontera import Backend
+from distributed_frontera.backends.cache import ClockStateCache, FingerprintBloomFilter
 from distributed_frontera.worker.partitioner import Crc32NamePartitioner
 from distributed_frontera.worker.utils import chunks
 
@@ -70,17 +79,32 @@ def utcnow_timestamp():
     d = datetime.utcnow()
     return timegm(d.timetuple())
 
+def get_crc32(name):
+    return crc32(name) if type(name) is str else crc32(name.encode('utf-8', 'ignore'))
+
+def get_interval(score, resolution):
+    if score < 0.0 or score > 1.0:
+        raise OverflowError
+
+    i = int(score / resolution)
+    if i % 10 == 0 and i > 0:
+        i = i-1  # last interval is inclusive from right
+    return (i * resolution, (i+1) * resolution)
+
 
 class HBaseQueue(object):
 
-    GET_RETRIES = 1
+    GET_RETRIES = 5
 
-    def __init__(self, connection, partitions, logger, table_name, drop=False):
+    def __init__(self, connection, partitions, logger, table_name, drop=False, get_time_budget=10.0):
         self.connection = connection
         self.partitions = [i for i in range(0, partitions)]
         self.partitioner = Crc32NamePartitioner(self.partitions)
         self.logger = logger
         self.table_name = table_name
+        self.get_time_budget = get_time_budget
+        # partition id -> (hosts per row, items per row), observed in previous scans
+        self._density = {}
 
         tables = set(self.connection.tables())
         if drop and self.table_name in tables:
@@ -109,29 +133,10 @@ class HBaseQueue(object):
         :param links:
         :return:
         """
-        def get_crc32(name):
-            return crc32(name) if type(name) is str else crc32(name.encode('utf-8', 'ignore'))
-
-        def get_interval(score, resolution):
-            if score < 0.0 or score > 1.0:
-                raise OverflowError
-
-            i = int(score / resolution)
-            if i % 10 == 0 and i > 0:
-                i = i-1  # last interval is inclusive from right
-            return (i * resolution, (i+1) * resolution)
-
         timestamp = int(time() * 1E+6)
         data = dict()
         for score, fingerprint, domain, url in links:
-            if type(domain) == dict:
-                partition_id = self.partitioner.partition(domain['name'], self.partitions)
-                host_crc32 = get_crc32(domain['name'])
-            elif type(domain) == int:
-                partition_id = self.partitioner.partition_by_hash(domain, self.partitions)
-                host_crc32 = domain
-            else:
-                raise TypeError("domain of unknown type.")
+            partition_id, host_crc32 = self._get_partition(domain)
             item = [unhexlify(fingerprint), host_crc32, url, score]
             score = 1 - score  # because of lexicographical sort in HBase
             rk = "%d_%s_%d" %(partition_id, "%0.2f_%0.2f" % get_interval(score, 0.01), timestamp)
@@ -153,130 +158,647 @@ class HBaseQueue(object):
                     final[column] = stream.getvalue()
                 b.put(rk, final)
 
-    def get(self, partition_id, min_requests, min_hosts=None, max_requests_per_host=None):
-        table = self.connection.table(self.table_name)
+    def _get_partition(self, domain):
+        """
+        :return: tuple of partition id and host Crc32
+        """
+        if type(domain) == dict:
+            return self.partitioner.partition(domain['name'], self.partitions), get_crc32(domain['name'])
+        if type(domain) == int:
+            return self.partitioner.partition_by_hash(domain, self.partitions), domain
+        raise TypeError("domain of unknown type.")
+
+    def _estimate_limit(self, partition_id, min_requests, min_hosts):
+        """
+        Estimates number of rows to scan to get min_requests from min_hosts, using density observed in previous scans
+        of the partition.
+        """
+        if partition_id not in self._density:
+            return int(min_requests)
+        hosts_per_row, items_per_row = self._density[partition_id]
+        rows = float(min_requests) / max(items_per_row, 0.01)
+        if min_hosts is not None:
+            rows = max(rows, float(min_hosts) / max(hosts_per_row, 0.01))
+        return int(rows * 1.2) + 1
+
+    def _update_density(self, partition_id, rows, hosts, items):
+        if not rows:
+            return
+        density = (float(hosts) / rows, float(items) / rows)
+        if partition_id in self._density:
+            previous = self._density[partition_id]
+            density = ((previous[0] + density[0]) / 2, (previous[1] + density[1]) / 2)
+        self._density[partition_id] = density
+
+    def _should_retry(self, tries, started, rows, limit):
+        if rows < limit:
+            return False  # partition is exhausted
+        return tries < self.GET_RETRIES and time() - started < self.get_time_budget
+
+    def get(self, partition_id, min_requests, min_hosts=None, max_requests_per_host=None, connection=None):
+        """
+        Scans partition rows in a single pass, until at least min_requests from min_hosts are collected. Items are
+        taken while they fit into max_requests_per_host, rows with all items taken are removed, and the rest are
+        written back with items left.
+
+        Partitions can be read concurrently, each one with it's own connection passed in ``connection``.
+        """
+        table = (connection or self.connection).table(self.table_name)
+        hosts = {}
+        results = {}
+        trash_can = []
+        leftovers = {}
 
-        meta_map = {}
-        queue = {}
-        limit = min_requests
+        def is_enough():
+            return len(results) >= min_requests and (min_hosts is None or len(hosts) >= min_hosts)
+
+        row_start, row_stop = '%d_' % partition_id, '%d`' % partition_id
+        limit = self._estimate_limit(partition_id, min_requests, min_hosts)
         tries = 0
-        count = 0
-        while tries < self.GET_RETRIES:
+        rows = 0
+        items = 0
+        started = time()
+        while True:
             tries += 1
-            limit *= 5.5 if tries > 1 else 1.0
-            self.logger.debug("Try %d, limit %d, last attempt: requests %d, hosts %d" % (tries, limit, count, len(queue.keys())))
-            meta_map.clear()
-            queue.clear()
-            for rk, data in table.scan(row_prefix='%d_' % partition_id, limit=int(limit), batch_size=256):
-                for cq, buf in data.iteritems():
-                    stream = BytesIO(buf)
-                    unpacker = Unpacker(stream)
-                    for item in unpacker:
+            scanned = 0
+            for rk, data in table.scan(row_start=row_start, row_stop=row_stop, limit=limit, batch_size=256):
+                scanned += 1
+                row_start = rk + '\x00'
+                taken = False
+                left = {}
+                for column, buf in data.iteritems():
+                    for item in Unpacker(BytesIO(buf)):
+                        items += 1
                         fingerprint, host_crc32, url, score = item
-                        if host_crc32 not in queue:
-                            queue[host_crc32] = []
-                        if max_requests_per_host is not None and len(queue[host_crc32]) > max_requests_per_host:
-                            continue
-                        queue[host_crc32].append(fingerprint)
+                        if fingerprint not in results:
+                            host_requests = hosts.get(host_crc32, 0)
+                            if max_requests_per_host is not None and host_requests >= max_requests_per_host:
+                                left.setdefault(column, []).append(item)
+                                continue
+                            hosts[host_crc32] = host_requests + 1
+                            results[fingerprint] = (url, score)
+                        taken = True
+                if taken:
+                    if left:
+                        leftovers[rk] = (left, [column for column in data if column not in left])
+                    else:
+                        trash_can.append(rk)
+                    if is_enough():
+                        break
+            rows += scanned
+            self.logger.debug("Try %d, limit %d, rows %d, requests %d, hosts %d" % (tries, limit, scanned,
+                                                                                  len(results), len(hosts)))
+            if is_enough() or not self._should_retry(tries, started, scanned, limit):
+                break
+            limit = max(limit * 2, self._estimate_limit(partition_id, min_requests - len(results),
+                                                        min_hosts - len(hosts) if min_hosts else None))
+        self._update_density(partition_id, rows, len(hosts), items)
+        self.logger.debug("Tries %d, hosts %d, requests %d" % (tries, len(hosts), len(results)))
 
-                        if fingerprint not in meta_map:
-                            meta_map[fingerprint] = []
-                        meta_map[fingerprint].append((rk, item))
+        with table.batch(transaction=True) as b:
+            for rk in trash_can:
+                b.delete(rk)
+            packer = Packer()
+            for rk, (left, emptied) in leftovers.iteritems():
+                if emptied:
+                    b.delete(rk, columns=emptied)
+                b.put(rk, dict((column, ''.join(packer.pack(item) for item in column_items))
+                               for column, column_items in left.iteritems()))
+        self.logger.debug("%d row keys removed, %d rewritten" % (len(trash_can), len(leftovers)))
+        return [(hexlify(fingerprint), url, score) for fingerprint, (url, score) in results.iteritems()]
 
-            count = 0
-            for host_id, fprints in queue.iteritems():
-                count += len(fprints)
+    def rebuild(self, table_name):
+        pass
 
-            if min_hosts is not None and len(queue.keys()) < min_hosts:
-                continue
 
-            if count < min_requests:
+class HBaseCellQueue(HBaseQueue):
+    """
+    Priority queue with one cell per item, instead of one cell per score interval.
+
+    Row keys are the same as in :class:`HBaseQueue`, column qualifier is a score interval of 0.001 width followed by
+    binary fingerprint, and value is the packed item. This allows get to delete exactly the cells it returns and leave
+    the rest of the row in place, so batch sizes are predictable and per host limits are respected. The layout isn't
+    compatible with :class:`HBaseQueue`, therefore it needs a separate (or rebuilt) queue table.
+    """
+
+    def schedule(self, links):
+        timestamp = int(time() * 1E+6)
+        table = self.connection.table(self.table_name)
+        packer = Packer()
+        with table.batch(transaction=True) as b:
+            for score, fingerprint, domain, url in links:
+                partition_id, host_crc32 = self._get_partition(domain)
+                binary_fprint = unhexlify(fingerprint)
+                item = [binary_fprint, host_crc32, url, score]
+                score = 1 - score  # because of lexicographical sort in HBase
+                rk = "%d_%s_%d" % (partition_id, "%0.2f_%0.2f" % get_interval(score, 0.01), timestamp)
+                column = 'f:%0.3f_%0.3f_' % get_interval(score, 0.001) + binary_fprint
+                b.put(rk, {column: packer.pack(item)})
+
+    def get(self, partition_id, min_requests, min_hosts=None, max_requests_per_host=None, connection=None):
+        """
+        Items are taken in score order, but no more than min_requests / min_hosts per host at first, rest of the
+        items within max_requests_per_host are set aside, and used only if there isn't enough hosts in the scanned
+        rows.
+        """
+        table = (connection or self.connection).table(self.table_name)
+        host_quota = max_requests_per_host
+        if min_hosts:
+            host_quota = -(-min_requests // min_hosts)
+            if max_requests_per_host is not None:
+                host_quota = min(host_quota, max_requests_per_host)
+        hosts = {}
+        fingerprints = set()
+        results = []
+        spare = []
+        trash_can = {}
+
+        def take(rk, cq, item):
+            fingerprint, host_crc32, url, score = item
+            trash_can.setdefault(rk, []).append(cq)
+            if fingerprint in fingerprints:
+                return
+            fingerprints.add(fingerprint)
+            hosts[host_crc32] = hosts.get(host_crc32, 0) + 1
+            results.append((hexlify(fingerprint), url, score))
+
+        row_start, row_stop = '%d_' % partition_id, '%d`' % partition_id
+        limit = self._estimate_limit(partition_id, min_requests, min_hosts)
+        tries = 0
+        rows = 0
+        items = 0
+        started = time()
+        while len(results) < min_requests:
+            tries += 1
+            scanned = 0
+            for rk, data in table.scan(row_start=row_start, row_stop=row_stop, limit=limit, batch_size=256):
+                scanned += 1
+                row_start = rk + '\x00'
+                for cq in sorted(data.iterkeys()):
+                    items += 1
+                    item = unpackb(data[cq])
+                    host_requests = hosts.get(item[1], 0)
+                    if host_quota is not None and host_requests >= host_quota:
+                        if max_requests_per_host is None or host_requests < max_requests_per_host:
+                            spare.append((rk, cq, item))
+                        continue
+                    take(rk, cq, item)
+                    if len(results) >= min_requests:
+                        break
+                if len(results) >= min_requests:
+                    break
+            rows += scanned
+            self.logger.debug("Try %d, limit %d, rows %d, requests %d, hosts %d" % (tries, limit, scanned,
+                                                                                  len(results), len(hosts)))
+            if len(results) >= min_requests or not self._should_retry(tries, started, scanned, limit):
+                break
+            limit = max(limit * 2, self._estimate_limit(partition_id, min_requests - len(results), None))
+        self._update_density(partition_id, rows, len(hosts), items)
+
+        for rk, cq, item in spare:
+            if len(results) >= min_requests:
+                break
+            if max_requests_per_host is not None and hosts.get(item[1], 0) >= max_requests_per_host:
                 continue
-            break
-
-        self.logger.debug("Tries %d, hosts %d, requests %d" % (tries, len(queue.keys()), count))
-
-        # For every fingerprint collect it's row keys and return all fingerprints from them
-        fprint_map = {}
-        for fprint, meta_list in meta_map.iteritems():
-            for rk, _ in meta_list:
-                fprint_map.setdefault(rk, []).append(fprint)
-
-        results = set()
-        trash_can = set()
-        for _, fprints in queue.iteritems():
-            for fprint in fprints:
-                for rk, _ in meta_map[fprint]:
-                    trash_can.add(rk)
-                    for rk_fprint in fprint_map[rk]:
-                        _, item = meta_map[rk_fprint][0]
-                        _, _, url, score = item
-                        results.add((hexlify(rk_fprint), url, score))
+            take(rk, cq, item)
+        self.logger.debug("Tries %d, hosts %d, requests %d" % (tries, len(hosts), len(results)))
 
         with table.batch(transaction=True) as b:
-            for rk in trash_can:
-                b.delete(rk)
-        self.logger.debug("%d row keys removed" % (len(trash_can)))
+            for rk, columns in trash_can.iteritems():
+                b.delete(rk, columns=columns)
+        self.logger.debug("%d cells removed" % sum(map(len, trash_can.itervalues())))
         return results
 
-    def rebuild(self, table_name):
-        pass
+
+class StateFlusher(Thread):
+    """
+    Background writer of states to HBase, using it's own connection.
+
+    States are submitted in chunks to a bounded queue, when queue is full, submitting thread is blocked until some
+    chunk is written. Submitted, but not yet written states are available through :meth:`get`.
+
+    Chunk which couldn't be written after WRITE_RETRIES tries is kept, with it's states still available through
+    :meth:`get`, and submitted again with the next :meth:`submit`. :meth:`wait` and :meth:`close` raise IOError, if
+    there are such chunks, so states are never lost silently.
+    """
+
+    WRITE_RETRIES = 3
+    RETRY_BACKOFF = 1.0
+
+    def __init__(self, connection, table_name, logger, queue_size, chunk_size=32768):
+        super(StateFlusher, self).__init__(name="state-flusher")
+        self.daemon = True
+        self.connection = connection
+        self._table_name = table_name
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self._queue = Queue(maxsize=queue_size)
+        self._pending = {}
+        self._failed = []
+        self._lock = Lock()
+
+    def submit(self, states):
+        """
+        :param dict states: fingerprint to state map
+        """
+        with self._lock:
+            self._pending.update(states)
+            failed, self._failed = self._failed, []
+        for chunk in failed:
+            self._queue.put(chunk)
+        for chunk in chunks(states.items(), self.chunk_size):
+            self._queue.put(chunk)
+
+    def get(self, fingerprint):
+        with self._lock:
+            return self._pending.get(fingerprint)
+
+    def run(self):
+        table = self.connection.table(self._table_name)
+        while True:
+            chunk = self._queue.get()
+            try:
+                if chunk is None:
+                    return
+                written = self._write(table, chunk)
+                with self._lock:
+                    if not written:
+                        self._failed.append(chunk)
+                        continue
+                    for fprint, state in chunk:
+                        if self._pending.get(fprint) == state:
+                            del self._pending[fprint]
+            finally:
+                self._queue.task_done()
+
+    def _write(self, table, chunk):
+        """
+        :return: bool, True if chunk was written
+        """
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                with table.batch(transaction=True) as b:
+                    for fprint, state in chunk:
+                        b.put(unhexlify(fprint), prepare_hbase_object(state=state))
+                return True
+            except Exception, e:
+                if tries == self.WRITE_RETRIES:
+                    self.logger.error("Write of %d states failed, keeping them for next flush: %s" % (len(chunk), e))
+                    return False
+                self.logger.warning("States write failed, try %d/%d: %s" % (tries, self.WRITE_RETRIES, e))
+                sleep(self.RETRY_BACKOFF * 2 ** (tries - 1))
+
+    def _check_failed(self):
+        with self._lock:
+            failed = sum(map(len, self._failed))
+        if failed:
+            raise IOError("%d states weren't written to HBase" % failed)
+
+    def wait(self):
+        """
+        Blocks until all submitted states are written, or failed to be written.
+
+        :raises IOError: if some states weren't written
+        """
+        self._queue.join()
+        self._check_failed()
+
+    def close(self):
+        """
+        Writes the states left, submitting failed chunks once again, and stops the thread.
+
+        :raises IOError: if some states weren't written
+        """
+        self.submit({})
+        self._queue.put(None)
+        self.join()
+        self.connection.close()
+        self._check_failed()
+
+    def get_stats(self):
+        return {
+            'flush_queue_depth': self._queue.qsize(),
+            'flush_pending': len(self._pending),
+            'flush_failed': sum(map(len, self._failed))
+        }
 
 
 class HBaseState(object):
 
-    def __init__(self, connection, table_name, logger, cache_size_limit):
+    SNAPSHOT_PREFIX = '>4sBqB'
+    SNAPSHOT_VERSION = 4
+
+    def __init__(self, connection, table_name, logger, cache_size_limit, cache_class=ClockStateCache,
+                 known_filter=None, fetch_connections=None, flusher=None, filter_connection=None,
+                 filter_refresh_interval=600.0):
+        """
+        :param known_filter: optional :class:`FingerprintBloomFilter`, used to skip reads of never seen fingerprints
+        once it's rebuilt with :meth:`start_filter_rebuild`
+        :param fetch_connections: optional list of connections, if given, states are fetched in parallel over all
+        of them, instead of sequentially over the main connection
+        :param flusher: optional :class:`StateFlusher`, if given, changed states are written to HBase in background
+        as soon as they accumulate in a chunk, and flush doesn't block
+        :param filter_connection: connection used to rebuild the filter in background, if not given, the filter is
+        rebuilt synchronously over the main connection
+        :param float filter_refresh_interval: time in seconds, the filter is used for after the start of it's rebuild,
+        it's rebuilt again every half of it
+        """
         self.connection = connection
+        self._fetch_connections = fetch_connections or [connection]
+        self._free_connections = Queue()
+        for fetch_connection in self._fetch_connections:
+            self._free_connections.put(fetch_connection)
+        self._fetch_pool = ThreadPool(len(self._fetch_connections)) if fetch_connections else None
         self._table_name = table_name
         self.logger = logger
-        self._state_cache = {}
-        self._cache_size_limit = cache_size_limit
+        self._dirty = {}
+        self._state_cache = cache_class(cache_size_limit)
+        self._known = known_filter
+        # start time of the scan the filter was built from, filter doesn't know fingerprints written by other
+        # strategy workers since then
+        self._known_time = None
+        self._filter_connection = filter_connection
+        self._filter_refresh_interval = filter_refresh_interval
+        self._rebuild_thread = None
+        self._rebuild_time = None
+        self._rebuild_stop = Event()
+        self._rebuilt = None
+        self._added = []
+        self._flusher = flusher
+        if flusher:
+            flusher.start()
+        self._avoided_reads = 0
+
+    def start_filter_rebuild(self):
+        """
+        Starts filling the filter of known fingerprints with every fingerprint having state in metadata table, in a
+        background thread. Until it's finished, all missing states are read from HBase. Without a dedicated filter
+        connection, the filter is rebuilt before returning.
+
+        Other strategy workers write states of the links they extract, and the filter learns only states written by
+        this one, so after the first rebuild the filter is rebuilt every half of refresh interval, and reads are
+        skipped only while it's younger than refresh interval. States written by other workers during the refresh
+        interval before a fetch may still be missed.
+        """
+        if self._known is None or self._rebuild_thread is not None:
+            return
+        self._rebuilt = FingerprintBloomFilter(self._known.capacity, self._known.error_rate)
+        self._rebuild_time = time()
+        if self._filter_connection is None:
+            self._rebuild_filter(self.connection)
+            self._finish_filter_rebuild()
+            return
+        self._rebuild_thread = Thread(target=self._rebuild_filter, args=(self._filter_connection,),
+                                      name="filter-rebuild")
+        self._rebuild_thread.daemon = True
+        self._rebuild_thread.start()
+
+    def _rebuild_filter(self, connection):
+        # fingerprints are added to a new filter, because the current one is updated by the worker at the same time,
+        # fingerprints added meanwhile are remembered, and added to the new filter once it's rebuilt
+        self.logger.info("Rebuilding filter of known fingerprints")
+        try:
+            table = connection.table(self._table_name)
+            for key, _ in table.scan(columns=['s:state'], batch_size=65536):
+                if self._rebuild_stop.is_set():
+                    self._rebuilt = None
+                    return
+                self._rebuilt.add(hexlify(key))
+        except Exception, e:
+            self.logger.error("Filter rebuild failed, states of all fingerprints will be read: %s" % e)
+            self._rebuilt = None
+            return
+        self.logger.info("Filter rebuilt, %d fingerprints" % self._rebuilt.count)
+
+    def _check_filter_rebuild(self):
+        if self._rebuild_thread is None or self._rebuild_thread.is_alive():
+            return
+        self._rebuild_thread = None
+        self._finish_filter_rebuild()
+
+    def _finish_filter_rebuild(self):
+        added, self._added = self._added, []
+        if self._rebuilt is None:
+            return
+        for fprint in added:
+            self._rebuilt.add(fprint)
+        self._known, self._rebuilt = self._rebuilt, None
+        self._known_time = self._rebuild_time
+        if self._known.count > self._known.capacity:
+            self.logger.warning("Filter of known fingerprints is over capacity (%d > %d), false positive rate "
+                                "is higher than configured" % (self._known.count, self._known.capacity))
+
+    def _is_filter_fresh(self):
+        return self._known_time is not None and time() - self._known_time < self._filter_refresh_interval
+
+    def _refresh_filter(self):
+        if self._rebuild_time is not None and time() - self._rebuild_time >= self._filter_refresh_interval / 2:
+            self.start_filter_rebuild()
 
     def update(self, objs, persist):
         objs = objs if type(objs) in [list, tuple] else [objs]
         if persist:
             def put(obj):
-                if obj.meta['state'] is not None:
-                    self._state_cache[obj.meta['fingerprint']] = obj.meta['state']
+                fprint, state = obj.meta['fingerprint'], obj.meta['state']
+                if state is not None and self._state_cache.peek(fprint) != state:
+                    self._state_cache[fprint] = state
+                    self._dirty[fprint] = state
+                    if self._known is not None:
+                        self._known.add(fprint)
+                        if self._rebuild_thread is not None:
+                            self._added.append(fprint)
             map(put, objs)
+            if self._flusher and len(self._dirty) >= self._flusher.chunk_size:
+                self._submit()
             return
 
         def get(obj):
-            fprint = obj.meta['fingerprint']
-            obj.meta['state'] = self._state_cache[fprint] if fprint in self._state_cache else None
+            obj.meta['state'] = self._state_cache.peek(obj.meta['fingerprint'])
         map(get, objs)
 
+    def _submit(self):
+        self._flusher.submit(self._dirty)
+        self._dirty = {}
+
     def flush(self, force_clear):
-        if len(self._state_cache) > self._cache_size_limit:
-            force_clear = True
-        table = self.connection.table(self._table_name)
-        for chunk in chunks(self._state_cache.items(), 32768):
-            with table.batch(transaction=True) as b:
-                for fprint, state in chunk:
-                    hb_obj = prepare_hbase_object(state=state)
-                    b.put(unhexlify(fprint), hb_obj)
+        self.logger.debug("Flushing %d changed states" % len(self._dirty))
+        if self._flusher:
+            self._submit()
+        else:
+            table = self.connection.table(self._table_name)
+            for chunk in chunks(self._dirty.items(), 32768):
+                with table.batch(transaction=True) as b:
+                    for fprint, state in chunk:
+                        hb_obj = prepare_hbase_object(state=state)
+                        b.put(unhexlify(fprint), hb_obj)
+            self._dirty.clear()
+        self.logger.debug("States stats %s" % str(self.get_stats()))
         if force_clear:
             self.logger.debug("Cache has %d items, clearing" % len(self._state_cache))
             self._state_cache.clear()
 
     def fetch(self, fingerprints):
-        to_fetch = [f for f in fingerprints if f not in self._state_cache]
+        self._check_filter_rebuild()
+        self._refresh_filter()
+        skip_unknown = self._is_filter_fresh()
+        to_fetch = []
+        for fprint in fingerprints:
+            if self._state_cache.get(fprint) is not None:
+                continue
+            if fprint in self._dirty:
+                # evicted, but not flushed yet, so HBase has stale state
+                self._state_cache[fprint] = self._dirty[fprint]
+                continue
+            if self._flusher:
+                state = self._flusher.get(fprint)
+                if state is not None:
+                    self._state_cache[fprint] = state
+                    continue
+            if skip_unknown and fprint not in self._known:
+                # never seen, so there is no state in HBase
+                self._avoided_reads += 1
+                continue
+            to_fetch.append(fprint)
         self.logger.debug("cache size %s" % len(self._state_cache))
         self.logger.debug("to fetch %d from %d" % (len(to_fetch), len(fingerprints)))
-        for chunk in chunks(to_fetch, 65536):
-            keys = [unhexlify(fprint) for fprint in chunk]
-            table = self.connection.table(self._table_name)
-            records = table.rows(keys, columns=['s:state'])
-            for key, cells in records:
-                if 's:state' in cells:
-                    state = unpack('>B', cells['s:state'])[0]
-                    self._state_cache[hexlify(key)] = state
+        if not to_fetch:
+            return
+        chunk_size = min(65536, -(-len(to_fetch) // len(self._fetch_connections)))
+        if self._fetch_pool:
+            results = self._fetch_pool.imap_unordered(self._fetch_chunk, chunks(to_fetch, chunk_size))
+        else:
+            results = imap(self._fetch_chunk, chunks(to_fetch, chunk_size))
+        for states in results:
+            for fprint, state in states:
+                self._state_cache[fprint] = state
+
+    def _fetch_chunk(self, chunk):
+        connection = self._free_connections.get()
+        try:
+            table = connection.table(self._table_name)
+            records = table.rows([unhexlify(fprint) for fprint in chunk], columns=['s:state'])
+            return [(hexlify(key), unpack('>B', cells['s:state'])[0]) for key, cells in records
+                    if 's:state' in cells]
+        finally:
+            self._free_connections.put(connection)
+
+    def close(self):
+        try:
+            self.flush(False)
+            if self._flusher:
+                self._flusher.close()
+        finally:
+            if self._rebuild_thread is not None:
+                self._rebuild_stop.set()
+                self._rebuild_thread.join()
+            if self._filter_connection:
+                self._filter_connection.close()
+            if self._fetch_pool:
+                self._fetch_pool.close()
+                self._fetch_pool.join()
+                for connection in self._fetch_connections:
+                    connection.close()
+
+    def snapshot(self, path, offset):
+        """
+        Flushes changed states and writes the cache to a local file, marked with spider log offset. The file is
+        replaced atomically.
+
+        :param str path: snapshot file path
+        :param int offset: spider log offset, up to which all messages are reflected in the states
+        :raises IOError: if changed states couldn't be written to HBase, snapshot isn't written then
+        """
+        self.flush(False)
+        if self._flusher:
+            self._flusher.wait()
+        self._check_filter_rebuild()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            header_size = len(self._snapshot_header(offset, 0, 0, 0.0))
+            f.seek(header_size)
+            if self._known_time is not None:
+                self._known.dump(f)
+            filter_size = f.tell() - header_size
+            self._state_cache.dump(f)
+            cache_size = f.tell() - header_size - filter_size
+            f.seek(0)
+            f.write(self._snapshot_header(offset, filter_size, cache_size, self._known_time or 0.0))
+        rename(tmp_path, path)
+        self.logger.info("States snapshot written, offset %d, %d states" % (offset, len(self._state_cache)))
+
+    def load_snapshot(self, path):
+        """
+        Loads the cache, and the filter of known fingerprints if it's in, from a local snapshot file. Snapshot which
+        is broken or of other cache type is ignored. The filter is used only until it's older than refresh interval,
+        same as the rebuilt one, and has to be rebuilt with :meth:`start_filter_rebuild` to learn states written by
+        other workers since the snapshot.
+
+        :return: spider log offset the snapshot was taken at, or None if it wasn't loaded
+        """
+        if not exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+                try:
+                    offset = self._load_snapshot(buf)
+                finally:
+                    buf.close()
+        except (ValueError, EnvironmentError, struct_error), e:
+            self.logger.error("States snapshot %s is broken, ignoring: %s" % (path, e))
+            self._state_cache.clear()
+            self._known_time = None
+            return None
+        if offset is None:
+            self.logger.info("States snapshot %s is of other version or cache type, ignoring" % path)
+            return None
+        self.logger.info("States snapshot loaded, offset %d, %d states" % (offset, len(self._state_cache)))
+        return offset
+
+    def _load_snapshot(self, buf):
+        magic, version, offset, name_size = unpack_from(self.SNAPSHOT_PREFIX, buf)
+        position = calcsize(self.SNAPSHOT_PREFIX)
+        if (magic, version) != ('DFSS', self.SNAPSHOT_VERSION) or \
+                buf[position:position + name_size] != self._state_cache.__class__.__name__:
+            return None
+        position += name_size
+        filter_size, cache_size, known_time = unpack_from('>QQd', buf, position)
+        position += 24
+        if len(buf) != position + filter_size + cache_size:
+            raise ValueError("Snapshot size doesn't match, it's truncated")
+        if filter_size and self._known is not None and self._known.load(buf, position):
+            self._known_time = known_time
+        self._state_cache.load(buf, position + filter_size)
+        return offset
+
+    def _snapshot_header(self, offset, filter_size, cache_size, known_time):
+        name = self._state_cache.__class__.__name__
+        return pack(self.SNAPSHOT_PREFIX, 'DFSS', self.SNAPSHOT_VERSION, offset, len(name)) + name + \
+            pack('>QQd', filter_size, cache_size, known_time)
+
+    def get_stats(self):
+        stats = self._state_cache.get_stats()
+        stats['dirty'] = len(self._dirty)
+        if self._flusher:
+            stats.update(self._flusher.get_stats())
+        if self._known is not None:
+            stats['filter_ready'] = self._is_filter_fresh()
+            stats['filter_size'] = self._known.count
+            stats['filter_avoided_reads'] = self._avoided_reads
+        return stats
 
 
 class HBaseBackend(Backend):
     component_name = 'HBase Backend'
 
-    def __init__(self, manager):
+    def __init__(self, manager, is_copy=False):
+        """
+        :param manager: frontier manager
+        :param bool is_copy: only open connections to existing tables, without creating or dropping them, and without
+            states (see :meth:`copy`)
+        """
         self.manager = manager
 
         settings = manager.settings
@@ -286,25 +808,59 @@ class HBaseBackend(Backend):
         drop_all_tables = settings.get('HBASE_DROP_ALL_TABLES')
         self.queue_partitions = settings.get('HBASE_QUEUE_PARTITIONS')
         self._table_name = settings.get('HBASE_METADATA_TABLE')
-        host = choice(hosts) if type(hosts) in [list, tuple] else hosts
-        kwargs = {
-            'host': host,
+        self._hosts = list(hosts) if type(hosts) in [list, tuple] else [hosts]
+        self._connection_class = load_object(settings.get('HBASE_CONNECTION'))
+        self._connection_kwargs = {
             'port': int(port),
             'table_prefix': namespace,
             'table_prefix_separator': ':'
         }
         if settings.get('HBASE_USE_COMPACT_PROTOCOL'):
-            kwargs.update({
+            self._connection_kwargs.update({
                 'protocol': 'compact',
                 'transport': 'framed'
             })
-        self.connection = Connection(**kwargs)
-        self.queue = HBaseQueue(self.connection, self.queue_partitions, self.manager.logger.backend,
-                                settings.get('HBASE_QUEUE_TABLE'), drop=drop_all_tables)
-        self.state_checker = HBaseState(self.connection, self._table_name, self.manager.logger.backend,
-                                        settings.get('HBASE_STATE_CACHE_SIZE_LIMIT'))
+        self.connection = self._connect(choice(self._hosts))
+        queue_class = load_object(settings.get('HBASE_QUEUE'))
+        self.queue = queue_class(self.connection, self.queue_partitions, self.manager.logger.backend,
+                                 settings.get('HBASE_QUEUE_TABLE'), drop=drop_all_tables and not is_copy,
+                                 get_time_budget=settings.get('HBASE_QUEUE_GET_TIME_BUDGET'))
+        self.queue_min_hosts = settings.get('HBASE_QUEUE_MIN_HOSTS')
+        self.queue_max_requests_per_host = settings.get('HBASE_QUEUE_MAX_REQUESTS_PER_HOST')
+        get_concurrency = settings.get('HBASE_QUEUE_GET_CONCURRENCY')
+        self._queue_connections = [self._connect(self._hosts[i % len(self._hosts)]) for i in range(get_concurrency)] \
+            if get_concurrency > 1 else [self.connection]
+        self._free_queue_connections = Queue()
+        for queue_connection in self._queue_connections:
+            self._free_queue_connections.put(queue_connection)
+        self._queue_pool = ThreadPool(get_concurrency) if get_concurrency > 1 else None
+        self.state_checker = None if is_copy else self._create_state_checker(settings)
+        if not is_copy:
+            self._create_metadata_table(settings, drop_all_tables)
+        table = self.connection.table(self._table_name)
+        self.batch = table.batch(batch_size=settings.get('HBASE_BATCH_SIZE'))
+        self.store_content = settings.get('HBASE_STORE_CONTENT')
+
+    def _create_state_checker(self, settings):
+        known_filter = FingerprintBloomFilter(settings.get('HBASE_STATE_FILTER_CAPACITY'),
+                                              settings.get('HBASE_STATE_FILTER_ERROR_RATE')) \
+            if settings.get('HBASE_STATE_FILTER') else None
+        fetch_concurrency = settings.get('HBASE_STATE_FETCH_CONCURRENCY')
+        fetch_connections = [self._connect(self._hosts[i % len(self._hosts)]) for i in range(fetch_concurrency)] \
+            if fetch_concurrency > 1 else None
+        flusher = StateFlusher(self._connect(choice(self._hosts)), self._table_name, self.manager.logger.backend,
+                               settings.get('HBASE_STATE_WRITE_BEHIND_QUEUE_SIZE')) \
+            if settings.get('HBASE_STATE_WRITE_BEHIND') else None
+        filter_connection = self._connect(choice(self._hosts)) if known_filter else None
+        return HBaseState(self.connection, self._table_name, self.manager.logger.backend,
+                          settings.get('HBASE_STATE_CACHE_SIZE_LIMIT'),
+                          load_object(settings.get('HBASE_STATE_CACHE')), known_filter,
+                          fetch_connections, flusher, filter_connection,
+                          settings.get('HBASE_STATE_FILTER_REFRESH_INTERVAL'))
+
+    def _create_metadata_table(self, settings, drop):
         tables = set(self.connection.tables())
-        if drop_all_tables and self._table_name in tables:
+        if drop and self._table_name in tables:
             self.connection.delete_table(self._table_name, disable=True)
             tables.remove(self._table_name)
 
@@ -318,20 +874,36 @@ class HBaseBackend(Backend):
                 schema['m']['compression'] = 'SNAPPY'
                 schema['c']['compression'] = 'SNAPPY'
             self.connection.create_table(self._table_name, schema)
-        table = self.connection.table(self._table_name)
-        self.batch = table.batch(batch_size=settings.get('HBASE_BATCH_SIZE'))
-        self.store_content = settings.get('HBASE_STORE_CONTENT')
+
+    def _connect(self, host):
+        return self._connection_class(host=host, **self._connection_kwargs)
 
     @classmethod
     def from_manager(cls, manager):
         return cls(manager)
 
+    def copy(self):
+        """
+        Returns backend using the same tables, but with connections and write batch of it's own, so it can be used
+        from another thread. Tables aren't created or dropped, and the copy has no states.
+        """
+        return self.__class__(self.manager, is_copy=True)
+
     def frontier_start(self):
         pass
 
     def frontier_stop(self):
-        self.connection.close()
-        self.flush()
+        try:
+            if self.state_checker is not None:
+                self.state_checker.close()
+        finally:
+            self.flush()
+            if self._queue_pool:
+                self._queue_pool.close()
+                self._queue_pool.join()
+                for connection in self._queue_connections:
+                    connection.close()
+            self.connection.close()
 
     def add_seeds(self, seeds):
         for seed in seeds:
@@ -367,22 +939,70 @@ class HBaseBackend(Backend):
         self.batch.put(rk, obj)
 
     def get_next_requests(self, max_next_requests, **kwargs):
-        next_pages = []
+        return list(self.iter_next_requests(max_next_requests, **kwargs))
+
+    def iter_next_requests(self, max_next_requests, **kwargs):
+        """
+        The same as :meth:`get_next_requests`, but yields requests of every partition as soon as it's read. When
+        HBASE_QUEUE_GET_CONCURRENCY is more than one, partitions are read in parallel, and come in order of
+        completion.
+
+        Requests are removed from the queue when partition is read, so if iteration stops early, requests of the
+        partitions which were read already, but not handed out, are put back to the queue.
+        """
         log = self.manager.logger.backend
         log.debug("Querying queue table.")
         partitions = set(kwargs.pop('partitions', []))
-        for partition_id in range(0, self.queue_partitions):
-            if partition_id not in partitions:
-                continue
-            results = self.queue.get(partition_id, max_next_requests,
-                                                    min_hosts=24, max_requests_per_host=128)
-            log.debug("Got %d items for partition id %d" % (len(results), partition_id))
-            for fingerprint, url, score in results:
-                r = self.manager.request_model(url=url)
-                r.meta['fingerprint'] = fingerprint
-                r.meta['score'] = score
-                next_pages.append(r)
-        return next_pages
+        partition_ids = [partition_id for partition_id in range(0, self.queue_partitions)
+                         if partition_id in partitions]
+        get = lambda partition_id: self._get_partition_requests(partition_id, max_next_requests)
+        if self._queue_pool:
+            results = self._queue_pool.imap_unordered(get, partition_ids)
+        else:
+            results = imap(get, partition_ids)
+        pending = deque()
+        try:
+            for partition_id, items in results:
+                log.debug("Got %d items for partition id %d" % (len(items), partition_id))
+                pending.extend(items)
+                while pending:
+                    fingerprint, url, score = pending.popleft()
+                    r = self.manager.request_model(url=url)
+                    r.meta['fingerprint'] = fingerprint
+                    r.meta['score'] = score
+                    yield r
+        finally:
+            # pool reads all partitions regardless of iteration, sequential reading just stops
+            if self._queue_pool:
+                for _, items in results:
+                    pending.extend(items)
+            if pending:
+                self._put_back(pending)
+
+    def _get_partition_requests(self, partition_id, max_next_requests):
+        connection = self._free_queue_connections.get()
+        try:
+            return partition_id, self.queue.get(partition_id, max_next_requests,
+                                                min_hosts=self.queue_min_hosts,
+                                                max_requests_per_host=self.queue_max_requests_per_host,
+                                                connection=connection)
+        except Exception, e:
+            self.manager.logger.backend.error("Error getting requests of partition %d: %s" % (partition_id, e))
+            return partition_id, []
+        finally:
+            self._free_queue_connections.put(connection)
+
+    def _put_back(self, items):
+        log = self.manager.logger.backend
+        log.warning("Putting %d requests, which weren't handed out, back to the queue" % len(items))
+        to_schedule = []
+        for fingerprint, url, score in items:
+            _, hostname, _, _, _, _ = parse_domain_from_url_fast(url)
+            to_schedule.append((score, fingerprint, {'name': hostname}, url))
+        try:
+            self.queue.schedule(to_schedule)
+        except Exception, e:
+            log.error("Error putting back %d requests, they are lost: %s" % (len(to_schedule), e))
 
     def update_score(self, batch):
         if not isinstance(batch, dict):
@@ -412,3 +1032,12 @@ class HBaseBackend(Backend):
     def fetch_states(self, fingerprints):
         self.state_checker.fetch(fingerprints)
 
+    def rebuild_states_filter(self):
+        self.state_checker.start_filter_rebuild()
+
+    def snapshot_states(self, path, offset):
+        self.state_checker.snapshot(path, offset)
+
+    def load_states_snapshot(self, path):
+        return self.state_checker.load_snapshot(path)
+
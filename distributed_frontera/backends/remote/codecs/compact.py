@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Compact codec for the two highest volume message types: update_score in scoring log and requests in outgoing topic.
+All other messages are encoded the same way as with msgpack codec.
+
+Compact messages start with 0xc1 byte, which is never used by msgpack, followed by format version and message type
+bytes. Therefore decoder tells compact messages from msgpack ones by the first byte, and reads both. Encoder produces
+messages of configured ``version``, where version 0 means plain msgpack messages. For rolling upgrade of a cluster,
+workers and spiders are deployed with version 0 first, and the version is raised once every consumer can read it.
+
+Version 1 layouts:
+
+* update_score: binary fingerprint (20 bytes), score (double), schedule flag (byte), then URL till the end.
+* request: msgpack array of URL, binary fingerprint, meta with well known keys replaced by small integers, and
+  headers and cookies, which are omitted when empty.
+"""
+from __future__ import absolute_import
+from binascii import hexlify, unhexlify
+from struct import pack, unpack_from, calcsize
+
+from msgpack import packb, unpackb
+
+from distributed_frontera.backends.remote.codecs import msgpack
+
+MAGIC = '\xc1'
+VERSION = 1
+
+UPDATE_SCORE = 'U'
+REQUEST = 'R'
+
+_UPDATE_SCORE_HEADER = '>20sdB'
+_UPDATE_SCORE_HEADER_SIZE = calcsize(_UPDATE_SCORE_HEADER)
+
+# never reorder, only append: indices are a part of the format
+META_KEYS = ('fingerprint', 'score', 'jid', 'domain', 'state', 'scrapy_meta', 'name', 'netloc', 'scheme', 'sld',
+             'tld', 'subdomain')
+_META_KEY_IDS = dict((key, i) for i, key in enumerate(META_KEYS))
+
+
+def _intern_keys(meta):
+    return dict((_META_KEY_IDS.get(key, key), value) for key, value in meta.iteritems())
+
+
+def _restore_keys(meta):
+    return dict((META_KEYS[key] if type(key) is int else key, value) for key, value in meta.iteritems())
+
+
+class Encoder(msgpack.Encoder):
+    def __init__(self, request_model, *a, **kw):
+        super(Encoder, self).__init__(request_model, *a, **kw)
+        version = kw.get('version')
+        self.version = VERSION if version is None else version
+        if not 0 <= self.version <= VERSION:
+            raise ValueError("Unsupported compact codec version %s, maximal is %d." % (self.version, VERSION))
+
+    def encode_request(self, request):
+        if not self.version:
+            return super(Encoder, self).encode_request(request)
+        meta = _intern_keys(msgpack._prepare_meta(request.meta))
+        if type(meta.get(3)) is dict:
+            meta[3] = _intern_keys(meta[3])
+        obj = [request.url, unhexlify(meta.pop(0)), meta]
+        if request.headers or request.cookies:
+            obj.extend([request.headers, request.cookies])
+        return MAGIC + chr(self.version) + REQUEST + packb(obj)
+
+    def encode_update_score(self, fingerprint, score, url, schedule):
+        if not self.version:
+            return super(Encoder, self).encode_update_score(fingerprint, score, url, schedule)
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return MAGIC + chr(self.version) + UPDATE_SCORE + \
+            pack(_UPDATE_SCORE_HEADER, unhexlify(fingerprint), score, 1 if schedule else 0) + url
+
+
+class Decoder(msgpack.Decoder):
+    def _split(self, buffer, error=TypeError):
+        version = ord(buffer[1])
+        if version > VERSION:
+            raise error("Unsupported compact codec version %d, maximal is %d." % (version, VERSION))
+        return buffer[2], buffer[3:]
+
+    def _decode_compact(self, buffer):
+        type, body = self._split(buffer)
+        if type == UPDATE_SCORE:
+            fingerprint, score, schedule = unpack_from(_UPDATE_SCORE_HEADER, body)
+            return ('update_score', hexlify(fingerprint), score, body[_UPDATE_SCORE_HEADER_SIZE:], bool(schedule))
+        if type == REQUEST:
+            return ('request', self._request_from_compact(unpackb(body)))
+        raise TypeError('Unknown message type')
+
+    def _request_from_compact(self, obj):
+        meta = _restore_keys(obj[2])
+        meta['fingerprint'] = hexlify(obj[1])
+        if type(meta.get('domain')) is dict:
+            meta['domain'] = _restore_keys(meta['domain'])
+        headers, cookies = (obj[3], obj[4]) if len(obj) > 3 else (None, None)
+        return self._request_model(url=obj[0], headers=headers, cookies=cookies, meta=meta)
+
+    def decode(self, buffer):
+        if buffer[0] == MAGIC:
+            return self._decode_compact(buffer)
+        return super(Decoder, self).decode(buffer)
+
+    def decode_request(self, buffer):
+        if buffer[0] == MAGIC:
+            # KafkaBackend expects ValueError for undecodable requests
+            type, body = self._split(buffer, ValueError)
+            if type != REQUEST:
+                raise ValueError('Request message is expected')
+            return self._request_from_compact(unpackb(body))
+        return super(Decoder, self).decode_request(buffer)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Framing of many encoded records into one Kafka message, to get better compression ratio and fewer produce requests
+for high volume topics. It doesn't depend on codec used for records.
+
+Frame starts with 0xc1 0x00 'F' marker, which is neither valid msgpack, nor JSON, nor compact codec message, followed
+by number of records, and then records, each prefixed with it's length. Consumers read both framed and plain messages.
+"""
+from struct import pack, unpack_from
+
+FRAME_MAGIC = '\xc1\x00F'
+
+_COUNT = '>I'
+_LENGTH = '>I'
+_HEADER_SIZE = len(FRAME_MAGIC) + 4
+_LENGTH_SIZE = 4
+
+
+def is_frame(buffer):
+    return buffer.startswith(FRAME_MAGIC)
+
+
+def pack_frame(records):
+    parts = [FRAME_MAGIC, pack(_COUNT, len(records))]
+    for record in records:
+        parts.append(pack(_LENGTH, len(record)))
+        parts.append(record)
+    return ''.join(parts)
+
+
+def iter_records(buffer):
+    """
+    Generator of records of the message, message which isn't a frame is a single record.
+    """
+    if not buffer.startswith(FRAME_MAGIC):
+        yield buffer
+        return
+    count, = unpack_from(_COUNT, buffer, len(FRAME_MAGIC))
+    offset = _HEADER_SIZE
+    size = len(buffer)
+    for _ in xrange(count):
+        if offset + _LENGTH_SIZE > size:
+            raise ValueError('Truncated frame')
+        length, = unpack_from(_LENGTH, buffer, offset)
+        offset += _LENGTH_SIZE
+        if offset + length > size:
+            raise ValueError('Truncated frame')
+        yield buffer[offset:offset + length]
+        offset += length
+
+
+class Framer(object):
+    """
+    Accumulates records per partition and packs them into frames of at most ``max_size`` bytes. Record bigger than
+    that gets a frame of it's own.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._pending = {}
+
+    def add(self, partition, key, record):
+        """
+        :param partition: records of the same partition are put in the same frames
+        :param key: message key, key of the first record in frame is used
+        :param str record: encoded record
+        :return: (key, frame) tuple, when partition frame is full, None otherwise
+        """
+        size = len(record) + _LENGTH_SIZE
+        pending = self._pending.get(partition)
+        full = None
+        if pending is not None and pending[1] + size > self.max_size:
+            full = self._pop(partition)
+            pending = None
+        if pending is None:
+            pending = self._pending[partition] = [key, _HEADER_SIZE, []]
+        pending[1] += size
+        pending[2].append(record)
+        return full
+
+    def flush(self):
+        """
+        :return: list of (key, frame) tuples for all partitions having records
+        """
+        return [self._pop(partition) for partition in self._pending.keys()]
+
+    def _pop(self, partition):
+        key, _, records = self._pending.pop(partition)
+        return key, pack_frame(records)
@@ -34,8 +34,9 @@ class CrawlFrontierJSONEncoder(json.JSONEncoder):
 
 class Encoder(CrawlFrontierJSONEncoder):
     def __init__(self, request_model, *a, **kw):
+        self.send_body = True if kw.pop('send_body', False) else False
+        kw.pop('version', None)
         super(Encoder, self).__init__(request_model, *a, **kw)
-        self.send_body = True if 'send_body' in kw and kw['send_body'] else False
 
     def encode_add_seeds(self, seeds):
         """
@@ -2,25 +2,56 @@
 from __future__ import absolute_import
 from msgpack import packb, unpackb
 
+_PRIMITIVE_TYPES = frozenset([bool, int, long, float, str, unicode, type(None)])
+
+
+def _serialize(obj):
+    """Recursively walk object's hierarchy."""
+    if isinstance(obj, (bool, int, long, float, basestring)):
+        return obj
+    elif isinstance(obj, dict):
+        obj = obj.copy()
+        for key in obj:
+            obj[key] = _serialize(obj[key])
+        return obj
+    elif isinstance(obj, list):
+        return [_serialize(item) for item in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_serialize([item for item in obj]))
+    elif hasattr(obj, '__dict__'):
+        return _serialize(obj.__dict__)
+    else:
+        return None
+
+
+def _is_packable(key, value):
+    """
+    Checks whatever meta value can be packed as is. Fingerprint, jid, score and state are primitives, domain is a dict
+    of strings set by frontera middlewares. Everything else goes to generic walk.
+    """
+    if type(value) in _PRIMITIVE_TYPES:
+        return True
+    if key == 'domain' and type(value) is dict:
+        for item in value.itervalues():
+            if type(item) not in _PRIMITIVE_TYPES:
+                return False
+        return True
+    return False
+
+
+def _prepare_meta(meta):
+    for key, value in meta.iteritems():
+        if not _is_packable(key, value):
+            break
+    else:
+        # packing doesn't modify the dict, so there is no need to copy it
+        return meta
+    return dict((key, value if _is_packable(key, value) else _serialize(value)) for key, value in meta.iteritems())
+
+
 def _prepare_request_message(request):
-    def serialize(obj):
-        """Recursively walk object's hierarchy."""
-        if isinstance(obj, (bool, int, long, float, basestring)):
-            return obj
-        elif isinstance(obj, dict):
-            obj = obj.copy()
-            for key in obj:
-                obj[key] = serialize(obj[key])
-            return obj
-        elif isinstance(obj, list):
-            return [serialize(item) for item in obj]
-        elif isinstance(obj, tuple):
-            return tuple(serialize([item for item in obj]))
-        elif hasattr(obj, '__dict__'):
-            return serialize(obj.__dict__)
-        else:
-            return None
-    return [request.url, request.headers, request.cookies, serialize(request.meta)]
+    return [request.url, request.headers, request.cookies, _prepare_meta(request.meta)]
+
 
 def _prepare_response_message(response, send_body):
     return [response.url, response.status_code, response.meta, response.body if send_body else None]
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from collections import deque, OrderedDict
+from time import time
+
+from frontera.core import get_slot_key
+
+
+class OverusedBuffer(object):
+    """
+    Buffer of requests for overused downloader slots, a drop-in replacement of :class:`frontera.core.OverusedBuffer`.
+
+    Requests are kept in per-slot deques. Slots having requests and not overused are indexed in a ready set, which is
+    updated from the difference of overused keys between calls, so getting requests doesn't scan all buffered slots,
+    and is proportional to the number of requests returned and changes in overused keys. Ready slots are served in
+    round robin, one request per slot at a time.
+
+    Memory is capped by ``max_pending`` requests in total and ``max_per_slot`` per slot, requests above the caps are
+    returned even if their slot is overused, leaving them to the downloader. Slots without any activity during
+    ``slot_ttl`` seconds, are evicted the same way.
+    """
+    def __init__(self, _get_func, log_func=None, max_pending=100000, max_per_slot=1000, slot_ttl=600.0):
+        """
+        :param _get_func: reference to get_next_requests() method of binded class
+        :param log_func: optional logging function, for logging of internal state
+        :param int max_pending: maximal number of buffered requests
+        :param int max_per_slot: maximal number of buffered requests for one slot
+        :param float slot_ttl: time in seconds after which inactive slot is evicted
+        """
+        self._get = _get_func
+        self._log = log_func
+        self.max_pending = max_pending
+        self.max_per_slot = max_per_slot
+        self.slot_ttl = slot_ttl
+        self._pending = {}
+        self._ready = OrderedDict()
+        self._updated = OrderedDict()
+        self._released = deque()
+        self._overused = set()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _get_key(self, request, type):
+        if type == 'domain':
+            # hostname from netloc set by DomainMiddleware is the same as get_slot_key() gives, but without URL parsing
+            domain = request.meta.get('domain')
+            netloc = domain.get('netloc') if isinstance(domain, dict) else None
+            if netloc and '@' not in netloc and '[' not in netloc:
+                return netloc.partition(':')[0].lower()
+        return get_slot_key(request, type)
+
+    def _touch(self, key, now):
+        self._updated.pop(key, None)
+        self._updated[key] = now
+
+    def _remove(self, key):
+        del self._pending[key]
+        del self._updated[key]
+        self._ready.pop(key, None)
+
+    def _update_overused(self, overused):
+        for key in self._overused - overused:
+            if key in self._pending:
+                self._ready[key] = True
+        for key in overused - self._overused:
+            self._ready.pop(key, None)
+        self._overused = overused
+
+    def _evict_stale(self, now):
+        deadline = now - self.slot_ttl
+        while self._updated:
+            key, updated = next(self._updated.iteritems())
+            if updated > deadline:
+                break
+            if self._log:
+                self._log("Evicting %i requests of stale slot %s" % (len(self._pending[key]), key))
+            self._released.extend(self._pending[key])
+            self._remove(key)
+
+    def _get_pending(self, max_n_requests, now):
+        requests = []
+        while self._released and len(requests) < max_n_requests:
+            requests.append(self._released.popleft())
+        while self._ready and len(requests) < max_n_requests:
+            key = next(self._ready.iterkeys())
+            pending = self._pending[key]
+            requests.append(pending.popleft())
+            if pending:
+                # moving to the end, for round robin
+                del self._ready[key]
+                self._ready[key] = True
+                self._touch(key, now)
+            else:
+                self._remove(key)
+        self._size -= len(requests)
+        return requests
+
+    def _buffer(self, key, request, now):
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = deque()
+        elif len(pending) >= self.max_per_slot:
+            return False
+        if self._size >= self.max_pending:
+            if not pending:
+                del self._pending[key]
+            return False
+        pending.append(request)
+        self._size += 1
+        self._touch(key, now)
+        return True
+
+    def get_next_requests(self, max_n_requests, **kwargs):
+        if self._log:
+            self._log("Overused keys: %s" % str(kwargs['overused_keys']))
+            self._log("Pending: %i" % self._size)
+
+        now = time()
+        self._update_overused(set(kwargs['overused_keys']))
+        self._evict_stale(now)
+        requests = self._get_pending(max_n_requests, now)
+
+        if len(requests) == max_n_requests:
+            return requests
+
+        for request in self._get(max_n_requests - len(requests), **kwargs):
+            key = self._get_key(request, kwargs['key_type'])
+            if key in self._overused and self._buffer(key, request, now):
+                continue
+            requests.append(request)
+        return requests
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from logging import getLogger
+from Queue import Queue, Empty
+from threading import Thread, Event
+from time import time, sleep
+
+from kafka.common import ProduceRequest, ProduceResponse, FailedPayloadsError, UnknownError, kafka_errors, \
+    RETRY_ERROR_TYPES, RequestTimedOutError
+from kafka.protocol import CODEC_SNAPPY, create_message_set
+
+logger = getLogger("kafka.async")
+
+_FLUSH = object()
+_STOP = object()
+
+
+class AsyncProducer(object):
+    """
+    Batching producer, sending messages of one topic from a background thread.
+
+    Messages are kept in a buffer of at most ``buffer_size`` messages, :meth:`send` blocks when it's full. Buffered
+    messages are sent in one produce request for all partitions, as soon as ``batch_size`` bytes are collected or
+    ``linger`` seconds passed since the first message of a batch. Failed partitions are retried up to ``max_tries``
+    times on retriable errors, waiting ``retry_backoff`` seconds between tries.
+
+    Delivery callbacks are called from the background thread with ``(key, message, error)`` arguments, where error
+    is None if message was acknowledged by broker, or an exception if it was dropped.
+    """
+    def __init__(self, client, topic, partitioner_class, codec=CODEC_SNAPPY, buffer_size=10000, batch_size=262144,
+                 linger=0.5, max_tries=5, retry_backoff=1.0, callback=None):
+        """
+        :param client: Kafka client, used from the background thread only
+        :param str topic: topic to send messages to
+        :param partitioner_class: :class:`kafka.partitioner.base.Partitioner` subclass, used to map keys
+        :param int codec: Kafka compression codec
+        :param int buffer_size: maximal number of buffered messages
+        :param int batch_size: size of messages in bytes, triggering a send
+        :param float linger: maximal time in seconds message waits for a batch to fill
+        :param int max_tries: maximal number of tries to send a message
+        :param float retry_backoff: time to wait before next try
+        :param callback: default delivery callback
+        """
+        self._client = client
+        self._topic = topic
+        self._partitioner_class = partitioner_class
+        self._partitioner = None
+        self._codec = codec
+        self._batch_size = batch_size
+        self._linger = linger
+        self._max_tries = max_tries
+        self._retry_backoff = retry_backoff
+        self._callback = callback
+        self._queue = Queue(buffer_size)
+        self._flush_requested = Event()
+        self._thread = Thread(target=self._run, name="AsyncProducer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, key, message, callback=None):
+        """
+        Buffers the message, blocking if buffer is full.
+
+        :param str key: message key
+        :param str message: message value
+        :param callback: delivery callback, overriding the default one
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError("Producer is stopped")
+        self._queue.put((key, message, callback or self._callback))
+
+    def flush(self):
+        """
+        Sends buffered messages without waiting for linger time, and blocks until all of them are delivered or
+        dropped.
+        """
+        if not self._thread.is_alive():
+            return
+        self._flush_requested.set()
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def stop(self, timeout=None):
+        """
+        Flushes buffered messages and stops the background thread.
+        """
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    @property
+    def buffered(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            size = 0
+            deadline = None
+            while size < self._batch_size:
+                # when flushing, the queue is drained without waiting, till the flush marker
+                flushing = self._flush_requested.is_set()
+                timeout = None if deadline is None or flushing else deadline - time()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if item is _FLUSH or item is _STOP:
+                    self._queue.task_done()
+                    self._flush_requested.clear()
+                    stopping = item is _STOP
+                    break
+                if deadline is None:
+                    deadline = time() + self._linger
+                batch.append(item)
+                size += len(item[1])
+            if not batch:
+                continue
+            try:
+                self._send_batch(batch)
+            except Exception, e:
+                logger.exception("Unexpected error while sending batch")
+                self._notify(batch, e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _get_partition(self, key):
+        if self._partitioner is None:
+            self._client.load_metadata_for_topics(self._topic)
+            self._partitioner = self._partitioner_class(self._client.get_partition_ids_for_topic(self._topic))
+        return self._partitioner.partition(key)
+
+    def _send_batch(self, batch):
+        by_partition = defaultdict(list)
+        for item in batch:
+            by_partition[self._get_partition(item[0])].append(item)
+
+        tries = 0
+        error = None
+        while by_partition:
+            tries += 1
+            partitions = by_partition.keys()
+            requests = [ProduceRequest(self._topic, partition,
+                                       create_message_set([(item[1], item[0]) for item in by_partition[partition]],
+                                                          self._codec))
+                        for partition in partitions]
+            responses = self._client.send_produce_request(requests, fail_on_error=False)
+            failed = {}
+            for partition, response in zip(partitions, responses):
+                if isinstance(response, FailedPayloadsError):
+                    error = response
+                elif isinstance(response, ProduceResponse) and response.error:
+                    error = kafka_errors.get(response.error, UnknownError)()
+                else:
+                    self._notify(by_partition[partition], None)
+                    continue
+                if not isinstance(error, RETRY_ERROR_TYPES + (RequestTimedOutError,)):
+                    logger.error("Dropping %d messages: %s", len(by_partition[partition]), error)
+                    self._notify(by_partition[partition], error)
+                    continue
+                failed[partition] = by_partition[partition]
+            if failed and tries >= self._max_tries:
+                logger.error("Dropping %d messages after %d tries: %s", sum(map(len, failed.values())), tries,
+                             error)
+                for items in failed.values():
+                    self._notify(items, error)
+                return
+            if failed:
+                logger.warning("Could not send messages to %d partitions, try %d/%d: %s", len(failed), tries,
+                               self._max_tries, error)
+                sleep(self._retry_backoff)
+                self._client.reset_topic_metadata(self._topic)
+            by_partition = failed
+
+    def _notify(self, items, error):
+        for key, message, callback in items:
+            if callback is None:
+                continue
+            try:
+                callback(key, message, error)
+            except Exception:
+                logger.exception("Delivery callback failed")
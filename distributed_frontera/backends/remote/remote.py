@@ -1,13 +1,20 @@
 import time
+from collections import deque
+from importlib import import_module
 from logging import getLogger, StreamHandler
+from Queue import Queue, Empty
+from threading import Thread, Event
 
-from kafka import KafkaClient, SimpleConsumer, KeyedProducer
+from kafka import KeyedProducer
 from kafka.common import BrokerResponseError, OffsetOutOfRangeError, MessageSizeTooLargeError
 from kafka.protocol import CODEC_SNAPPY
-from frontera.core import OverusedBuffer
+from frontera.utils.misc import load_object
 
-from codecs.msgpack import Encoder, Decoder
 from frontera import Backend, Settings
+from distributed_frontera.backends.remote.codecs.framing import iter_records
+from distributed_frontera.backends.remote.overused import OverusedBuffer
+from distributed_frontera.backends.remote.producer import AsyncProducer
+from distributed_frontera.worker.consumer import AdaptiveConsumer
 from distributed_frontera.worker.partitioner import FingerprintPartitioner
 
 
@@ -42,11 +49,34 @@ class KafkaBackend(Backend):
         self._group = settings.get('FRONTIER_GROUP', "scrapy-crawler")
         self._get_timeout = float(settings.get('KAFKA_GET_TIMEOUT', 5.0))
         self._partition_id = settings.get('SPIDER_PARTITION_ID')
+        self._client_class = load_object(settings.get('KAFKA_CLIENT', 'kafka.KafkaClient'))
+        self._async = settings.get('KAFKA_ASYNC_PRODUCER', False)
+        self._async_options = {
+            'buffer_size': settings.get('KAFKA_PRODUCER_BUFFER_SIZE', 10000),
+            'batch_size': settings.get('KAFKA_PRODUCER_BATCH_SIZE', 262144),
+            'linger': settings.get('KAFKA_PRODUCER_LINGER', 0.5)
+        }
+        self._prefetch = settings.get('KAFKA_PREFETCH', 0)
+        self.stats = {
+            'delivered': 0,
+            'dropped': 0
+        }
 
         # Kafka setup
-        self._conn = KafkaClient(self._server)
+        self._conn = self._client_class(self._server)
+        # prefetching consumer runs in it's own thread, and client isn't thread-safe
+        self._cons_conn = self._conn.copy() if self._prefetch else self._conn
         self._prod = None
         self._cons = None
+        if self._prefetch:
+            self._prefetched = Queue(self._prefetch)
+            self._prefetch_stopped = Event()
+            self._prefetch_thread = None
+            self.stats['prefetch_buffer_size'] = self._prefetch
+            self.stats['prefetch_buffer'] = 0
+            self.stats['prefetch_dropped'] = 0
+        # requests left from framed messages, which had more records than requested
+        self._pending = deque()
 
         logger = getLogger("kafka")
         handler = StreamHandler()
@@ -55,8 +85,9 @@ class KafkaBackend(Backend):
         self._connect_consumer()
         self._connect_producer()
 
-        self._encoder = Encoder(manager.request_model)
-        self._decoder = Decoder(manager.request_model, manager.response_model)
+        codec = import_module(settings.get('KAFKA_CODEC', 'distributed_frontera.backends.remote.codecs.msgpack'))
+        self._encoder = codec.Encoder(manager.request_model, version=settings.get('KAFKA_CODEC_VERSION'))
+        self._decoder = codec.Decoder(manager.request_model, manager.response_model)
                 
     def _connect_producer(self):
         """If producer is not connected try to connect it now.
@@ -65,7 +96,13 @@ class KafkaBackend(Backend):
         """        
         if self._prod is None:
             try:
-                self._prod = KeyedProducer(self._conn, partitioner=FingerprintPartitioner, codec=CODEC_SNAPPY)
+                if self._async:
+                    # producer thread gets it's own connection, client isn't thread-safe
+                    self._prod = AsyncProducer(self._conn.copy(), self._topic_done, FingerprintPartitioner,
+                                               codec=CODEC_SNAPPY, callback=self._on_delivery,
+                                               **self._async_options)
+                else:
+                    self._prod = KeyedProducer(self._conn, partitioner=FingerprintPartitioner, codec=CODEC_SNAPPY)
             except BrokerResponseError:
                 self._prod = None        
                 if self._manager is not None:
@@ -82,13 +119,14 @@ class KafkaBackend(Backend):
         """
         if self._cons is None:
             try:
-                self._cons = SimpleConsumer(
-                    self._conn,
+                self._cons = AdaptiveConsumer(
+                    self._cons_conn,
                     self._group,
                     self._topic_todo,
                     partitions=[self._partition_id],
                     buffer_size=131072,
                     max_buffer_size=1048576)
+                self.stats['consumer'] = self._cons.stats
             except BrokerResponseError:
                 self._cons = None
                 if self._manager is not None:
@@ -110,15 +148,57 @@ class KafkaBackend(Backend):
             self._manager.logger.backend.warning(
                 "Could not connect consumer to {0}. I will try latter.".format(
                     self._topic_todo))
+        if self._prefetch:
+            self._start_prefetch()
 
     def frontier_stop(self):        
+        if self._prefetch:
+            self._stop_prefetch()
         # flush everything if a batch is incomplete
         self._prod.stop()
 
+    def _start_prefetch(self):
+        if self._prefetch_thread is not None and self._prefetch_thread.is_alive():
+            return
+        # thread can be started only once, so a new one is made every time, e.g. after stop
+        self._prefetch_stopped.clear()
+        self._prefetch_thread = Thread(target=self._prefetch_requests, name="KafkaPrefetch")
+        self._prefetch_thread.daemon = True
+        self._prefetch_thread.start()
+
+    def _stop_prefetch(self):
+        self._prefetch_stopped.set()
+        if self._prefetch_thread is None:
+            return
+        # fetch is waiting for KAFKA_GET_TIMEOUT at most, before stop is checked
+        self._prefetch_thread.join(self._get_timeout * 2)
+        if self._prefetch_thread.is_alive():
+            self._manager.logger.backend.warning("Prefetching thread didn't stop")
+            return
+        # consumer commits offsets as messages are read, so requests left in buffer aren't read again
+        dropped = self._prefetched.qsize() + len(self._pending)
+        self._prefetched = Queue(self._prefetch)
+        self._pending.clear()
+        self.stats['prefetch_buffer'] = 0
+        if dropped:
+            self.stats['prefetch_dropped'] += dropped
+            self._manager.logger.backend.warning("Dropped %d prefetched requests on stop" % dropped)
+
+    def _on_delivery(self, key, message, error):
+        if error is None:
+            self.stats['delivered'] += 1
+            return
+        self.stats['dropped'] += 1
+        self._manager.logger.backend.error("Message %s wasn't delivered: %s" % (key, error))
+
     def _send_message(self, encoded_message, key, fail_wait_time=1.0, max_tries=5):
         start = time.clock()
         success = False
-        if self._connect_producer():
+        if self._async and self._connect_producer():
+            # delivery is reported to _on_delivery, retries are done by producer
+            self._prod.send(key, encoded_message)
+            success = True
+        elif self._connect_producer():
             n_tries = 0
             while not success and n_tries < max_tries:
                 try:
@@ -151,22 +231,62 @@ class KafkaBackend(Backend):
         self._send_message(self._encoder.encode_request_error(page, error), page.meta['fingerprint'])
 
     def get_next_requests(self, max_n_requests, **kwargs):
+        if self._prefetch:
+            return self._get_prefetched(max_n_requests)
         start = time.clock()
+        requests = self._fetch_requests(max_n_requests)
+        self._manager.logger.backend.debug("get_next_requests: {0}".format(time.clock() - start))
+        return requests
+
+    def _get_prefetched(self, max_n_requests):
         requests = []
+        while len(requests) < max_n_requests:
+            try:
+                requests.append(self._prefetched.get_nowait())
+            except Empty:
+                break
+        self.stats['prefetch_buffer'] = self._prefetched.qsize()
+        return requests
+
+    def _prefetch_requests(self):
+        while not self._prefetch_stopped.is_set():
+            free = self._prefetch - self._prefetched.qsize()
+            if free <= 0:
+                self._prefetch_stopped.wait(0.1)
+                continue
+            try:
+                # the only producer of the queue, so it never blocks
+                for request in self._fetch_requests(free):
+                    self._prefetched.put(request)
+            except Exception, err:
+                self._manager.logger.backend.error("Prefetching error %s" % err)
+                self._prefetch_stopped.wait(self._get_timeout)
+            self.stats['prefetch_buffer'] = self._prefetched.qsize()
+
+    def _fetch_requests(self, max_n_requests):
+        requests = []
+        while self._pending and len(requests) < max_n_requests:
+            requests.append(self._pending.popleft())
+        if len(requests) == max_n_requests:
+            return requests
 
         if not self._connect_consumer():
-            return []
+            return requests
 
         while True:
             try:
                 success = False
                 for offmsg in self._cons.get_messages(
-                        max_n_requests,
+                        max_n_requests - len(requests),
                         timeout=self._get_timeout):
                     success = True
                     try:
-                        request = self._decoder.decode_request(offmsg.message.value)
-                        requests.append(request)
+                        for record in iter_records(offmsg.message.value):
+                            request = self._decoder.decode_request(record)
+                            if len(requests) < max_n_requests:
+                                requests.append(request)
+                            else:
+                                self._pending.append(request)
                     except ValueError:
                         self._manager.logger.backend.warning(
                             "Could not decode {0} message: {1}".format(
@@ -192,8 +312,6 @@ class KafkaBackend(Backend):
                 self._manager.logger.backend.warning(
                     "Error %s" % (err))
                 break
-
-        self._manager.logger.backend.debug("get_next_requests: {0}".format(time.clock() - start))
         return requests
 
 
@@ -202,8 +320,12 @@ class KafkaOverusedBackend(KafkaBackend):
 
     def __init__(self, manager):
         super(KafkaOverusedBackend, self).__init__(manager)
+        settings = manager.settings
         self._buffer = OverusedBuffer(super(KafkaOverusedBackend, self).get_next_requests,
-                                      manager.logger.manager.debug)
+                                      manager.logger.manager.debug,
+                                      max_pending=settings.get('OVERUSED_BUFFER_MAX_PENDING', 100000),
+                                      max_per_slot=settings.get('OVERUSED_BUFFER_MAX_PER_SLOT', 1000),
+                                      slot_ttl=settings.get('OVERUSED_BUFFER_SLOT_TTL', 600.0))
 
     def get_next_requests(self, max_n_requests, **kwargs):
         return self._buffer.get_next_requests(max_n_requests, **kwargs)
\ No newline at end of file
@@ -5,6 +5,7 @@ OVERUSED_SLOT_FACTOR = 2.0
 DELAY_ON_EMPTY = 30.0
 URL_FINGERPRINT_FUNCTION = 'frontera.utils.fingerprint.hostname_local_fingerprint'
 
+HBASE_CONNECTION = 'happybase.Connection'
 HBASE_THRIFT_HOST = 'localhost'
 HBASE_THRIFT_PORT = 9090
 HBASE_NAMESPACE = 'crawler'
@@ -16,5 +17,37 @@ HBASE_USE_COMPACT_PROTOCOL = False
 HBASE_BATCH_SIZE = 9216
 HBASE_STORE_CONTENT = False
 HBASE_STATE_CACHE_SIZE_LIMIT = 3000000
+HBASE_STATE_CACHE = 'distributed_frontera.backends.cache.ClockStateCache'
 HBASE_QUEUE_TABLE = 'queue'
+HBASE_QUEUE = 'distributed_frontera.backends.hbase.HBaseQueue'
+HBASE_QUEUE_MIN_HOSTS = 24
+HBASE_QUEUE_MAX_REQUESTS_PER_HOST = 128
+HBASE_QUEUE_GET_TIME_BUDGET = 10.0
+HBASE_QUEUE_GET_CONCURRENCY = 1
+HBASE_STATE_WRITE_BEHIND = False
+HBASE_STATE_WRITE_BEHIND_QUEUE_SIZE = 16
+HBASE_STATE_FETCH_CONCURRENCY = 1
+HBASE_STATE_FILTER = False
+HBASE_STATE_FILTER_CAPACITY = 100000000
+HBASE_STATE_FILTER_ERROR_RATE = 0.01
+HBASE_STATE_FILTER_REFRESH_INTERVAL = 600.0
 
+KAFKA_CLIENT = 'kafka.KafkaClient'
+KAFKA_CODEC = 'distributed_frontera.backends.remote.codecs.msgpack'
+KAFKA_CODEC_VERSION = None
+KAFKA_FRAME_SIZE = None
+KAFKA_ASYNC_PRODUCER = False
+KAFKA_PRODUCER_BUFFER_SIZE = 10000
+KAFKA_PRODUCER_BATCH_SIZE = 262144
+KAFKA_PRODUCER_LINGER = 0.5
+KAFKA_PREFETCH = 0
+KAFKA_LAGS_CACHE_TTL = 0.0
+KAFKA_LAGS_FROM_PRODUCER = False
+
+OVERUSED_BUFFER_MAX_PENDING = 100000
+OVERUSED_BUFFER_MAX_PER_SLOT = 1000
+OVERUSED_BUFFER_SLOT_TTL = 600.0
+PIPELINE_QUEUE_SIZE = 4
+
+SCORING_STATES_SNAPSHOT = None
+SCORING_STATES_SNAPSHOT_INTERVAL = 600.0
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from bisect import bisect_left
+from threading import RLock
+
+
+class MemoryCluster(object):
+    """
+    Process wide storage shared by all :class:`Connection` objects, like HBase cluster is shared by Thrift servers.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.lock = RLock()
+
+    def reset(self):
+        with self.lock:
+            self.tables.clear()
+
+
+cluster = MemoryCluster()
+
+
+class Connection(object):
+    """
+    In-memory stand-in for :class:`happybase.Connection`, implementing the subset used by Distributed Frontera.
+    Accepts (and ignores) all connection arguments, so it can be set in HBASE_CONNECTION setting. Tables are stored
+    in memory of current process, and visible to all connections with the same table prefix.
+    """
+    def __init__(self, host='localhost', port=9090, table_prefix=None, table_prefix_separator='_', cluster=cluster,
+                 **kwargs):
+        self.host = host
+        self.port = port
+        self.table_prefix = table_prefix
+        self.table_prefix_separator = table_prefix_separator
+        self._cluster = cluster
+
+    def _table_name(self, name):
+        if self.table_prefix is None:
+            return name
+        return self.table_prefix + self.table_prefix_separator + name
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def tables(self):
+        if self.table_prefix is None:
+            return self._cluster.tables.keys()
+        prefix = self.table_prefix + self.table_prefix_separator
+        return [name[len(prefix):] for name in self._cluster.tables if name.startswith(prefix)]
+
+    def create_table(self, name, families):
+        if not families:
+            raise ValueError("At least one column family should be specified.")
+        name = self._table_name(name)
+        with self._cluster.lock:
+            if name in self._cluster.tables:
+                raise IOError("Table %s already exists." % name)
+            self._cluster.tables[name] = TableData(families.keys())
+
+    def delete_table(self, name, disable=False):
+        with self._cluster.lock:
+            del self._cluster.tables[self._table_name(name)]
+
+    def enable_table(self, name):
+        pass
+
+    def disable_table(self, name):
+        pass
+
+    def is_table_enabled(self, name):
+        return True
+
+    def table(self, name, use_prefix=True):
+        return Table(name, self)
+
+    def _get_data(self, name):
+        try:
+            return self._cluster.tables[self._table_name(name)]
+        except KeyError:
+            raise IOError("Table %s doesn't exist." % self._table_name(name))
+
+
+class TableData(object):
+    """
+    Rows of a table: dict of row key to row cells, and a lazily rebuilt sorted list of row keys.
+    """
+    def __init__(self, families):
+        self.families = set(families)
+        self.rows = {}
+        self.lock = RLock()
+        self._keys = []
+        self._stale = 0
+
+    def put(self, row, data):
+        for column in data:
+            if column.split(':', 1)[0] not in self.families:
+                raise IOError("Unknown column family in %s." % column)
+        with self.lock:
+            if row not in self.rows:
+                self.rows[row] = {}
+                self._keys = None
+            self.rows[row].update(data)
+
+    def delete(self, row, columns=None):
+        with self.lock:
+            cells = self.rows.get(row)
+            if cells is None:
+                return
+            if columns is not None:
+                for column in cells.keys():
+                    if _match(column, columns):
+                        del cells[column]
+                if cells:
+                    return
+            del self.rows[row]
+            self._stale += 1
+
+    def sorted_keys(self):
+        with self.lock:
+            if self._keys is None or self._stale > len(self.rows):
+                self._keys = sorted(self.rows)
+                self._stale = 0
+            return self._keys
+
+
+def _match(column, columns):
+    for c in columns:
+        if column == c or (':' not in c and column.startswith(c + ':')):
+            return True
+    return False
+
+
+def _select(cells, columns):
+    if columns is None:
+        return dict(cells)
+    return dict((column, value) for column, value in cells.iteritems() if _match(column, columns))
+
+
+class Table(object):
+    """
+    In-memory stand-in for :class:`happybase.Table`. Timestamps and versions aren't supported, only the latest value
+    of every cell is kept.
+    """
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+
+    @property
+    def _data(self):
+        return self.connection._get_data(self.name)
+
+    def families(self):
+        return dict((family, {}) for family in self._data.families)
+
+    def row(self, row, columns=None, timestamp=None, include_timestamp=False):
+        cells = self._data.rows.get(row)
+        return _select(cells, columns) if cells else {}
+
+    def rows(self, rows, columns=None, timestamp=None, include_timestamp=False):
+        data = self._data.rows
+        result = []
+        for row in rows:
+            cells = data.get(row)
+            if not cells:
+                continue
+            cells = _select(cells, columns)
+            if cells:
+                result.append((row, cells))
+        return result
+
+    def scan(self, row_start=None, row_stop=None, row_prefix=None, columns=None, filter=None, timestamp=None,
+             include_timestamp=False, batch_size=1000, scan_batching=None, limit=None, sorted_columns=False):
+        if row_prefix is not None:
+            if row_start is not None or row_stop is not None:
+                raise TypeError("'row_prefix' cannot be combined with 'row_start' or 'row_stop'")
+            row_start = row_prefix
+            row_stop = _prefix_stop(row_prefix)
+        data = self._data
+        keys = data.sorted_keys()
+        i = bisect_left(keys, row_start) if row_start else 0
+        count = 0
+        while i < len(keys):
+            if limit is not None and count >= limit:
+                return
+            row = keys[i]
+            i += 1
+            if row_stop is not None and row >= row_stop:
+                return
+            cells = data.rows.get(row)
+            if not cells:
+                continue
+            cells = _select(cells, columns)
+            if not cells:
+                continue
+            count += 1
+            yield row, cells
+
+    def put(self, row, data, timestamp=None, wal=True):
+        self._data.put(row, data)
+
+    def delete(self, row, columns=None, timestamp=None, wal=True):
+        self._data.delete(row, columns)
+
+    def batch(self, timestamp=None, batch_size=None, transaction=False, wal=True):
+        return Batch(self, batch_size, transaction)
+
+
+def _prefix_stop(prefix):
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Batch(object):
+    """
+    In-memory stand-in for :class:`happybase.Batch`. Mutations are applied on send, or when batch_size is reached.
+    """
+    def __init__(self, table, batch_size=None, transaction=False):
+        if batch_size is not None and transaction:
+            raise TypeError("'transaction' cannot be used when 'batch_size' is specified")
+        self._table = table
+        self._batch_size = batch_size
+        self._transaction = transaction
+        self._mutations = []
+
+    def send(self):
+        data = self._table._data
+        for op, row, arg in self._mutations:
+            if op == 'put':
+                data.put(row, arg)
+            else:
+                data.delete(row, arg)
+        self._mutations = []
+
+    def _add(self, op, row, arg):
+        self._mutations.append((op, row, arg))
+        if self._batch_size and len(self._mutations) >= self._batch_size:
+            self.send()
+
+    def put(self, row, data, wal=None):
+        self._add('put', row, dict(data))
+
+    def delete(self, row, columns=None, wal=None):
+        self._add('delete', row, columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._transaction:
+            return
+        self.send()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from bisect import bisect_left, bisect_right
+from functools import partial
+from struct import pack, unpack_from
+from threading import Condition
+from time import time
+
+from kafka.common import ProduceResponse, OffsetResponse, OffsetCommitResponse, \
+    OffsetFetchResponse, UnknownTopicOrPartitionError, OffsetOutOfRangeError, check_error
+from kafka.protocol import KafkaProtocol
+from kafka.util import kafka_bytestring, write_short_string
+
+LATEST = -1
+EARLIEST = -2
+
+
+class PartitionLog(object):
+    """
+    Messages of a single topic partition. Every message is kept encoded exactly as it appears in a fetch response
+    message set, so fetches are plain string slicing, and under-sized fetches return a partial trailing message,
+    like real broker does.
+    """
+    def __init__(self):
+        self.messages = []
+        self.times = []
+        self._ends = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message, timestamp):
+        offset = len(self.messages)
+        encoded = KafkaProtocol._encode_message(message)
+        data = pack('>qi', offset, len(encoded)) + encoded
+        self.messages.append(data)
+        self.times.append(timestamp)
+        self.size += len(data)
+        self._ends.append(self.size)
+        return offset
+
+    def available(self, offset):
+        return self.size - (self._ends[offset - 1] if offset else 0)
+
+    def read(self, offset, max_bytes):
+        start = self._ends[offset - 1] if offset else 0
+        stop = bisect_right(self._ends, start + max_bytes, offset)
+        data = b''.join(self.messages[offset:stop])
+        if stop < len(self.messages) and len(data) < max_bytes:
+            data += self.messages[stop][:max_bytes - len(data)]
+        return data
+
+    def offset_before(self, timestamp):
+        """
+        Offset of the first message appended at or after timestamp (in seconds).
+        """
+        return bisect_left(self.times, timestamp)
+
+
+class MemoryBroker(object):
+    """
+    Process wide storage shared by all :class:`KafkaClient` objects, playing the role of Kafka cluster. Topics are
+    created automatically on first metadata request, with ``partitions`` partitions, unless created explicitly
+    with :meth:`create_topic` beforehand.
+    """
+    def __init__(self, partitions=1):
+        self.partitions = partitions
+        self.condition = Condition()
+        self.reset()
+
+    def reset(self):
+        with self.condition:
+            self.topics = {}
+            self.group_offsets = {}
+
+    def create_topic(self, topic, partitions=None):
+        with self.condition:
+            if topic not in self.topics:
+                self.topics[topic] = [PartitionLog() for _ in xrange(partitions or self.partitions)]
+            return self.topics[topic]
+
+    def get_log(self, topic, partition):
+        logs = self.topics.get(topic)
+        if logs is None or not 0 <= partition < len(logs):
+            return None
+        return logs[partition]
+
+    def get_stats(self):
+        with self.condition:
+            return dict((topic, {
+                'messages': sum(len(log) for log in logs),
+                'bytes': sum(log.size for log in logs)
+            }) for topic, logs in self.topics.iteritems())
+
+
+broker = MemoryBroker()
+
+
+class KafkaClient(object):
+    """
+    In-memory stand-in for :class:`kafka.KafkaClient`, implementing requests used by :class:`kafka.SimpleConsumer`,
+    :class:`kafka.SimpleProducer`, :class:`kafka.KeyedProducer` and :class:`distributed_frontera.worker.offsets.Fetcher`.
+    Accepts (and ignores) connection arguments, so it can be set in KAFKA_CLIENT setting. Compressed message sets
+    are unpacked on produce and messages are stored uncompressed.
+    """
+    def __init__(self, hosts, client_id='kafka-python', timeout=120, broker=broker, **kwargs):
+        self.hosts = hosts
+        self.client_id = client_id
+        self.timeout = timeout
+        self._broker = broker
+        self.topic_partitions = {}
+
+    def __repr__(self):
+        return '<KafkaClient client_id=%s, stub>' % self.client_id
+
+    def close(self):
+        pass
+
+    def copy(self):
+        c = KafkaClient(self.hosts, self.client_id, self.timeout, self._broker)
+        c.topic_partitions = dict(self.topic_partitions)
+        return c
+
+    def reinit(self):
+        pass
+
+    def reset_topic_metadata(self, *topics):
+        for topic in topics:
+            self.topic_partitions.pop(topic, None)
+
+    def reset_all_metadata(self):
+        self.topic_partitions.clear()
+
+    def has_metadata_for_topic(self, topic):
+        topic = kafka_bytestring(topic)
+        return topic in self.topic_partitions and len(self.topic_partitions[topic]) > 0
+
+    def get_partition_ids_for_topic(self, topic):
+        topic = kafka_bytestring(topic)
+        if topic not in self.topic_partitions:
+            return []
+        return sorted(self.topic_partitions[topic])
+
+    @property
+    def topics(self):
+        return list(self.topic_partitions.keys())
+
+    def ensure_topic_exists(self, topic, timeout=30):
+        self.load_metadata_for_topics(topic)
+
+    def load_metadata_for_topics(self, *topics):
+        topics = [kafka_bytestring(t) for t in topics]
+        if topics:
+            for topic in topics:
+                self._broker.create_topic(topic)
+        else:
+            self.topic_partitions.clear()
+        with self._broker.condition:
+            for topic, logs in self._broker.topics.iteritems():
+                if not topics or topic in topics:
+                    self.topic_partitions[topic] = range(len(logs))
+
+    def _responses(self, responses, fail_on_error, callback):
+        if fail_on_error:
+            for resp in responses:
+                check_error(resp)
+        return [resp if not callback else callback(resp) for resp in responses]
+
+    def send_produce_request(self, payloads=[], acks=1, timeout=1000, fail_on_error=True, callback=None):
+        now = time()
+        responses = []
+        with self._broker.condition:
+            for payload in payloads:
+                log = self._broker.get_log(payload.topic, payload.partition)
+                if log is None:
+                    responses.append(ProduceResponse(payload.topic, payload.partition,
+                                                     UnknownTopicOrPartitionError.errno, -1))
+                    continue
+                offset = len(log)
+                for message in payload.messages:
+                    for _, decoded in KafkaProtocol._decode_message(KafkaProtocol._encode_message(message), 0):
+                        log.append(decoded, now)
+                responses.append(ProduceResponse(payload.topic, payload.partition, 0, offset))
+            self._broker.condition.notify_all()
+        if acks == 0:
+            return []
+        return self._responses(responses, fail_on_error, callback)
+
+    def send_fetch_request(self, payloads=[], fail_on_error=True, callback=None, max_wait_time=100, min_bytes=4096):
+        encoder = partial(KafkaProtocol.encode_fetch_request, max_wait_time=max_wait_time, min_bytes=min_bytes)
+        responses = self._send_broker_aware_request(payloads, encoder, KafkaProtocol.decode_fetch_response)
+        return self._responses(responses, fail_on_error, callback)
+
+    def _send_broker_aware_request(self, payloads, encoder_fn, decoder_fn):
+        """
+        The same as the method of real client, used by request senders with custom decoders, like
+        :class:`distributed_frontera.worker.consumer.AdaptiveConsumer`. Only fetch requests are supported, request
+        is encoded and response is decoded with the functions given, so decoder gets the bytes real broker sends.
+        """
+        request = encoder_fn(client_id=self.client_id, correlation_id=0, payloads=payloads)
+        api_key, _, _, client_id_size = unpack_from('>hhih', request, 4)
+        if api_key != KafkaProtocol.FETCH_KEY:
+            raise NotImplementedError("Only fetch requests are supported")
+        _, max_wait_time, min_bytes = unpack_from('>iii', request, 14 + client_id_size)
+        fetched = self._fetch(payloads, max_wait_time, min_bytes)
+        response = [pack('>ii', 0, len(fetched))]
+        for topic, partition, error, head, data in fetched:
+            response.append(write_short_string(topic) + pack('>iihqi', 1, partition, error, head, len(data)) + data)
+        return list(decoder_fn(b''.join(response)))
+
+    def _fetch(self, payloads, max_wait_time, min_bytes):
+        """
+        :return: list of (topic, partition, error, highwater mark, message set) tuples
+        """
+        deadline = time() + max_wait_time / 1000.0
+        responses = []
+        with self._broker.condition:
+            while True:
+                available = 0
+                for payload in payloads:
+                    log = self._broker.get_log(payload.topic, payload.partition)
+                    if log is not None and payload.offset <= len(log):
+                        available += log.available(payload.offset)
+                remaining = deadline - time()
+                if available >= min_bytes or remaining <= 0:
+                    break
+                self._broker.condition.wait(remaining)
+
+            for payload in payloads:
+                log = self._broker.get_log(payload.topic, payload.partition)
+                if log is None:
+                    error, data, head = UnknownTopicOrPartitionError.errno, b'', -1
+                elif not 0 <= payload.offset <= len(log):
+                    error, data, head = OffsetOutOfRangeError.errno, b'', len(log)
+                else:
+                    error, data, head = 0, log.read(payload.offset, payload.max_bytes), len(log)
+                responses.append((payload.topic, payload.partition, error, head, data))
+        return responses
+
+    def send_offset_request(self, payloads=[], fail_on_error=True, callback=None):
+        responses = []
+        with self._broker.condition:
+            for payload in payloads:
+                log = self._broker.get_log(payload.topic, payload.partition)
+                if log is None:
+                    responses.append(OffsetResponse(payload.topic, payload.partition,
+                                                    UnknownTopicOrPartitionError.errno, ()))
+                    continue
+                if payload.time == LATEST:
+                    offset = len(log)
+                elif payload.time == EARLIEST:
+                    offset = 0
+                else:
+                    offset = log.offset_before(payload.time / 1000.0)
+                responses.append(OffsetResponse(payload.topic, payload.partition, 0, (offset,)))
+        return self._responses(responses, fail_on_error, callback)
+
+    def send_offset_commit_request(self, group, payloads=[], fail_on_error=True, callback=None):
+        responses = []
+        with self._broker.condition:
+            for payload in payloads:
+                if self._broker.get_log(payload.topic, payload.partition) is None:
+                    responses.append(OffsetCommitResponse(payload.topic, payload.partition,
+                                                          UnknownTopicOrPartitionError.errno))
+                    continue
+                self._broker.group_offsets[(group, payload.topic, payload.partition)] = (payload.offset,
+                                                                                         payload.metadata)
+                responses.append(OffsetCommitResponse(payload.topic, payload.partition, 0))
+        return self._responses(responses, fail_on_error, callback)
+
+    def send_offset_fetch_request(self, group, payloads=[], fail_on_error=True, callback=None):
+        responses = []
+        with self._broker.condition:
+            for payload in payloads:
+                key = (group, payload.topic, payload.partition)
+                if key not in self._broker.group_offsets:
+                    # the same as Kafka 0.8 responds for groups without committed offsets
+                    responses.append(OffsetFetchResponse(payload.topic, payload.partition, -1, b'',
+                                                         UnknownTopicOrPartitionError.errno))
+                    continue
+                offset, metadata = self._broker.group_offsets[key]
+                responses.append(OffsetFetchResponse(payload.topic, payload.partition, offset, metadata, 0))
+        return self._responses(responses, fail_on_error, callback)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+import gc
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def collect_garbage():
+    """
+    kafka-python producers stop themselves when garbage collected, and sync ones log a warning doing that, so objects
+    left in reference cycles by a test are collected after it, while it's log output is still captured.
+    """
+    yield
+    gc.collect()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # the same for objects, which pytest was keeping alive through log records of the last test
+    gc.collect()
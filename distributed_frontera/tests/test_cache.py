@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from hashlib import sha1
+from io import BytesIO
+from struct import pack
+
+from pytest import raises
+
+from distributed_frontera.backends.cache import ClockStateCache, CompactStateCache, FingerprintBloomFilter
+
+
+def test_clock_cache_eviction():
+    cache = ClockStateCache(3)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['c'] = 3
+    assert cache.get('a') == 1
+    cache['d'] = 0
+    assert len(cache) == 3
+    assert 'a' in cache and 'd' in cache and 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get_stats() == {'size': 3, 'hits': 1, 'misses': 1, 'evictions': 1}
+
+
+def test_clock_cache_update_and_peek():
+    cache = ClockStateCache(2)
+    cache['a'] = 1
+    cache['a'] = 2
+    assert cache.peek('a') == 2
+    assert cache.peek('z', 5) == 5
+    assert cache.hits == 0 and cache.misses == 0
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_compact_cache():
+    cache = CompactStateCache(100)
+    fprints = ['%040x' % (i * 7919) for i in xrange(1, 301)]
+    for i, fprint in enumerate(fprints):
+        cache[fprint] = i % 4
+        if i % 3 == 0:
+            assert cache.get(fprints[0]) == 0
+    assert len(cache) == 100
+    assert cache.evictions == 200
+    assert fprints[0] in cache
+    assert cache.peek(fprints[-1]) == 299 % 4
+    present = [f for f in fprints if f in cache]
+    assert len(present) == 100
+    for fprint in present:
+        cache[fprint] = 2
+    assert all(cache.peek(f) == 2 for f in present)
+    assert len(cache) == 100
+
+
+def test_bloom_filter():
+    bf = FingerprintBloomFilter(1000, 0.01)
+    fprints = [sha1(str(i)).hexdigest() for i in xrange(2000)]
+    for fprint in fprints[:1000]:
+        bf.add(fprint)
+    assert bf.count == 1000
+    assert all(fprint in bf for fprint in fprints[:1000])
+    false_positives = sum(1 for fprint in fprints[1000:] if fprint in bf)
+    assert false_positives < 50
+
+
+def test_cache_dump_load():
+    fprints = [sha1(str(i)).hexdigest() for i in xrange(100)]
+    for cache_class in (ClockStateCache, CompactStateCache):
+        cache = cache_class(200)
+        for i, fprint in enumerate(fprints):
+            cache[fprint] = i % 4
+        f = BytesIO()
+        cache.dump(f)
+
+        loaded = cache_class(200)
+        loaded.load(f.getvalue())
+        assert len(loaded) == 100
+        assert all(loaded.peek(fprint) == i % 4 for i, fprint in enumerate(fprints))
+
+        smaller = cache_class(50)
+        smaller.load(f.getvalue())
+        assert len(smaller) == 50
+        assert all(smaller.peek(fprint) in (i % 4, None) for i, fprint in enumerate(fprints))
+
+        # dump placed after other data
+        shifted = cache_class(200)
+        shifted.load('header' + f.getvalue(), 6)
+        assert len(shifted) == 100
+
+    # compact cache arrays are written big-endian, whatever the host byte order is
+    cache = CompactStateCache(200)
+    cache[fprints[0]] = 1
+    f = BytesIO()
+    cache.dump(f)
+    slot = [i for i, value in enumerate(cache._values) if value][0]
+    assert f.getvalue()[4 + slot * 4:8 + slot * 4] == pack('>I', cache._hi[slot])
+
+
+def test_bloom_filter_dump_load():
+    bf = FingerprintBloomFilter(1000, 0.01)
+    fprints = [sha1(str(i)).hexdigest() for i in xrange(100)]
+    for fprint in fprints:
+        bf.add(fprint)
+    f = BytesIO()
+    bf.dump(f)
+
+    loaded = FingerprintBloomFilter(1000, 0.01)
+    assert loaded.load('header' + f.getvalue(), 6)
+    assert loaded.count == 100
+    assert all(fprint in loaded for fprint in fprints)
+    # filter of other size can't be loaded
+    assert not FingerprintBloomFilter(2000, 0.01).load(f.getvalue())
+    with raises(ValueError):
+        loaded.load(f.getvalue()[:-1])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from frontera.core.models import Request, Response
+
+from pytest import raises
+
+from distributed_frontera.backends.remote.codecs import compact, framing
+from distributed_frontera.backends.remote.codecs.msgpack import Encoder, Decoder
+
+
+class Cookie(object):
+    def __init__(self):
+        self.name = 'session'
+        self.values = ('a', 1)
+
+
+def test_msgpack_request_meta():
+    encoder = Encoder(Request)
+    decoder = Decoder(Request, Response)
+    meta = {'fingerprint': 'ab' * 20, 'jid': 1, 'score': 0.5, 'state': None,
+            'domain': {'name': 'example.com', 'fingerprint': 'cd' * 20}}
+    request = Request('http://example.com/', meta=meta)
+    assert decoder.decode_request(encoder.encode_request(request)).meta == meta
+
+    meta['cookie'] = Cookie()
+    meta['redirect_urls'] = ['http://example.com/a']
+    decoded = decoder.decode_request(encoder.encode_request(request))
+    assert decoded.meta['cookie'] == {'name': 'session', 'values': ['a', 1]}
+    assert decoded.meta['redirect_urls'] == ['http://example.com/a']
+    assert decoded.meta['domain'] == meta['domain']
+    assert isinstance(meta['cookie'], Cookie)
+
+
+def test_compact_codec():
+    encoder = compact.Encoder(Request)
+    decoder = compact.Decoder(Request, Response)
+    fingerprint = 'ab' * 20
+    message = encoder.encode_update_score(fingerprint, 0.25, u'http://example.com/\u00e9', False)
+    assert message.startswith(compact.MAGIC)
+    assert decoder.decode(message) == ('update_score', fingerprint, 0.25, 'http://example.com/\xc3\xa9', False)
+
+    meta = {'fingerprint': fingerprint, 'jid': 1, 'score': 0.5, 'custom': [1, 2],
+            'domain': {'name': 'example.com', 'fingerprint': 'cd' * 20}}
+    request = Request('http://example.com/', meta=meta)
+    message = encoder.encode_request(request)
+    assert len(message) < len(Encoder(Request).encode_request(request))
+    for decoded in (decoder.decode_request(message), decoder.decode(message)[1]):
+        assert decoded.url == request.url
+        assert decoded.meta == meta
+
+    # compact decoder reads plain msgpack messages, produced by older encoders or version 0
+    for legacy in (Encoder(Request), compact.Encoder(Request, version=0)):
+        assert decoder.decode_request(legacy.encode_request(request)).meta == meta
+        assert decoder.decode(legacy.encode_update_score(fingerprint, 0.25, 'http://example.com/', True)) == \
+            ('update_score', fingerprint, 0.25, 'http://example.com/', True)
+
+    newer = compact.MAGIC + chr(compact.VERSION + 1) + message[3:]
+    with raises(TypeError):
+        decoder.decode(newer)
+    with raises(ValueError):
+        decoder.decode_request(newer)
+    with raises(ValueError):
+        compact.Encoder(Request, version=compact.VERSION + 1)
+
+
+def test_framing():
+    records = ['a' * 10, '', 'b' * 300]
+    frame = framing.pack_frame(records)
+    assert framing.is_frame(frame)
+    assert list(framing.iter_records(frame)) == records
+    assert list(framing.iter_records('plain message')) == ['plain message']
+    with raises(ValueError):
+        list(framing.iter_records(frame[:-1]))
+
+    framer = framing.Framer(64)
+    assert framer.add(0, 'k1', 'x' * 20) is None
+    assert framer.add(1, 'k2', 'y' * 20) is None
+    assert framer.add(0, 'k3', 'z' * 20) is None
+    key, full = framer.add(0, 'k4', 'w' * 20)
+    assert key == 'k1' and list(framing.iter_records(full)) == ['x' * 20, 'z' * 20]
+    assert len(full) <= 64
+    flushed = dict(framer.flush())
+    assert list(framing.iter_records(flushed['k2'])) == ['y' * 20]
+    assert list(framing.iter_records(flushed['k4'])) == ['w' * 20]
+    assert framer.flush() == []
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+from hashlib import sha1
+from logging import getLogger
+
+from pytest import raises
+
+from frontera import FrontierManager
+from frontera.core.models import Request
+
+from distributed_frontera.backends.cache import FingerprintBloomFilter
+from distributed_frontera.backends.hbase import HBaseQueue, HBaseCellQueue, HBaseState, StateFlusher
+from distributed_frontera.settings import Settings
+from distributed_frontera.stubs import hbase
+from distributed_frontera.stubs.hbase import Connection, MemoryCluster, Table
+
+logger = getLogger("test")
+
+
+def get_links(count, hosts):
+    links = []
+    for i in xrange(count):
+        host = 'host%d.com' % (i % hosts)
+        url = 'http://%s/%d' % (host, i)
+        links.append((1.0 / (1 + i % 5), sha1(url).hexdigest(), {'name': host}, url))
+    return links
+
+
+def test_stub_scan_and_delete():
+    connection = Connection(table_prefix='crawler', table_prefix_separator=':', cluster=MemoryCluster())
+    connection.create_table('t', {'f': {}, 's': {}})
+    assert connection.tables() == ['t']
+    table = connection.table('t')
+    with table.batch(transaction=True) as b:
+        for i in range(10):
+            b.put('%d_%d' % (i % 2, i), {'f:a': str(i), 's:b': 'x'})
+    assert [rk for rk, _ in table.scan(row_prefix='1_')] == ['1_1', '1_3', '1_5', '1_7', '1_9']
+    assert [rk for rk, _ in table.scan(row_start='0_4', limit=2)] == ['0_4', '0_6']
+    table.delete('1_1', columns=['f:a'])
+    assert table.row('1_1') == {'s:b': 'x'}
+    table.delete('1_1', columns=['s'])
+    assert table.rows(['1_1', '1_3'], columns=['f:a']) == [('1_3', {'f:a': '3'})]
+    try:
+        with table.batch(transaction=True) as b:
+            b.delete('1_3')
+            raise ValueError
+    except ValueError:
+        pass
+    assert table.row('1_3')
+
+
+def test_queue_get_respects_limits():
+    for queue_class in (HBaseQueue, HBaseCellQueue):
+        queue = queue_class(Connection(cluster=MemoryCluster()), 1, logger, 'queue')
+        links = get_links(300, 30)
+        queue.schedule(links)
+        results = queue.get(0, 50, min_hosts=10, max_requests_per_host=5)
+        assert len(results) >= 50
+        total = len(results)
+        while results:
+            results = queue.get(0, 50, min_hosts=10, max_requests_per_host=5)
+            total += len(results)
+        assert total == 300
+
+
+def test_backend_reads_partitions_concurrently():
+    hbase.cluster.reset()
+    manager = FrontierManager.from_settings(Settings(attributes={
+        'BACKEND': 'distributed_frontera.backends.hbase.HBaseBackend',
+        'HBASE_CONNECTION': 'distributed_frontera.stubs.hbase.Connection',
+        'HBASE_QUEUE_PARTITIONS': 8,
+        'HBASE_QUEUE_GET_CONCURRENCY': 4,
+        'LOGGING_ENABLED': False
+    }))
+    backend = manager.backend
+    links = get_links(300, 30)
+    backend.queue.schedule(links)
+    requests = backend.get_next_requests(1000, partitions=[0, 1, 2, 3, 4, 5, 6])
+    fingerprints = set(request.meta['fingerprint'] for request in requests)
+    assert len(fingerprints) == len(requests)
+    requests = list(backend.iter_next_requests(1000, partitions=range(8)))
+    fingerprints.update(request.meta['fingerprint'] for request in requests)
+    assert fingerprints == set(fingerprint for _, fingerprint, _, _ in links)
+    manager.stop()
+
+
+def test_backend_puts_back_requests_not_handed_out():
+    hbase.cluster.reset()
+    manager = FrontierManager.from_settings(Settings(attributes={
+        'BACKEND': 'distributed_frontera.backends.hbase.HBaseBackend',
+        'HBASE_CONNECTION': 'distributed_frontera.stubs.hbase.Connection',
+        'HBASE_QUEUE_PARTITIONS': 4,
+        'HBASE_QUEUE_GET_CONCURRENCY': 2,
+        'LOGGING_ENABLED': False
+    }))
+    backend = manager.backend
+    links = get_links(100, 20)
+    backend.queue.schedule(links)
+    get = backend.queue.get
+
+    def failing_get(partition_id, *args, **kwargs):
+        if partition_id == 3:
+            raise IOError("Thrift connection lost")
+        return get(partition_id, *args, **kwargs)
+    backend.queue.get = failing_get
+    # all partitions are read by the pool, but only one request is taken
+    iterator = backend.iter_next_requests(1000, partitions=range(4))
+    fingerprints = set([next(iterator).meta['fingerprint']])
+    iterator.close()
+
+    # error in one partition doesn't affect the others, and requests read, but not taken, aren't lost
+    backend.queue.get = get
+    fingerprints.update(request.meta['fingerprint'] for request in backend.get_next_requests(1000,
+                                                                                              partitions=range(4)))
+    assert fingerprints == set(fingerprint for _, fingerprint, _, _ in links)
+    manager.stop()
+
+
+def test_cell_queue_returns_exact_batch():
+    queue = HBaseCellQueue(Connection(cluster=MemoryCluster()), 2, logger, 'queue')
+    queue.schedule(get_links(500, 50))
+    returned = set()
+    for partition_id in (0, 1):
+        results = queue.get(partition_id, 40, min_hosts=20, max_requests_per_host=4)
+        assert len(results) == 40
+        hosts = {}
+        for fingerprint, url, score in results:
+            host = url.split('/')[2]
+            hosts[host] = hosts.get(host, 0) + 1
+        assert max(hosts.values()) <= 4
+        assert len(hosts) >= 20
+        returned.update(fingerprint for fingerprint, _, _ in results)
+    assert len(returned) == 80
+
+
+def test_state_flush_and_fetch():
+    cluster = MemoryCluster()
+    connection = Connection(cluster=cluster)
+    connection.create_table('metadata', {'s': {}})
+    requests = [Request('http://host.com/%d' % i, meta={'fingerprint': sha1(str(i)).hexdigest()})
+                for i in range(20)]
+    fingerprints = [r.meta['fingerprint'] for r in requests]
+
+    flusher = StateFlusher(Connection(cluster=cluster), 'metadata', logger, 2, chunk_size=8)
+    state = HBaseState(connection, 'metadata', logger, 10, flusher=flusher)
+    state.fetch(fingerprints)
+    state.update(requests, False)
+    assert all(r.meta['state'] is None for r in requests)
+    for r in requests:
+        r.meta['state'] = 1
+    state.update(requests, True)
+    state.close()
+    assert len(list(connection.table('metadata').scan())) == 20
+
+    state = HBaseState(connection, 'metadata', logger, 100,
+                       fetch_connections=[Connection(cluster=cluster) for _ in range(3)])
+    state.fetch(fingerprints)
+    for r in requests:
+        r.meta['state'] = None
+    state.update(requests, False)
+    assert all(r.meta['state'] == 1 for r in requests)
+    state.update(requests, True)
+    assert state.get_stats()['dirty'] == 0
+    state.close()
+
+
+def test_state_filter_skips_unknown_fingerprints():
+    cluster = MemoryCluster()
+    connection = Connection(cluster=cluster)
+    connection.create_table('metadata', {'s': {}})
+    known = [sha1('known %d' % i).hexdigest() for i in range(10)]
+    unknown = [sha1('unknown %d' % i).hexdigest() for i in range(10)]
+    with connection.table('metadata').batch() as b:
+        for fprint in known:
+            b.put(fprint.decode('hex'), {'s:state': '\x02'})
+
+    state = HBaseState(connection, 'metadata', logger, 100, known_filter=FingerprintBloomFilter(1000, 0.001),
+                       filter_connection=Connection(cluster=cluster))
+    # the filter isn't ready before the rebuild, so nothing is skipped
+    state.fetch(unknown[:5])
+    assert state.get_stats()['filter_avoided_reads'] == 0
+    state.start_filter_rebuild()
+    state._rebuild_thread.join()
+    added = Request('http://host.com/added', meta={'fingerprint': sha1('added').hexdigest(), 'state': 1})
+    state.update([added], True)
+
+    state.fetch(known + unknown + [added.meta['fingerprint']])
+    stats = state.get_stats()
+    assert stats['filter_ready']
+    assert stats['filter_avoided_reads'] == 10
+    requests = [Request('http://host.com/%s' % fprint, meta={'fingerprint': fprint}) for fprint in known + unknown]
+    state.update(requests, False)
+    assert [r.meta['state'] for r in requests] == [2] * 10 + [None] * 10
+    state.close()
+
+
+def test_state_snapshot(tmpdir):
+    cluster = MemoryCluster()
+    connection = Connection(cluster=cluster)
+    connection.create_table('metadata', {'s': {}})
+    requests = [Request('http://host.com/%d' % i, meta={'fingerprint': sha1(str(i)).hexdigest(), 'state': 2})
+                for i in range(10)]
+    state = HBaseState(connection, 'metadata', logger, 100, known_filter=FingerprintBloomFilter(1000, 0.001))
+    state.start_filter_rebuild()
+    state.update(requests, True)
+    path = str(tmpdir.join('states'))
+    state.snapshot(path, 42)
+    state.close()
+
+    # the cache and the filter are restored, and the offset of the snapshot is returned
+    state = HBaseState(connection, 'metadata', logger, 100, known_filter=FingerprintBloomFilter(1000, 0.001))
+    assert state.load_snapshot(path) == 42
+    assert state.get_stats()['filter_ready']
+    # the filter from snapshot is rebuilt as usual, to learn states written by others since then
+    other = sha1('other').hexdigest()
+    with connection.table('metadata').batch() as b:
+        b.put(other.decode('hex'), {'s:state': '\x01'})
+    state.start_filter_rebuild()
+    assert other in state._known
+    for r in requests:
+        r.meta['state'] = None
+    state.update(requests, False)
+    assert all(r.meta['state'] == 2 for r in requests)
+
+    state.close()
+
+    # filter older than refresh interval isn't used
+    state = HBaseState(connection, 'metadata', logger, 100, known_filter=FingerprintBloomFilter(1000, 0.001),
+                       filter_refresh_interval=0.0)
+    assert state.load_snapshot(path) == 42
+    assert not state.get_stats()['filter_ready']
+    state.close()
+
+    # broken snapshots are ignored
+    state = HBaseState(connection, 'metadata', logger, 100, known_filter=FingerprintBloomFilter(1000, 0.001))
+    assert state.load_snapshot(str(tmpdir.join('missing'))) is None
+    data = tmpdir.join('states').read('rb')
+    for broken in ('', data[:10], data[:-1]):
+        tmpdir.join('broken').write(broken, 'wb')
+        assert state.load_snapshot(str(tmpdir.join('broken'))) is None
+        assert not state.get_stats()['filter_ready']
+        assert len(state._state_cache) == 0
+
+
+def test_state_filter_learns_other_workers_states():
+    cluster = MemoryCluster()
+    connection = Connection(cluster=cluster)
+    connection.create_table('metadata', {'s': {}})
+    first = HBaseState(connection, 'metadata', logger, 100, known_filter=FingerprintBloomFilter(1000, 0.001),
+                       filter_refresh_interval=60.0)
+    second = HBaseState(Connection(cluster=cluster), 'metadata', logger, 100)
+    first.start_filter_rebuild()
+    fprint = sha1('link').hexdigest()
+    second.update([Request('http://host.com/link', meta={'fingerprint': fprint, 'state': 1})], True)
+    second.flush(False)
+
+    # the state is written after the rebuild, so the filter can't know it until it's refreshed
+    first.fetch([fprint])
+    assert first.get_stats()['filter_avoided_reads'] == 1
+    # the filter is rebuilt after half of refresh interval, and states of all workers are seen again
+    first._rebuild_time -= 30.0
+    first._known_time -= 30.0
+    first.fetch([fprint])
+    request = Request('http://host.com/link', meta={'fingerprint': fprint})
+    first.update([request], False)
+    assert request.meta['state'] == 1
+    assert first.get_stats()['filter_ready']
+
+    # filter older than refresh interval isn't used, even if it's rebuild didn't finish
+    first._state_cache.clear()
+    first._filter_connection = Connection(cluster=cluster)
+    first._rebuild_time -= 60.0
+    first._known_time -= 60.0
+    first._rebuild_stop.set()
+    first.fetch([sha1('unknown').hexdigest(), fprint])
+    assert first.get_stats()['filter_avoided_reads'] == 1
+    first.update([request], False)
+    assert request.meta['state'] == 1
+    first.close()
+    second.close()
+
+
+class CountingConnection(Connection):
+    def __init__(self, *args, **kwargs):
+        super(CountingConnection, self).__init__(*args, **kwargs)
+        self.used = 0
+
+    def table(self, name, use_prefix=True):
+        self.used += 1
+        return super(CountingConnection, self).table(name, use_prefix)
+
+
+def test_state_parallel_fetch():
+    cluster = MemoryCluster()
+    connection = Connection(cluster=cluster)
+    connection.create_table('metadata', {'s': {}})
+    fingerprints = [sha1(str(i)).hexdigest() for i in range(1000)]
+    with connection.table('metadata').batch() as b:
+        for i, fprint in enumerate(fingerprints[:900]):
+            b.put(fprint.decode('hex'), {'s:state': chr(i % 4)})
+
+    fetch_connections = [CountingConnection(cluster=cluster) for _ in range(3)]
+    state = HBaseState(connection, 'metadata', logger, 2000, fetch_connections=fetch_connections)
+    state.fetch(fingerprints)
+    # one chunk per connection
+    assert sum(c.used for c in fetch_connections) == 3
+    requests = [Request('http://host.com/%d' % i, meta={'fingerprint': fprint})
+                for i, fprint in enumerate(fingerprints)]
+    state.update(requests, False)
+    assert [r.meta['state'] for r in requests] == [i % 4 for i in range(900)] + [None] * 100
+    state.close()
+
+
+def test_cell_queue_takes_cells_of_row():
+    connection = Connection(cluster=MemoryCluster())
+    queue = HBaseCellQueue(connection, 1, logger, 'queue')
+    # all items of the same host and score, so they are stored in a single row
+    queue.schedule([(0.5, sha1(str(i)).hexdigest(), {'name': 'host.com'}, 'http://host.com/%d' % i)
+                    for i in range(10)])
+    assert len(list(connection.table('queue').scan())) == 1
+    returned = set()
+    for left in (8, 6, 4, 2, 0):
+        results = queue.get(0, 10, max_requests_per_host=2)
+        assert len(results) == 2
+        returned.update(fingerprint for fingerprint, _, _ in results)
+        assert sum(len(cells) for _, cells in connection.table('queue').scan()) == left
+    assert len(returned) == 10
+    assert queue.get(0, 10, max_requests_per_host=2) == []
+
+
+def test_queue_get_limits_requests_per_host():
+    for queue_class in (HBaseQueue, HBaseCellQueue):
+        connection = Connection(cluster=MemoryCluster())
+        queue = queue_class(connection, 1, logger, 'queue')
+        links = get_links(300, 30)
+        queue.schedule(links)
+        returned = []
+        while True:
+            results = queue.get(0, 1000, max_requests_per_host=3)
+            if not results:
+                break
+            hosts = {}
+            for fingerprint, url, score in results:
+                host = url.split('/')[2]
+                hosts[host] = hosts.get(host, 0) + 1
+            assert max(hosts.values()) <= 3
+            returned.extend(fingerprint for fingerprint, _, _ in results)
+        assert sorted(returned) == sorted(fingerprint for _, fingerprint, _, _ in links)
+
+
+def test_queue_adaptive_scan():
+    queue = HBaseQueue(Connection(cluster=MemoryCluster()), 1, logger, 'queue')
+    # every host gets it's own score interval, so a row holds 10 items of a single host
+    queue.schedule([((h + 1) / 100.0, sha1('%d %d' % (h, i)).hexdigest(), {'name': 'host%d.com' % h},
+                     'http://host%d.com/%d' % (h, i)) for h in range(30) for i in range(10)])
+    # the first estimate is 2 rows, so getting 5 hosts requires more tries
+    results = queue.get(0, 2, min_hosts=5)
+    assert len(set(url.split('/')[2] for _, url, _ in results)) >= 5
+    # density learned in the scan makes the next estimate cover min_hosts at once
+    assert queue._estimate_limit(0, 2, 5) >= 5
+    results = queue.get(0, 2, min_hosts=5)
+    assert len(set(url.split('/')[2] for _, url, _ in results)) >= 5
+
+
+class FailingConnection(Connection):
+    """
+    Connection failing the first ``failures`` batch sends.
+    """
+    def __init__(self, failures, *args, **kwargs):
+        super(FailingConnection, self).__init__(*args, **kwargs)
+        self.failures = failures
+
+    def table(self, name, use_prefix=True):
+        return FailingTable(name, self)
+
+
+class FailingTable(Table):
+    def batch(self, timestamp=None, batch_size=None, transaction=False, wal=True):
+        batch = super(FailingTable, self).batch(timestamp, batch_size, transaction, wal)
+        send = batch.send
+
+        def failing_send():
+            if self.connection.failures:
+                self.connection.failures -= 1
+                raise IOError("Thrift connection lost")
+            send()
+        batch.send = failing_send
+        return batch
+
+
+def test_flusher_keeps_failed_states(tmpdir):
+    cluster = MemoryCluster()
+    connection = Connection(cluster=cluster)
+    connection.create_table('metadata', {'s': {}})
+    flusher_connection = FailingConnection(4, cluster=cluster)
+    flusher = StateFlusher(flusher_connection, 'metadata', logger, 2, chunk_size=8)
+    flusher.RETRY_BACKOFF = 0.0
+    state = HBaseState(connection, 'metadata', logger, 100, flusher=flusher)
+    requests = [Request('http://host.com/%d' % i, meta={'fingerprint': sha1(str(i)).hexdigest(), 'state': 2})
+                for i in range(5)]
+    fingerprints = [r.meta['fingerprint'] for r in requests]
+    state.update(requests, True)
+
+    # all three tries of the chunk fail, states stay pending and snapshot isn't written
+    path = str(tmpdir.join('states'))
+    with raises(IOError):
+        state.snapshot(path, 10)
+    assert not tmpdir.join('states').exists()
+    assert state.get_stats()['flush_failed'] == 5
+    assert all(flusher.get(fprint) == 2 for fprint in fingerprints)
+    assert list(connection.table('metadata').scan()) == []
+
+    # the chunk is submitted again, and written on the second try
+    state.snapshot(path, 10)
+    assert tmpdir.join('states').exists()
+    assert len(list(connection.table('metadata').scan())) == 5
+    assert state.get_stats()['flush_pending'] == 0
+
+    # chunk failed during close is submitted once again, and fails again
+    flusher_connection.failures = 6
+    state.update([Request('http://host.com/x', meta={'fingerprint': sha1('x').hexdigest(), 'state': 1})], True)
+    with raises(IOError):
+        state.close()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from struct import pack
+from time import sleep
+
+from pytest import raises
+
+from frontera import FrontierManager, Settings
+from frontera.core.models import Request
+from kafka import SimpleConsumer, KeyedProducer, SimpleProducer
+from kafka.codec import snappy_encode
+from kafka.common import ProduceResponse, MessageSizeTooLargeError, ConsumerFetchSizeTooSmall, Message
+from kafka.protocol import CODEC_SNAPPY, KafkaProtocol, create_message
+
+from distributed_frontera.backends.remote.codecs.msgpack import Encoder
+from distributed_frontera.backends.remote.producer import AsyncProducer
+from distributed_frontera.stubs import kafka
+from distributed_frontera.stubs.kafka import KafkaClient, MemoryBroker
+from distributed_frontera.worker.consumer import AdaptiveConsumer
+from distributed_frontera.worker.offsets import Fetcher
+from distributed_frontera.worker.partitioner import Crc32NamePartitioner
+
+
+def test_stub_produce_consume_and_lags():
+    broker = MemoryBroker()
+    broker.create_topic('todo', 2)
+    client = KafkaClient('localhost:9092', broker=broker)
+    producer = KeyedProducer(client, partitioner=Crc32NamePartitioner, codec=CODEC_SNAPPY)
+    for i in xrange(50):
+        producer.send_messages('todo', 'host%d' % (i % 5), 'message %d' % i)
+
+    consumer_client = KafkaClient('localhost:9092', broker=broker)
+    consumers = [SimpleConsumer(consumer_client, 'group', 'todo', partitions=[p], auto_commit=False,
+                                buffer_size=64, max_buffer_size=4096) for p in (0, 1)]
+    fetcher = Fetcher(consumer_client, 'todo', 'group')
+    assert fetcher.get() == {0: 0.0, 1: 0.0}
+
+    values = []
+    for consumer in consumers:
+        values.extend(m.message.value for m in consumer.get_messages(count=10, block=True, timeout=0.1))
+        consumer.commit()
+    assert len(values) == 20
+
+    lags = fetcher.get()
+    assert sum(lags.values()) == 30
+    for consumer in consumers:
+        values.extend(m.message.value for m in consumer.get_messages(count=100, block=True, timeout=0.1))
+        consumer.commit()
+    assert sorted(values) == sorted('message %d' % i for i in xrange(50))
+    assert fetcher.get() == {0: 0, 1: 0}
+    assert broker.get_stats()['todo']['messages'] == 50
+
+
+def test_fetcher_caches_and_tracks_produced_offsets():
+    broker = MemoryBroker()
+    broker.create_topic('todo', 2)
+    client = KafkaClient('localhost:9092', broker=broker)
+    producer = KeyedProducer(client, partitioner=Crc32NamePartitioner)
+    producer.send_messages('todo', 'host', *['message %d' % i for i in xrange(10)])
+    partition = Crc32NamePartitioner([0, 1]).partition('host')
+    consumer = SimpleConsumer(client, 'group', 'todo', partitions=[partition], auto_commit=False)
+    assert len(consumer.get_messages(count=4, block=True, timeout=0.1)) == 4
+    consumer.commit()
+
+    cached = Fetcher(client, 'todo', 'group', ttl=60.0)
+    tracking = Fetcher(client, 'todo', 'group', ttl=60.0, track_produced=True)
+    assert cached.get()[partition] == tracking.get()[partition] == 6
+    responses = producer.send_messages('todo', 'host', 'message 10', 'message 11')
+    tracking.produced(responses, 2)
+    assert cached.get()[partition] == 6
+    assert tracking.get()[partition] == 8
+    assert Fetcher(client, 'todo', 'group').get()[partition] == 8
+
+
+def test_stub_resumes_from_committed_offset():
+    broker = MemoryBroker()
+    client = KafkaClient('localhost:9092', broker=broker)
+    client.load_metadata_for_topics('done')
+    producer = KeyedProducer(client, partitioner=Crc32NamePartitioner)
+    producer.send_messages('done', 'key', *['%d' % i for i in xrange(10)])
+
+    consumer = SimpleConsumer(client, 'group', 'done', auto_commit=False)
+    assert [m.message.value for m in consumer.get_messages(count=4)] == ['0', '1', '2', '3']
+    consumer.commit()
+    consumer = SimpleConsumer(KafkaClient('localhost:9092', broker=broker), 'group', 'done', auto_commit=False)
+    assert consumer.offsets[0] == 4
+    assert [m.message.value for m in consumer.get_messages(count=10)] == [str(i) for i in xrange(4, 10)]
+
+
+def test_async_producer_batches_and_reports_delivery():
+    broker = MemoryBroker()
+    broker.create_topic('done', 2)
+    delivered = []
+    producer = AsyncProducer(KafkaClient('localhost:9092', broker=broker), 'done', Crc32NamePartitioner,
+                             batch_size=1024, linger=60.0, callback=lambda *args: delivered.append(args))
+    for i in xrange(10):
+        producer.send('host%d' % i, 'message %d' % i)
+    producer.flush()
+    assert sorted(delivered) == sorted(('host%d' % i, 'message %d' % i, None) for i in xrange(10))
+    assert producer.buffered == 0
+
+    # batch size is reached by first 6 messages without waiting for linger time, the rest is sent on stop
+    for i in xrange(10):
+        producer.send('host%d' % i, 'x' * 200)
+    consumer = SimpleConsumer(KafkaClient('localhost:9092', broker=broker), 'group', 'done', auto_commit=False)
+    assert len(consumer.get_messages(count=16, block=True, timeout=5.0)) == 16
+    producer.stop()
+    assert len(delivered) == 20
+    assert broker.get_stats()['done']['messages'] == 20
+
+
+class FailingClient(KafkaClient):
+    def send_produce_request(self, payloads=[], **kwargs):
+        return [ProduceResponse(payload.topic, payload.partition, MessageSizeTooLargeError.errno, -1)
+                for payload in payloads]
+
+
+def test_async_producer_drops_on_fatal_errors():
+    broker = MemoryBroker()
+    errors = []
+    producer = AsyncProducer(FailingClient('localhost:9092', broker=broker), 'done', Crc32NamePartitioner,
+                             linger=0.0, retry_backoff=0.0)
+    producer.send('host', 'message', callback=lambda key, message, error: errors.append(error))
+    producer.stop()
+    assert len(errors) == 1 and isinstance(errors[0], MessageSizeTooLargeError)
+
+
+def test_kafka_backend_prefetch():
+    kafka.broker.reset()
+    kafka.broker.create_topic('frontier-todo', 1)
+    encoder = Encoder(Request)
+    producer = SimpleProducer(KafkaClient('localhost:9092'))
+    producer.send_messages('frontier-todo', *[encoder.encode_request(
+        Request('http://example.com/%d' % i, meta={'fingerprint': '%040x' % i})) for i in xrange(30)])
+
+    manager = FrontierManager.from_settings(Settings(attributes={
+        'BACKEND': 'distributed_frontera.backends.remote.KafkaBackend',
+        'KAFKA_CLIENT': 'distributed_frontera.stubs.kafka.KafkaClient',
+        'KAFKA_LOCATION': 'localhost:9092',
+        'KAFKA_GET_TIMEOUT': 0.1,
+        'KAFKA_PREFETCH': 10,
+        'SPIDER_PARTITION_ID': 0,
+        'LOGGING_ENABLED': False
+    }))
+    backend = manager.backend
+    for _ in xrange(50):
+        if backend.stats['prefetch_buffer'] == 10:
+            break
+        sleep(0.05)
+    assert backend.stats['prefetch_buffer'] == 10
+    urls = [request.url for request in backend.get_next_requests(4)]
+    assert urls == ['http://example.com/%d' % i for i in xrange(4)]
+    for _ in xrange(100):
+        urls.extend(request.url for request in backend.get_next_requests(30))
+        if len(urls) == 30:
+            break
+        sleep(0.01)
+    assert urls == ['http://example.com/%d' % i for i in xrange(30)]
+    manager.stop()
+    assert not backend._prefetch_thread.is_alive()
+    assert backend.stats['prefetch_dropped'] == 0
+
+    # restart after stop starts new thread, and requests buffered, but not handed out, are counted on stop
+    producer.send_messages('frontier-todo', *[encoder.encode_request(
+        Request('http://example.com/%d' % i, meta={'fingerprint': '%040x' % i})) for i in xrange(30, 35)])
+    backend.frontier_start()
+    for _ in xrange(50):
+        if backend.stats['prefetch_buffer'] == 5:
+            break
+        sleep(0.05)
+    backend.frontier_stop()
+    assert not backend._prefetch_thread.is_alive()
+    assert backend.stats['prefetch_dropped'] == 5
+    assert backend.stats['prefetch_buffer'] == 0
+
+
+def test_adaptive_consumer_keeps_fetch_size():
+    broker = MemoryBroker()
+    client = KafkaClient('localhost:9092', broker=broker)
+    client.load_metadata_for_topics('done')
+    producer = KeyedProducer(client, partitioner=Crc32NamePartitioner)
+    for i in xrange(20):
+        producer.send_messages('done', 'key', 'x' * 3000)
+
+    consumer = AdaptiveConsumer(client, 'group', 'done', auto_commit=False, buffer_size=1024, max_buffer_size=65536)
+    values = []
+    for _ in xrange(20):
+        values.extend(consumer.get_messages(count=1))
+    assert len(values) == 20
+    # 1024 -> 2048 -> 4096 once, then fetches are sized after the biggest message
+    assert consumer.stats['refetches'] == 2
+    assert consumer.stats['max_message_size'] > 3000
+    assert consumer.stats['fetch_sizes'][0] >= 2 * 3000
+
+    # as with SimpleConsumer, message bigger than max_buffer_size is an error
+    producer.send_messages('done', 'key', 'x' * 100000)
+    with raises(ConsumerFetchSizeTooSmall):
+        consumer.get_messages(count=1)
+
+
+class CompressedSetClient(KafkaClient):
+    """
+    Serves messages of partition 0 as compressed message sets of 100 messages each, like real broker does with
+    messages produced with compression.
+    """
+    def _fetch(self, payloads, max_wait_time, min_bytes):
+        responses = []
+        for payload in payloads:
+            data = b''
+            for first in xrange(payload.offset - payload.offset % 100, 1000, 100):
+                inner = b''.join(pack('>qi', offset, len(encoded)) + encoded
+                                 for offset, encoded in ((offset, KafkaProtocol._encode_message(
+                                     create_message('x' * 1000))) for offset in xrange(first, first + 100)))
+                encoded = KafkaProtocol._encode_message(Message(0, CODEC_SNAPPY, None, snappy_encode(inner)))
+                data += pack('>qi', first + 99, len(encoded)) + encoded
+            responses.append((payload.topic, payload.partition, 0, 1000, data[:payload.max_bytes]))
+        return responses
+
+
+def test_adaptive_consumer_measures_compressed_sets():
+    broker = MemoryBroker()
+    broker.create_topic('done', 1)
+    client = CompressedSetClient('localhost:9092', broker=broker)
+    consumer = AdaptiveConsumer(client, 'group', 'done', auto_commit=False, buffer_size=4096, max_buffer_size=1048576)
+    values = []
+    for _ in xrange(10):
+        values.extend(consumer.get_messages(count=100))
+    assert len(values) == 1000
+    assert [m.offset for m in values] == range(1000)
+    # every set is 100k decompressed, but only few kilobytes on the wire, so fetch size stays small
+    assert 5000 < consumer.stats['max_message_size'] < 10000
+    assert consumer.stats['fetch_sizes'][0] < 65536
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from frontera.core.models import Request
+
+from distributed_frontera.backends.remote.overused import OverusedBuffer
+
+
+class Source(object):
+    def __init__(self, urls):
+        self.requests = [Request(url) for url in urls]
+
+    def get_next_requests(self, max_n_requests, **kwargs):
+        requests, self.requests = self.requests[:max_n_requests], self.requests[max_n_requests:]
+        return requests
+
+
+def urls(requests):
+    return [request.url for request in requests]
+
+
+def test_overused_buffer_round_robin():
+    source = Source(['http://a.com/1', 'http://b.com/1', 'http://a.com/2', 'http://c.com/1', 'http://a.com/3',
+                     'http://b.com/2'])
+    buffer = OverusedBuffer(source.get_next_requests)
+    assert urls(buffer.get_next_requests(6, overused_keys=['a.com', 'b.com'], key_type='domain')) == \
+        ['http://c.com/1']
+    assert len(buffer) == 5
+
+    assert urls(buffer.get_next_requests(3, overused_keys=['b.com'], key_type='domain')) == \
+        ['http://a.com/1', 'http://a.com/2', 'http://a.com/3']
+    source.requests = [Request('http://d.com/1')]
+    assert urls(buffer.get_next_requests(10, overused_keys=[], key_type='domain')) == \
+        ['http://b.com/1', 'http://b.com/2', 'http://d.com/1']
+    assert len(buffer) == 0
+
+
+def test_overused_buffer_caps_and_eviction():
+    source = Source(['http://a.com/%d' % i for i in xrange(5)] + ['http://b.com/%d' % i for i in xrange(5)])
+    buffer = OverusedBuffer(source.get_next_requests, max_pending=6, max_per_slot=4)
+    # requests above the caps are passed through despite slot overuse
+    assert urls(buffer.get_next_requests(10, overused_keys=['a.com', 'b.com'], key_type='domain')) == \
+        ['http://a.com/4', 'http://b.com/2', 'http://b.com/3', 'http://b.com/4']
+    assert len(buffer) == 6
+
+    buffer.slot_ttl = 0.0
+    assert urls(buffer.get_next_requests(4, overused_keys=['a.com', 'b.com'], key_type='domain')) == \
+        ['http://a.com/0', 'http://a.com/1', 'http://a.com/2', 'http://a.com/3']
+    assert urls(buffer.get_next_requests(4, overused_keys=['a.com', 'b.com'], key_type='domain')) == \
+        ['http://b.com/0', 'http://b.com/1']
+    assert len(buffer) == 0
+
+
+def test_overused_buffer_slot_key():
+    buffer = OverusedBuffer(None)
+    request = Request('http://WWW.Example.com:8080/', meta={'domain': {'netloc': 'WWW.Example.com:8080'}})
+    assert buffer._get_key(request, 'domain') == 'www.example.com'
+    assert buffer._get_key(Request('http://user@example.com/'), 'domain') == 'example.com'
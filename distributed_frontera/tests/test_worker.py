@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import sys
+from binascii import unhexlify
+from hashlib import sha1
+from time import time, sleep
+
+from frontera.core.models import Request
+from kafka import SimpleProducer
+
+from distributed_frontera.backends.remote.codecs.msgpack import Encoder
+from distributed_frontera.settings import Settings
+from distributed_frontera.stubs import hbase, kafka
+from distributed_frontera.worker.main import FrontierWorker
+from distributed_frontera.worker.supervisor import Supervisor
+
+
+def test_sharded_worker_partitions():
+    kafka.broker.reset()
+    hbase.cluster.reset()
+    kafka.broker.create_topic('frontier-done', 4)
+    kafka.broker.create_topic('frontier-score', 1)
+    settings = Settings(attributes={
+        'BACKEND': 'distributed_frontera.backends.hbase.HBaseBackend',
+        'HBASE_CONNECTION': 'distributed_frontera.stubs.hbase.Connection',
+        'KAFKA_CLIENT': 'distributed_frontera.stubs.kafka.KafkaClient',
+        'KAFKA_LOCATION': 'localhost:9092',
+        'INCOMING_TOPIC': 'frontier-done',
+        'OUTGOING_TOPIC': 'frontier-todo',
+        'SCORING_TOPIC': 'frontier-score',
+        'FRONTIER_GROUP': 'scrapy-crawler',
+        'LOGGING_ENABLED': False
+    })
+    worker = FrontierWorker(settings, False, False, False, shard=1, shards=2)
+    assert sorted(worker._in_consumer.offsets) == [1, 3]
+    # the only scoring partition belongs to shard 0
+    assert worker.slot.disable_scoring_consumption
+    assert not worker.slot.disable_incoming
+    worker.stop()
+
+    worker = FrontierWorker(settings, False, False, False, shard=0, shards=2)
+    assert sorted(worker._in_consumer.offsets) == [0, 2]
+    assert sorted(worker._scoring_consumer.offsets) == [0]
+
+    assert worker._get_shard_partitions('frontier-done') == [0, 2]
+    worker.stop()
+    worker = FrontierWorker(settings, False, False, False, shard=4, shards=5)
+    assert worker._get_shard_partitions('frontier-done') == []
+    # shard without partitions doesn't consume at all, rather than consume all of them
+    assert not hasattr(worker, '_in_consumer')
+    assert 'incoming_consumer' not in worker.stats
+    assert worker.slot.disable_incoming
+    worker.stop()
+    worker = FrontierWorker(settings, False, False, False)
+    assert worker._get_shard_partitions('frontier-done') is None
+    worker.stop()
+
+
+class PartitionsRecorder(object):
+    def __init__(self):
+        self.partitions = None
+
+    def get_next_requests(self, max_next_requests, partitions):
+        self.partitions = partitions
+        return []
+
+
+def test_sharded_worker_new_batch_partitions():
+    kafka.broker.reset()
+    hbase.cluster.reset()
+    kafka.broker.create_topic('frontier-done', 1)
+    kafka.broker.create_topic('frontier-score', 1)
+    kafka.broker.create_topic('frontier-todo', 5)
+    settings = Settings(attributes={
+        'BACKEND': 'distributed_frontera.backends.hbase.HBaseBackend',
+        'HBASE_CONNECTION': 'distributed_frontera.stubs.hbase.Connection',
+        'KAFKA_CLIENT': 'distributed_frontera.stubs.kafka.KafkaClient',
+        'KAFKA_LOCATION': 'localhost:9092',
+        'INCOMING_TOPIC': 'frontier-done',
+        'OUTGOING_TOPIC': 'frontier-todo',
+        'SCORING_TOPIC': 'frontier-score',
+        'FRONTIER_GROUP': 'scrapy-crawler',
+        'MAX_NEXT_REQUESTS': 10,
+        'LOGGING_ENABLED': False
+    })
+    for shard, partitions in [(0, [0, 2, 4]), (1, [1, 3])]:
+        worker = FrontierWorker(settings, False, False, False, shard=shard, shards=2)
+        recorder = worker._batch_backend = PartitionsRecorder()
+        worker.new_batch()
+        assert sorted(recorder.partitions) == partitions
+        worker._batch_backend = worker._backend
+        worker.stop()
+
+
+def test_supervisor_runs_shards():
+    command = lambda shard: [sys.executable, '-c', 'import sys; sys.exit(%d)' % (shard * 3)]
+    assert Supervisor(command, 1, poll_interval=0.05).run()
+    # shard 1 fails right after start, so it isn't restarted
+    supervisor = Supervisor(command, 2, poll_interval=0.05)
+    assert not supervisor.run()
+    assert not supervisor.children
+
+
+def test_pipelined_worker_doesnt_commit_unprocessed():
+    kafka.broker.reset()
+    hbase.cluster.reset()
+    kafka.broker.create_topic('frontier-done', 1)
+    kafka.broker.create_topic('frontier-score', 1)
+    kafka.broker.create_topic('frontier-todo', 1)
+    settings = Settings(attributes={
+        'BACKEND': 'distributed_frontera.backends.hbase.HBaseBackend',
+        'HBASE_CONNECTION': 'distributed_frontera.stubs.hbase.Connection',
+        'HBASE_DROP_ALL_TABLES': True,
+        'KAFKA_CLIENT': 'distributed_frontera.stubs.kafka.KafkaClient',
+        'KAFKA_LOCATION': 'localhost:9092',
+        'INCOMING_TOPIC': 'frontier-done',
+        'OUTGOING_TOPIC': 'frontier-todo',
+        'SCORING_TOPIC': 'frontier-score',
+        'FRONTIER_GROUP': 'scrapy-crawler',
+        'LOGGING_ENABLED': False
+    })
+    worker = FrontierWorker(settings, True, True, False, pipelined=True)
+    calls = []
+
+    def add_seeds(seeds):
+        calls.append(seeds)
+        raise IOError("HBase is down")
+    worker._backend.add_seeds = add_seeds
+
+    producer = SimpleProducer(kafka.KafkaClient('localhost:9092'))
+    seed = Request('http://example.com/', meta={'fingerprint': sha1('http://example.com/').hexdigest()})
+    producer.send_messages('frontier-done', Encoder(Request).encode_add_seeds([seed]))
+    worker.slot.schedule(on_start=True)
+    try:
+        deadline = time() + 10.0
+        while time() < deadline and not calls:
+            sleep(0.05)
+    finally:
+        worker.stop()
+    assert calls
+    # message was read, but it's batch failed, so it's read again after restart
+    assert worker._in_consumer.offsets[0] == 1
+    assert ('scrapy-crawler', 'frontier-done', 0) not in kafka.broker.group_offsets
+
+
+def test_pipelined_worker():
+    kafka.broker.reset()
+    hbase.cluster.reset()
+    kafka.broker.create_topic('frontier-done', 1)
+    kafka.broker.create_topic('frontier-score', 1)
+    kafka.broker.create_topic('frontier-todo', 4)
+    settings = Settings(attributes={
+        'BACKEND': 'distributed_frontera.backends.hbase.HBaseBackend',
+        'HBASE_CONNECTION': 'distributed_frontera.stubs.hbase.Connection',
+        'HBASE_DROP_ALL_TABLES': True,
+        'HBASE_BATCH_SIZE': 1,
+        'KAFKA_CLIENT': 'distributed_frontera.stubs.kafka.KafkaClient',
+        'KAFKA_LOCATION': 'localhost:9092',
+        'INCOMING_TOPIC': 'frontier-done',
+        'OUTGOING_TOPIC': 'frontier-todo',
+        'SCORING_TOPIC': 'frontier-score',
+        'FRONTIER_GROUP': 'scrapy-crawler',
+        'NEW_BATCH_DELAY': 0.05,
+        'MAX_NEXT_REQUESTS': 10,
+        'LOGGING_ENABLED': False
+    })
+    worker = FrontierWorker(settings, False, False, False, pipelined=True)
+    # copies share tables with the main backend, rather than create them again
+    assert worker._scoring_backend is not worker._backend
+    assert worker._scoring_backend.state_checker is None
+    assert worker._batch_backend.connection is not worker._backend.connection
+
+    client = kafka.KafkaClient('localhost:9092')
+    producer = SimpleProducer(client)
+    encoder = Encoder(Request)
+    seed = Request('http://example.com/', meta={'fingerprint': sha1('http://example.com/').hexdigest(),
+                                                 'domain': {'name': 'example.com',
+                                                            'fingerprint': sha1('example.com').hexdigest()}})
+    producer.send_messages('frontier-done', encoder.encode_add_seeds([seed]))
+    producer.send_messages('frontier-score', encoder.encode_update_score(seed.meta['fingerprint'], 0.5, seed.url,
+                                                                         True))
+    worker.slot.schedule(on_start=True)
+    try:
+        deadline = time() + 10.0
+        while time() < deadline and not kafka.broker.get_stats()['frontier-todo']['messages']:
+            sleep(0.05)
+    finally:
+        worker.stop()
+    assert not any(thread.is_alive() for thread in worker.slot._threads)
+
+    assert kafka.broker.get_stats()['frontier-todo']['messages'] == 1
+    assert worker.stats['last_consumed'] >= 1
+    metadata = worker._backend.connection.table(settings.get('HBASE_METADATA_TABLE'))
+    assert unhexlify(seed.meta['fingerprint']) in dict(metadata.scan())
+    # offsets are committed after batches are written to backend
+    assert kafka.broker.group_offsets[('scrapy-crawler', 'frontier-done', 0)][0] == 1
+    assert kafka.broker.group_offsets[('scrapy-crawler', 'frontier-score', 0)][0] == 1
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from functools import partial
+from logging import getLogger
+
+from kafka import SimpleConsumer
+from kafka.common import FetchRequest, ConsumerFetchSizeTooSmall, ConsumerNoMoreData, UnknownTopicOrPartitionError, \
+    NotLeaderForPartitionError, OffsetOutOfRangeError, FailedPayloadsError, BufferUnderflowError, OffsetAndMessage, \
+    OffsetCommitRequest, KafkaError, check_error
+from kafka.protocol import KafkaProtocol
+from kafka.util import relative_unpack, read_int_string, read_short_string
+
+logger = getLogger("adaptive-consumer")
+
+# offset, message size, crc, magic, attributes, key and value lengths
+MESSAGE_OVERHEAD = 26
+
+
+# fetch response with message set left undecoded
+RawFetchResponse = namedtuple("RawFetchResponse", ["topic", "partition", "error", "highwaterMark", "message_set"])
+
+
+def decode_fetch_response(data):
+    """
+    The same as :meth:`kafka.protocol.KafkaProtocol.decode_fetch_response`, but message sets aren't decoded, so
+    their sizes on the wire are known.
+
+    :return: generator of :class:`RawFetchResponse`
+    """
+    ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+    for _ in range(num_topics):
+        (topic, cur) = read_short_string(data, cur)
+        ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+        for _ in range(num_partitions):
+            ((partition, error, highwater_mark_offset), cur) = relative_unpack('>ihq', data, cur)
+            (message_set, cur) = read_int_string(data, cur)
+            yield RawFetchResponse(topic, partition, error, highwater_mark_offset, message_set)
+
+
+def iter_wire_messages(data):
+    """
+    Decodes message set along with the number of bytes messages took in it. Message decoded from compressed message
+    set gets the size of the whole set if it's the first one from it, and 0 otherwise, so sizes add up to the fetched
+    bytes, and not to the decompressed ones.
+
+    :param str data: message set
+    :return: generator of (size, :class:`kafka.common.OffsetAndMessage`) tuples
+    """
+    cur = 0
+    read_message = False
+    while cur < len(data):
+        # the same as KafkaProtocol._decode_message_set_iter, except sizes
+        try:
+            ((offset, ), end) = relative_unpack('>q', data, cur)
+            (encoded, end) = read_int_string(data, end)
+        except BufferUnderflowError:
+            if not read_message:
+                raise ConsumerFetchSizeTooSmall()
+            return
+        size = end - cur
+        cur = end
+        for (offset, message) in KafkaProtocol._decode_message(encoded, offset):
+            read_message = True
+            yield size, OffsetAndMessage(offset, message)
+            size = 0
+
+
+class AdaptiveConsumer(SimpleConsumer):
+    """
+    :class:`kafka.SimpleConsumer` adapting fetch sizes to the sizes of messages in topic.
+
+    SimpleConsumer starts every fetch with ``buffer_size`` and doubles it for the current fetch only, if message
+    doesn't fit, so topics with big messages get most of fetches done several times. Here fetch size is kept per
+    partition: it stays grown after message didn't fit, is kept at least twice as big as the biggest message seen,
+    doubles when fetches are filled for more than three quarters, and shrinks back towards ``buffer_size`` when
+    fetches are using less than a quarter of it. ``max_buffer_size`` is the upper bound, as usual. Sizes are measured
+    as messages are on the wire, so compressed message set counts by its compressed size.
+
+    Number of fetches, refetches caused by too small fetch size, biggest message size and current fetch sizes are
+    available in ``stats`` dict.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AdaptiveConsumer, self).__init__(*args, **kwargs)
+        self._fetch_sizes = {}
+        self._max_message_size = 0
+        self.stats = {
+            'fetches': 0,
+            'refetches': 0,
+            'max_message_size': 0,
+            'fetch_sizes': self._fetch_sizes
+        }
+
+    def commit_offsets(self, offsets):
+        """
+        Commits given offsets instead of the current ones, e.g. offsets of messages already processed, while consumer
+        has read further.
+
+        :param dict offsets: offsets by partition
+        :return: True if offsets were committed
+        """
+        if not offsets:
+            return False
+        reqs = [OffsetCommitRequest(self.topic, partition, offset, None)
+                for partition, offset in offsets.iteritems()]
+        with self.commit_lock:
+            try:
+                self.client.send_offset_commit_request(self.group, reqs)
+            except KafkaError as e:
+                logger.error('%s saving offsets: %s', e.__class__.__name__, e)
+                return False
+        return True
+
+    def _cap(self, size):
+        return size if self.max_buffer_size is None else min(size, self.max_buffer_size)
+
+    def _adapt(self, partition, size, fetched):
+        lower = max(self.buffer_size, self._cap(self._max_message_size * 2))
+        if fetched > size * 3 / 4:
+            size = self._cap(size * 2)
+        elif fetched < size / 4:
+            size = size / 2
+        self._fetch_sizes[partition] = max(size, lower)
+
+    def _fetch(self):
+        # the same as SimpleConsumer._fetch, except sizes handling
+        partitions = dict((p, self._fetch_sizes.get(p, self.buffer_size))
+                          for p in self.fetch_offsets.keys())
+        while partitions:
+            requests = []
+            for partition, buffer_size in partitions.iteritems():
+                requests.append(FetchRequest(self.topic, partition,
+                                             self.fetch_offsets[partition],
+                                             buffer_size))
+            # send_fetch_request decodes message sets right away, so the request is sent with the client method it's
+            # using, but with own decoder, this relies on kafka-python version pinned in requirements
+            encoder = partial(KafkaProtocol.encode_fetch_request,
+                              max_wait_time=int(self.fetch_max_wait_time),
+                              min_bytes=self.fetch_min_bytes)
+            responses = self.client._send_broker_aware_request(requests, encoder, decode_fetch_response)
+            self.stats['fetches'] += len(requests)
+
+            retry_partitions = {}
+            for resp in responses:
+                try:
+                    check_error(resp)
+                except UnknownTopicOrPartitionError:
+                    logger.error('UnknownTopicOrPartitionError for %s:%d', resp.topic, resp.partition)
+                    self.client.reset_topic_metadata(resp.topic)
+                    raise
+                except NotLeaderForPartitionError:
+                    logger.error('NotLeaderForPartitionError for %s:%d', resp.topic, resp.partition)
+                    self.client.reset_topic_metadata(resp.topic)
+                    continue
+                except OffsetOutOfRangeError:
+                    logger.warning('OffsetOutOfRangeError for %s:%d. Resetting partition offset...',
+                                   resp.topic, resp.partition)
+                    self.reset_partition_offset(resp.partition)
+                    retry_partitions[resp.partition] = partitions[resp.partition]
+                    continue
+                except FailedPayloadsError as e:
+                    logger.warning('FailedPayloadsError for %s:%d', e.payload.topic, e.payload.partition)
+                    retry_partitions[e.payload.partition] = partitions[e.payload.partition]
+                    continue
+
+                partition = resp.partition
+                buffer_size = partitions[partition]
+                fetched = 0
+                try:
+                    for size, message in iter_wire_messages(resp.message_set):
+                        fetched += size
+                        if size > self._max_message_size:
+                            self._max_message_size = self.stats['max_message_size'] = size
+                        if message.offset < self.fetch_offsets[partition]:
+                            continue
+                        self.queue.put((partition, message))
+                        self.fetch_offsets[partition] = message.offset + 1
+                except ConsumerFetchSizeTooSmall:
+                    if self.max_buffer_size is not None and buffer_size == self.max_buffer_size:
+                        logger.error('Max fetch size %d too small', self.max_buffer_size)
+                        raise
+                    buffer_size = self._cap(buffer_size * 2)
+                    logger.info('Fetch size too small, increase to %d and retry', buffer_size)
+                    self._fetch_sizes[partition] = retry_partitions[partition] = buffer_size
+                    self.stats['refetches'] += 1
+                    continue
+                except ConsumerNoMoreData:
+                    pass
+                except StopIteration:
+                    pass
+                self._adapt(partition, buffer_size, fetched)
+            partitions = retry_partitions
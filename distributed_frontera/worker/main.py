@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
 import logging
-from argparse import ArgumentParser
+import sys
+from argparse import ArgumentParser, SUPPRESS
+from importlib import import_module
+from Queue import Queue, Empty, Full
+from threading import Thread, Event
 from time import asctime
 
 from twisted.internet import reactor
-from kafka import KafkaClient, KeyedProducer, SimpleConsumer
+from kafka import KeyedProducer
 from kafka.common import OffsetOutOfRangeError
 from kafka.protocol import CODEC_SNAPPY
 from frontera.core.manager import FrontierManager
 from frontera.utils.url import parse_domain_from_url_fast
+from frontera.utils.misc import load_object
 
-from distributed_frontera.backends.remote.codecs.msgpack import Decoder, Encoder
+from distributed_frontera.backends.remote.codecs.framing import Framer, iter_records
 from distributed_frontera.settings import Settings
+from distributed_frontera.worker.consumer import AdaptiveConsumer
 from distributed_frontera.worker.partitioner import Crc32NamePartitioner
+from distributed_frontera.worker.supervisor import Supervisor
 from utils import CallLaterOnce
 from server import WorkerJsonRpcService
 from offsets import Fetcher
@@ -58,115 +65,317 @@ class Slot(object):
         self.scheduling.schedule(5.0)
 
 
-class FrontierWorker(object):
-    def __init__(self, settings, no_batches, no_scoring, no_incoming):
-        self._kafka = KafkaClient(settings.get('KAFKA_LOCATION'))
-        self._producer = KeyedProducer(self._kafka, partitioner=Crc32NamePartitioner, codec=CODEC_SNAPPY)
-
-        self._in_consumer = SimpleConsumer(self._kafka,
-                                       settings.get('FRONTIER_GROUP'),
-                                       settings.get('INCOMING_TOPIC'),
-                                       buffer_size=1048576,
-                                       max_buffer_size=10485760)
+class PipelinedSlot(object):
+    """
+    Runs worker loops on dedicated threads, instead of reactor callbacks, so blocking Kafka and HBase I/O of
+    incoming consumption, scoring consumption and batch generation overlap, and reactor is left to JSON-RPC service.
+    Consumption is split further in reading and decoding from Kafka, and writing to backend, connected with bounded
+    queues of ``queue_size`` batches. Consumers don't auto commit here, offsets of a batch are committed only after
+    it's written to backend.
+    """
+    # seconds to wait for every thread on stop, loops are checking for stop at least every second, unless blocked
+    # in backend or Kafka call
+    stop_timeout = 30.0
+
+    def __init__(self, worker, no_batches, no_scoring, new_batch_delay, no_incoming, queue_size):
+        self.worker = worker
+        self.is_finishing = False
+        self.disable_new_batches = no_batches
+        self.disable_scoring_consumption = no_scoring
+        self.disable_incoming = no_incoming
+        self.new_batch_delay = new_batch_delay
+        self._stopped = Event()
+        self._threads = []
+        self._pipelines = []
+        if not no_incoming:
+            self._add_pipeline("incoming", worker.read_incoming, worker.process_incoming, worker._in_consumer,
+                               queue_size)
         if not no_scoring:
-            self._scoring_consumer = SimpleConsumer(self._kafka,
-                                           settings.get('FRONTIER_GROUP'),
-                                           settings.get('SCORING_TOPIC'),
-                                           buffer_size=262144,
-                                           max_buffer_size=1048576)
+            self._add_pipeline("scoring", lambda: worker.read_scoring(block=True),
+                               lambda item: worker.process_scoring(*item), worker._scoring_consumer, queue_size)
+        self._add_loop("new-batch", self._new_batch)
+
+    def _add_loop(self, name, func):
+        def target():
+            while not self._stopped.is_set():
+                try:
+                    func()
+                except Exception:
+                    logger.exception("Error in %s loop", name)
+                    self._stopped.wait(1.0)
+        thread = Thread(target=target, name=name)
+        thread.daemon = True
+        self._threads.append(thread)
+
+    def _add_pipeline(self, name, read, process, consumer, queue_size):
+        queue = Queue(queue_size)
+        # offsets following the last batch written, it's replaced by writer and read by reader, so no lock is needed
+        pipeline = {'consumer': consumer, 'processed': None, 'committed': None}
+        self._pipelines.append(pipeline)
+        self._add_loop(name + "-reader", self._reader(read, queue, pipeline))
+        self._add_loop(name + "-writer", self._writer(process, queue, pipeline))
+
+    def _commit(self, pipeline):
+        # Kafka client isn't thread-safe, so it's called from reader thread, or after threads are stopped
+        processed = pipeline['processed']
+        if processed is not pipeline['committed'] and pipeline['consumer'].commit_offsets(processed):
+            pipeline['committed'] = processed
+
+    def _reader(self, read, queue, pipeline):
+        consumer = pipeline['consumer']
+
+        def func():
+            self._commit(pipeline)
+            item = (read(), dict(consumer.offsets))
+            while not self._stopped.is_set():
+                try:
+                    queue.put(item, timeout=1.0)
+                    break
+                except Full:
+                    continue
+        return func
 
-        self._offset_fetcher = Fetcher(self._kafka, settings.get('OUTGOING_TOPIC'), settings.get('FRONTIER_GROUP'))
+    def _writer(self, process, queue, pipeline):
+        def func():
+            try:
+                item, offsets = queue.get(timeout=1.0)
+            except Empty:
+                return
+            process(item)
+            pipeline['processed'] = offsets
+        return func
+
+    def _new_batch(self):
+        if not self.disable_new_batches and not self.is_finishing:
+            self.worker.new_batch()
+        self._stopped.wait(self.new_batch_delay)
 
+    def schedule(self, on_start=False):
+        if on_start:
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self):
+        """
+        :return: True if all threads have stopped within ``stop_timeout``
+        """
+        self._stopped.set()
+        stopped = True
+        for thread in self._threads:
+            thread.join(self.stop_timeout)
+            if thread.is_alive():
+                logger.warning("Thread %s didn't stop in %.1f seconds", thread.name, self.stop_timeout)
+                stopped = False
+        if stopped:
+            for pipeline in self._pipelines:
+                self._commit(pipeline)
+        return stopped
+
+
+class FrontierWorker(object):
+    def __init__(self, settings, no_batches, no_scoring, no_incoming, pipelined=False, shard=0, shards=1):
+        self._kafka = load_object(settings.get('KAFKA_CLIENT'))(settings.get('KAFKA_LOCATION'))
         self._manager = FrontierManager.from_settings(settings)
         self._backend = self._manager.backend
-        self._encoder = Encoder(self._manager.request_model)
-        self._decoder = Decoder(self._manager.request_model, self._manager.response_model)
+        if pipelined and not hasattr(self._backend, 'copy'):
+            logger.warning("%s can't be used from several threads, pipelined mode is disabled",
+                           self._backend.__class__.__name__)
+            pipelined = False
+        # sharded worker consumes and generates batches only for partitions having number equal to shard modulo
+        # shards, so that shards can run in separate processes
+        self.shard = shard
+        self.shards = shards
+        in_partitions = self._get_shard_partitions(settings.get('INCOMING_TOPIC'))
+        if in_partitions == []:
+            no_incoming = True
+        scoring_partitions = self._get_shard_partitions(settings.get('SCORING_TOPIC'))
+        if scoring_partitions == []:
+            no_scoring = True
+        # in pipelined mode every loop runs on it's own thread, and Kafka clients and backend connections
+        # aren't thread-safe, so scoring consumption and batch generation get their own, backend copies share
+        # tables with the main backend
+        self._scoring_kafka = self._kafka.copy() if pipelined else self._kafka
+        self._batch_kafka = self._kafka.copy() if pipelined else self._kafka
+        self._scoring_backend = self._backend.copy() if pipelined else self._backend
+        self._batch_backend = self._backend.copy() if pipelined else self._backend
+        self._producer = KeyedProducer(self._batch_kafka, partitioner=Crc32NamePartitioner, codec=CODEC_SNAPPY)
+
+        # empty partitions list would make consumer read all of them
+        if not no_incoming:
+            self._in_consumer = AdaptiveConsumer(self._kafka,
+                                                 settings.get('FRONTIER_GROUP'),
+                                                 settings.get('INCOMING_TOPIC'),
+                                                 partitions=in_partitions,
+                                                 buffer_size=1048576,
+                                                 max_buffer_size=10485760,
+                                                 auto_commit=not pipelined)
+        if not no_scoring:
+            self._scoring_consumer = AdaptiveConsumer(self._scoring_kafka,
+                                                      settings.get('FRONTIER_GROUP'),
+                                                      settings.get('SCORING_TOPIC'),
+                                                      partitions=scoring_partitions,
+                                                      buffer_size=262144,
+                                                      max_buffer_size=1048576,
+                                                      auto_commit=not pipelined)
+
+        self._offset_fetcher = Fetcher(self._batch_kafka, settings.get('OUTGOING_TOPIC'),
+                                       settings.get('FRONTIER_GROUP'),
+                                       ttl=settings.get('KAFKA_LAGS_CACHE_TTL'),
+                                       track_produced=settings.get('KAFKA_LAGS_FROM_PRODUCER'))
+
+        codec = import_module(settings.get('KAFKA_CODEC'))
+        self._encoder = codec.Encoder(self._manager.request_model, version=settings.get('KAFKA_CODEC_VERSION'))
+        self._decoder = codec.Decoder(self._manager.request_model, self._manager.response_model)
 
         self.consumer_batch_size = settings.get('CONSUMER_BATCH_SIZE', 128)
         self.outgoing_topic = settings.get('OUTGOING_TOPIC')
         self.max_next_requests = settings.MAX_NEXT_REQUESTS
-        self.slot = Slot(self.new_batch, self.consume_incoming, self.consume_scoring, no_batches, no_scoring,
-                         settings.get('NEW_BATCH_DELAY', 60.0), no_incoming)
+        self.frame_size = settings.get('KAFKA_FRAME_SIZE')
+        self._outgoing_partitioner = None
+        if pipelined:
+            self.slot = PipelinedSlot(self, no_batches, no_scoring, settings.get('NEW_BATCH_DELAY', 60.0),
+                                      no_incoming, settings.get('PIPELINE_QUEUE_SIZE', 4))
+        else:
+            self.slot = Slot(self.new_batch, self.consume_incoming, self.consume_scoring, no_batches, no_scoring,
+                             settings.get('NEW_BATCH_DELAY', 60.0), no_incoming)
         self.job_id = 0
         self.stats = {}
+        if shards > 1:
+            self.stats['shard'] = shard
+        if not no_incoming:
+            self.stats['incoming_consumer'] = self._in_consumer.stats
+        if not no_scoring:
+            self.stats['scoring_consumer'] = self._scoring_consumer.stats
+
+    def _get_shard_partitions(self, topic):
+        """
+        :return: list of topic partitions of this shard, or None if worker isn't sharded
+        """
+        if self.shards == 1:
+            return None
+        self._kafka.load_metadata_for_topics(topic)
+        return [partition for partition in self._kafka.get_partition_ids_for_topic(topic)
+                if partition % self.shards == self.shard]
 
     def set_process_info(self, process_info):
         self.process_info = process_info
 
     def run(self):
         self.slot.schedule(on_start=True)
+        if isinstance(self.slot, PipelinedSlot):
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
         reactor.run()
 
+    def stop(self):
+        """
+        Stops pipelined slot threads, if any, then backend copies they were using and the main backend.
+        """
+        if isinstance(self.slot, PipelinedSlot) and not self.slot.stop():
+            logger.warning("Stopping backends while worker threads are still running")
+        for backend in (self._scoring_backend, self._batch_backend):
+            if backend is not self._backend:
+                backend.frontier_stop()
+        self._manager.stop()
+
     def consume_incoming(self, *args, **kwargs):
-        consumed = 0
+        consumed = self.process_incoming(self.read_incoming())
+        self.slot.schedule()
+        return consumed
+
+    def read_incoming(self):
+        """
+        :return: list of decoded spider log messages, None for the ones failed to decode
+        """
+        messages = []
         try:
             for m in self._in_consumer.get_messages(count=self.consumer_batch_size, block=True, timeout=1.0):
                 try:
-                    msg = self._decoder.decode(m.message.value)
+                    messages.append(self._decoder.decode(m.message.value))
                 except (KeyError, TypeError), e:
                     logger.error("Decoding error: %s", e)
-                    continue
-                else:
-                    type = msg[0]
-                    if type == 'add_seeds':
-                        _, seeds = msg
-                        logger.info('Adding %i seeds', len(seeds))
-                        for seed in seeds:
-                            logger.debug('URL: ', seed.url)
-                        self._backend.add_seeds(seeds)
-                    if type == 'page_crawled':
-                        _, response, links = msg
-                        logger.debug("Page crawled %s", response.url)
-                        if response.meta['jid'] != self.job_id:
-                            continue
-                        self._backend.page_crawled(response, links)
-                    if type == 'request_error':
-                        _, request, error = msg
-                        if request.meta['jid'] != self.job_id:
-                            continue
-                        logger.info("Request error %s", request.url)
-                        self._backend.request_error(request, error)
-                finally:
-                    consumed += 1
+                    messages.append(None)
         except OffsetOutOfRangeError, e:
             # https://github.com/mumrah/kafka-python/issues/263
             self._in_consumer.seek(0, 2)  # moving to the tail of the log
             logger.info("Caught OffsetOutOfRangeError, moving to the tail of the log.")
+        return messages
+
+    def process_incoming(self, messages):
+        for msg in messages:
+            if msg is None:
+                continue
+            type = msg[0]
+            if type == 'add_seeds':
+                _, seeds = msg
+                logger.info('Adding %i seeds', len(seeds))
+                for seed in seeds:
+                    logger.debug('URL: ', seed.url)
+                self._backend.add_seeds(seeds)
+            if type == 'page_crawled':
+                _, response, links = msg
+                logger.debug("Page crawled %s", response.url)
+                if response.meta['jid'] != self.job_id:
+                    continue
+                self._backend.page_crawled(response, links)
+            if type == 'request_error':
+                _, request, error = msg
+                if request.meta['jid'] != self.job_id:
+                    continue
+                logger.info("Request error %s", request.url)
+                self._backend.request_error(request, error)
 
+        consumed = len(messages)
         logger.info("Consumed %d items.", consumed)
         self.stats['last_consumed'] = consumed
         self.stats['last_consumption_run'] = asctime()
-        self.slot.schedule()
         return consumed
 
     def consume_scoring(self, *args, **kwargs):
+        consumed = self.process_scoring(*self.read_scoring())
+        self.slot.schedule()
+        return consumed
+
+    def read_scoring(self, block=False):
+        """
+        :param bool block: wait for a full batch, for a second at most
+        :return: tuple of dict with score updates by fingerprint, and number of consumed records
+        """
         consumed = 0
+        batch = {}
         try:
-            batch = {}
-            for m in self._scoring_consumer.get_messages(count=1024):
+            for m in self._scoring_consumer.get_messages(count=1024, block=block, timeout=1.0):
                 try:
-                    msg = self._decoder.decode(m.message.value)
-                except (KeyError, TypeError), e:
-                    logger.error("Decoding error: %s", e)
-                    continue
-                else:
-                    if msg[0] == 'update_score':
-                        _, fprint, score, url, schedule = msg
-                        batch[fprint] = (score, url, schedule)
-                    if msg[0] == 'new_job_id':
-                        self.job_id = msg[1]
-                finally:
-                    consumed += 1
-            self._backend.update_score(batch)
+                    for record in iter_records(m.message.value):
+                        try:
+                            msg = self._decoder.decode(record)
+                        except (KeyError, TypeError), e:
+                            logger.error("Decoding error: %s", e)
+                            continue
+                        else:
+                            if msg[0] == 'update_score':
+                                _, fprint, score, url, schedule = msg
+                                batch[fprint] = (score, url, schedule)
+                            if msg[0] == 'new_job_id':
+                                self.job_id = msg[1]
+                                if self.shards > 1:
+                                    logger.warning("Got new job id %d, it has to be sent to every scoring log "
+                                                   "partition to reach all shards", self.job_id)
+                        finally:
+                            consumed += 1
+                except ValueError, e:
+                    logger.error("Framing error: %s", e)
         except OffsetOutOfRangeError, e:
             # https://github.com/mumrah/kafka-python/issues/263
             self._scoring_consumer.seek(0, 2)  # moving to the tail of the log
             logger.info("Caught OffsetOutOfRangeError, moving to the tail of the log.")
+        return batch, consumed
 
+    def process_scoring(self, batch, consumed):
+        self._scoring_backend.update_score(batch)
         logger.info("Consumed %d items during scoring consumption.", consumed)
         self.stats['last_consumed_scoring'] = consumed
         self.stats['last_consumption_run_scoring'] = asctime()
-        self.slot.schedule()
+        return consumed
 
     def new_batch(self, *args, **kwargs):
         lags = self._offset_fetcher.get()
@@ -174,6 +383,8 @@ class FrontierWorker(object):
 
         partitions = []
         for partition, lag in lags.iteritems():
+            if partition % self.shards != self.shard:
+                continue
             if lag < self.max_next_requests:
                 partitions.append(partition)
 
@@ -182,7 +393,10 @@ class FrontierWorker(object):
             return 0
 
         count = 0
-        for request in self._backend.get_next_requests(self.max_next_requests, partitions=partitions):
+        framer = Framer(self.frame_size) if self.frame_size else None
+        # backends able to stream requests, let encoding and producing overlap with reading of the other partitions
+        get_next_requests = getattr(self._batch_backend, 'iter_next_requests', self._batch_backend.get_next_requests)
+        for request in get_next_requests(self.max_next_requests, partitions=partitions):
             try:
                 request.meta['jid'] = self.job_id
                 eo = self._encoder.encode_request(request)
@@ -201,7 +415,15 @@ class FrontierWorker(object):
                                                                                 request.meta['fingerprint'], 
                                                                                 request.url))
             encoded_name = name.encode('utf-8', 'ignore')
-            self._producer.send_messages(self.outgoing_topic, encoded_name, eo)
+            if framer is None:
+                self._send(encoded_name, eo)
+                continue
+            frame = framer.add(self._get_outgoing_partition(encoded_name), encoded_name, eo)
+            if frame:
+                self._send(*frame)
+        if framer is not None:
+            for frame in framer.flush():
+                self._send(*frame)
         logger.info("Pushed new batch of %d items", count)
         self.stats['last_batch_size'] = count
         self.stats.setdefault('batches_after_start', 0)
@@ -209,6 +431,17 @@ class FrontierWorker(object):
         self.stats['last_batch_generated'] = asctime()
         return count
 
+    def _send(self, key, *messages):
+        responses = self._producer.send_messages(self.outgoing_topic, key, *messages)
+        self._offset_fetcher.produced(responses, len(messages))
+
+    def _get_outgoing_partition(self, key):
+        if self._outgoing_partitioner is None:
+            self._batch_kafka.load_metadata_for_topics(self.outgoing_topic)
+            partitions = self._batch_kafka.get_partition_ids_for_topic(self.outgoing_topic)
+            self._outgoing_partitioner = Crc32NamePartitioner(partitions)
+        return self._outgoing_partitioner.partition(key)
+
     def disable_new_batches(self):
         self.slot.disable_new_batches = True
 
@@ -223,18 +456,33 @@ if __name__ == '__main__':
                         help='Disables periodical consumption of scoring topic')
     parser.add_argument('--no-incoming', action='store_true',
                         help='Disables periodical incoming topic consumption')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Runs incoming and scoring consumption and batch generation on separate threads')
     parser.add_argument('--config', type=str, required=True,
                         help='Settings module name, should be accessible by import')
     parser.add_argument('--log-level', '-L', type=str, default='INFO',
                         help="Log level, for ex. DEBUG, INFO, WARN, ERROR, FATAL")
-    parser.add_argument('--port', type=int, help="Json Rpc service port to listen")
+    parser.add_argument('--port', type=int, help="Json Rpc service port to listen, shards listen on consecutive "
+                                                 "ports starting from it")
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Number of worker processes to start, each one consuming and generating batches for '
+                             'it\'s own subset of partitions')
+    parser.add_argument('--shard', type=int, help=SUPPRESS)
     args = parser.parse_args()
     logger.setLevel(args.log_level)
+
+    if args.shards > 1 and args.shard is None:
+        command = [sys.executable, '-m', 'distributed_frontera.worker.main'] + sys.argv[1:]
+        supervisor = Supervisor(lambda shard: command + ['--shard', str(shard)], args.shards)
+        sys.exit(0 if supervisor.run() else 1)
+
+    shard = args.shard or 0
     settings = Settings(module=args.config)
     if args.port:
-        settings.set("JSONRPC_PORT", [args.port])
+        settings.set("JSONRPC_PORT", [args.port + shard])
 
-    worker = FrontierWorker(settings, args.no_batches, args.no_scoring, args.no_incoming)
+    worker = FrontierWorker(settings, args.no_batches, args.no_scoring, args.no_incoming, args.pipelined,
+                            shard=shard, shards=args.shards)
     server = WorkerJsonRpcService(worker, settings)
     server.start_listening()
     worker.run()
@@ -2,6 +2,7 @@
 from kafka.common import OffsetRequest, OffsetFetchRequest, check_error, UnknownTopicOrPartitionError
 from logging import getLogger
 from collections import namedtuple
+from time import time
 
 logger = getLogger("offset-fetcher")
 
@@ -9,58 +10,88 @@ OffsetsStruct = namedtuple("OffsetsStruct", ["commit", "produced"])
 
 
 class Fetcher(object):
-    def __init__(self, client, topic, group_id):
+    """
+    Calculates lags of consumer group per topic partition. Offsets of all partitions are requested at once, in one
+    offset request and one offset fetch request.
+
+    Offsets are cached for ``ttl`` seconds. If ``track_produced`` is set, produced offsets are requested from broker
+    only once, and then kept up to date from acknowledgements passed to :meth:`produced`, so lags reflect produced
+    messages immediately, but the worker has to be the only producer to the topic.
+    """
+    def __init__(self, client, topic, group_id, ttl=0.0, track_produced=False):
+        """
+        :param client: Kafka client
+        :param str topic: topic to calculate lags for
+        :param str group_id: consumer group
+        :param float ttl: time in seconds, offsets are cached for
+        :param bool track_produced: get produced offsets from producer acknowledgements
+        """
         self._client = client
         self._topic = topic
         self._group_id = group_id
+        self._ttl = ttl
+        self._track_produced = track_produced
         self._client.load_metadata_for_topics()
         self._offsets = OffsetsStruct(commit=dict(),
                                       produced=dict())
         self._update_group_offsets()
         self._update_produced_offsets()
+        self._updated = time()
 
     def _update_produced_offsets(self):
         """
-        Arguments:
-            request_time_ms (int): Used to ask for all messages before a
-                certain time (ms). There are two special values. Specify -1 to receive the latest
-                offset (i.e. the offset of the next coming message) and -2 to receive the earliest
-                available offset. Note that because offsets are pulled in descending order, asking for
-                the earliest offset will always return you a single element.
+        Requests the latest offset (i.e. the offset of the next coming message) of every partition.
         """
-        for partition in self._client.get_partition_ids_for_topic(self._topic):
-            reqs = [OffsetRequest(self._topic, partition, -1, 1)]
-
-            (resp,) = self._client.send_offset_request(reqs)
-
+        partitions = self._client.get_partition_ids_for_topic(self._topic)
+        reqs = [OffsetRequest(self._topic, partition, -1, 1) for partition in partitions]
+        for resp in self._client.send_offset_request(reqs):
             check_error(resp)
             assert resp.topic == self._topic
-            assert resp.partition == partition
-            self._offsets.produced[partition] = resp.offsets[0]
+            self._offsets.produced[resp.partition] = resp.offsets[0]
 
     def _update_group_offsets(self):
         logger.info("Consumer fetching stored offsets")
-        for partition in self._client.get_partition_ids_for_topic(self._topic):
-            (resp,) = self._client.send_offset_fetch_request(
-                self._group_id,
-                [OffsetFetchRequest(self._topic, partition)],
-                fail_on_error=False)
+        partitions = self._client.get_partition_ids_for_topic(self._topic)
+        responses = self._client.send_offset_fetch_request(
+            self._group_id,
+            [OffsetFetchRequest(self._topic, partition) for partition in partitions],
+            fail_on_error=False)
+        for resp in responses:
             try:
                 check_error(resp)
             except UnknownTopicOrPartitionError:
                 pass
 
             if resp.offset == -1:
-                self._offsets.commit[partition] = None
+                self._offsets.commit[resp.partition] = None
             else:
-                self._offsets.commit[partition] = resp.offset
+                self._offsets.commit[resp.partition] = resp.offset
+
+    def produced(self, responses, count):
+        """
+        Updates produced offsets from producer acknowledgements, does nothing unless ``track_produced`` is set.
+
+        :param responses: list of :class:`kafka.common.ProduceResponse`
+        :param int count: number of messages in every acknowledged request
+        """
+        if not self._track_produced:
+            return
+        for resp in responses:
+            if resp.error or resp.offset < 0:
+                continue
+            offset = resp.offset + count
+            if offset > self._offsets.produced.get(resp.partition, 0):
+                self._offsets.produced[resp.partition] = offset
 
     def get(self):
         """
         :return: dict Lags per partition
         """
-        self._update_produced_offsets()
-        self._update_group_offsets()
+        if time() - self._updated >= self._ttl:
+            if not self._track_produced:
+                self._update_produced_offsets()
+            self._update_group_offsets()
+            self._updated = time()
 
         lags = {}
         for partition in self._client.get_partition_ids_for_topic(self._topic):
@@ -68,7 +99,3 @@ class Fetcher(object):
             lag = produced - self._offsets.commit[partition] if self._offsets.commit[partition] else 0.0
             lags[partition] = lag
         return lags
-
-
-
-
@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
-from time import asctime
+from time import asctime, time
 import logging
 from argparse import ArgumentParser
+from collections import deque
 from importlib import import_module
 
 from frontera.core.manager import FrontierManager
-from kafka import KafkaClient, SimpleProducer, SimpleConsumer
+from frontera.utils.misc import load_object
+from kafka import SimpleProducer
 from kafka.common import OffsetOutOfRangeError
 from kafka.protocol import CODEC_SNAPPY
 
+from distributed_frontera.backends.remote.codecs.framing import Framer
 from distributed_frontera.settings import Settings
-from distributed_frontera.backends.remote.codecs.msgpack import Decoder, Encoder
+from distributed_frontera.worker.consumer import AdaptiveConsumer
 
 logging.basicConfig()
 logger = logging.getLogger("score")
@@ -18,34 +21,51 @@ logger = logging.getLogger("score")
 
 class ScoringWorker(object):
     def __init__(self, settings, strategy_module):
-        kafka = KafkaClient(settings.get('KAFKA_LOCATION'))
+        kafka = load_object(settings.get('KAFKA_CLIENT'))(settings.get('KAFKA_LOCATION'))
         self._producer = SimpleProducer(kafka, codec=CODEC_SNAPPY)
         partition_id = settings.get('SCORING_PARTITION_ID')
         if partition_id == None or type(partition_id) != int:
             raise AttributeError("Scoring worker partition id isn't set.")
-        self._in_consumer = SimpleConsumer(kafka,
-                                       settings.get('SCORING_GROUP'),
-                                       settings.get('INCOMING_TOPIC'),
-                                       buffer_size=1048576,
-                                       max_buffer_size=10485760,
-                                       partitions=[partition_id])
+        self._in_consumer = AdaptiveConsumer(kafka,
+                                             settings.get('SCORING_GROUP'),
+                                             settings.get('INCOMING_TOPIC'),
+                                             buffer_size=1048576,
+                                             max_buffer_size=10485760,
+                                             partitions=[partition_id])
 
         self._manager = FrontierManager.from_settings(settings)
-        self._decoder = Decoder(self._manager.request_model, self._manager.response_model)
-        self._encoder = Encoder(self._manager.request_model)
+        codec = import_module(settings.get('KAFKA_CODEC'))
+        self._decoder = codec.Decoder(self._manager.request_model, self._manager.response_model)
+        self._encoder = codec.Encoder(self._manager.request_model, version=settings.get('KAFKA_CODEC_VERSION'))
 
         self.consumer_batch_size = settings.get('CONSUMER_BATCH_SIZE', 128)
         self.outgoing_topic = settings.get('SCORING_TOPIC')
+        self.frame_size = settings.get('KAFKA_FRAME_SIZE')
         self.strategy = strategy_module.CrawlingStrategy()
         self.backend = self._manager.backend
-        self.stats = {}
+        self.stats = {
+            'incoming_consumer': self._in_consumer.stats
+        }
         self.cache_flush_counter = 0
         self.job_id = 0
+        self.partition_id = partition_id
 
+        self.snapshot_path = settings.get('SCORING_STATES_SNAPSHOT')
+        self.snapshot_interval = settings.get('SCORING_STATES_SNAPSHOT_INTERVAL')
+        self.last_snapshot = time()
+        if self.snapshot_path:
+            # messages after the snapshot are consumed again, even if their offsets were committed already, so that
+            # states are exactly the same as if the worker wasn't stopped
+            offset = self.backend.load_states_snapshot(self.snapshot_path)
+            if offset is not None:
+                self._in_consumer.seek(offset, partition=partition_id)
+        # filter loaded from snapshot doesn't know states written by other workers since then, so it's always
+        # rebuilt
+        self.backend.rebuild_states_filter()
 
     def work(self):
         consumed = 0
-        batch = []
+        batch = deque()
         fingerprints = set()
         try:
             for m in self._in_consumer.get_messages(count=self.consumer_batch_size, block=True, timeout=1.0):
@@ -64,6 +84,8 @@ class ScoringWorker(object):
 
                     if type == 'page_crawled':
                         _, response, links = msg
+                        if response.meta['jid'] != self.job_id:
+                            continue
                         fingerprints.add(response.meta['fingerprint'])
                         fingerprints.update(map(lambda x: x.meta['fingerprint'], links))
                         continue
@@ -84,9 +106,11 @@ class ScoringWorker(object):
         self.backend.fetch_states(list(fingerprints))
         fingerprints.clear()
         results = []
-        for msg in batch:
+        while batch:
+            # decoded objects of every message are released as soon as it's processed
+            msg = batch.popleft()
             if len(results) > 1024:
-                self._producer.send_messages(self.outgoing_topic, *results)
+                self.send_results(results)
                 results = []
 
             type = msg[0]
@@ -110,7 +134,7 @@ class ScoringWorker(object):
                 results.extend(self.on_request_error(request, error))
                 continue
         if len(results):
-            self._producer.send_messages(self.outgoing_topic, *results)
+            self.send_results(results)
 
         if self.cache_flush_counter == 30:
             logger.info("Flushing states")
@@ -120,6 +144,9 @@ class ScoringWorker(object):
 
         self.cache_flush_counter += 1
 
+        if self.snapshot_path and time() - self.last_snapshot > self.snapshot_interval:
+            self.snapshot_states()
+
         if self.strategy.finished():
             logger.info("Succesfully reached the crawling goal. Exiting.")
             exit(0)
@@ -129,8 +156,37 @@ class ScoringWorker(object):
         self.stats['last_consumption_run'] = asctime()
 
     def run(self):
-        while True:
-            self.work()
+        try:
+            while True:
+                self.work()
+        finally:
+            logger.info("Stopping, flushing states")
+            if self.snapshot_path:
+                self.snapshot_states()
+            self._manager.stop()
+
+    def send_results(self, results):
+        if not self.frame_size:
+            self._producer.send_messages(self.outgoing_topic, *results)
+            return
+        # scoring log isn't keyed, so records aren't grouped by partition
+        framer = Framer(self.frame_size)
+        frames = []
+        for result in results:
+            full = framer.add(None, None, result)
+            if full:
+                frames.append(full[1])
+        frames.extend(frame for _, frame in framer.flush())
+        self._producer.send_messages(self.outgoing_topic, *frames)
+
+    def snapshot_states(self):
+        self._in_consumer.commit()
+        self.last_snapshot = time()
+        try:
+            self.backend.snapshot_states(self.snapshot_path, self._in_consumer.offsets[self.partition_id])
+        except IOError, e:
+            # changed states are kept and written with the next flush
+            logger.error("States snapshot failed: %s", e)
 
 
     def on_add_seeds(self, seeds):
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import signal
+from logging import getLogger
+from subprocess import Popen
+from time import time, sleep
+
+logger = getLogger("supervisor")
+
+
+class Supervisor(object):
+    """
+    Starts ``shards`` child processes, running command returned by ``command(shard)`` in each of them, and waits for
+    them to finish.
+
+    Children are started from scratch, rather than just forked, because Twisted reactor, Kafka and HBase connections
+    created on import or before fork can't be shared. SIGINT and SIGTERM received by supervisor are passed to all
+    children. Child exited with non-zero status is started again, unless supervisor is stopping, or child failed during
+    ``min_uptime`` seconds after start, which is likely a configuration error and would loop forever.
+    """
+    def __init__(self, command, shards, min_uptime=5.0, poll_interval=1.0):
+        """
+        :param command: callable getting shard number and returning list of child process arguments
+        :param int shards: number of child processes
+        :param float min_uptime: time in seconds, child has to run to be restarted after failure
+        :param float poll_interval: time in seconds between checks of children status
+        """
+        self.command = command
+        self.shards = shards
+        self.min_uptime = min_uptime
+        self.poll_interval = poll_interval
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        :return: True if all children exited successfully
+        """
+        handlers = {}
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            handlers[signum] = signal.signal(signum, self._on_signal)
+        success = True
+        try:
+            for shard in xrange(self.shards):
+                self._spawn(shard)
+            while self.children:
+                sleep(self.poll_interval)
+                for shard, (process, started) in self.children.items():
+                    status = process.poll()
+                    if status is None:
+                        continue
+                    del self.children[shard]
+                    if status == 0 or self.stopping:
+                        logger.info("Shard %d (pid %d) exited with status %d", shard, process.pid, status)
+                        continue
+                    success = False
+                    if time() - started < self.min_uptime:
+                        logger.error("Shard %d (pid %d) failed right after start with status %d, not restarting",
+                                     shard, process.pid, status)
+                        continue
+                    logger.error("Shard %d (pid %d) failed with status %d, restarting", shard, process.pid, status)
+                    self._spawn(shard)
+        finally:
+            for signum, handler in handlers.iteritems():
+                signal.signal(signum, handler)
+        return success
+
+    def stop(self, signum=signal.SIGTERM):
+        self.stopping = True
+        for process, _ in self.children.values():
+            try:
+                process.send_signal(signum)
+            except OSError:
+                pass
+
+    def _on_signal(self, signum, frame):
+        logger.info("Got signal %d, stopping shards", signum)
+        self.stop(signum)
+
+    def _spawn(self, shard):
+        process = Popen(self.command(shard))
+        logger.info("Started shard %d, pid %d", shard, process.pid)
+        self.children[shard] = (process, time())
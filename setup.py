@@ -31,7 +31,7 @@ setup(
     ],
     install_requires=[
         'happybase',
-        'kafka-python',
+        'kafka-python==0.9.5',
         'msgpack-python',
         'python-snappy',
         'frontera'